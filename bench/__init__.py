@@ -0,0 +1,2 @@
+"""Performance benchmarks. See bench.run for the command-line driver.
+"""
@@ -0,0 +1,309 @@
+"""Benchmark cases. Each case is a function which takes the benchmark
+context and (for sized cases) a series size, sets up whatever it
+needs, and returns a tuple (fn, ops): fn is called repeatedly by the
+harness, and performs ops operations each time.
+"""
+
+import io
+import datetime
+import itertools
+import struct
+import wsgiref.util
+
+import fuse.api
+import fuse.arrays as arrays
+import fuse.conneg as conneg
+import fuse.decimate as decimate
+import fuse.muddleware as muddleware
+
+_UTC = datetime.timezone.utc
+BASE = datetime.datetime(2012, 8, 28, 12, 0, 0, 0, _UTC)
+STEP = datetime.timedelta(seconds=30)
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+_USEC = datetime.timedelta(microseconds=1)
+
+CASES = []
+
+def case(name, sized=True):
+	"""Decorator registering a benchmark case
+	"""
+	def register(fn):
+		CASES.append((name, sized, fn))
+		return fn
+	return register
+
+def dataset(size, start=BASE):
+	"""Return a list of size (timestamp, value) pairs
+	"""
+	return [(start + STEP * i, 20.0 + (i % 97) * 0.25) for i in range(size)]
+
+def value_array(size, start=BASE):
+	"""Return the same data as dataset(), as a ValueArray
+	"""
+	data = dataset(size, start)
+	return arrays.ValueArray([(ts - _EPOCH) // _USEC for ts, v in data],
+							 [v for ts, v in data])
+
+class Context(object):
+	"""State shared by the benchmark cases: the configuration, the
+	database, the WSGI application, and the series created (so that
+	they can be dropped afterwards).
+	"""
+	def __init__(self, conf, db, app):
+		self.conf = conf
+		self.db = db
+		self.app = app
+		self.created = []
+		self.populated = {}
+
+	def new_series(self, name):
+		sid = self.db.create_series(name, STEP)
+		self.created.append(sid)
+		return sid
+
+	def series_with(self, size):
+		"""Return the ID of a series holding size points, creating it
+		the first time
+		"""
+		if size not in self.populated:
+			sid = self.new_series("bench-{0}".format(size))
+			for ts, value in dataset(size):
+				self.db.add_value(sid, ts, value)
+			self.populated[size] = sid
+		return self.populated[size]
+
+	def cleanup(self):
+		for sid in self.created:
+			self.db.drop_series(sid)
+		self.created = []
+		self.populated = {}
+
+	def request(self, method, path, query="", body=b"", content_type=None):
+		"""Make an in-process WSGI request, consuming the response,
+		and return the status line and the body
+		"""
+		environ = {}
+		wsgiref.util.setup_testing_defaults(environ)
+		environ["REQUEST_METHOD"] = method
+		environ["PATH_INFO"] = path
+		environ["QUERY_STRING"] = query
+		environ["CONTENT_LENGTH"] = str(len(body))
+		environ["wsgi.input"] = io.BytesIO(body)
+		if content_type is not None:
+			environ["CONTENT_TYPE"] = content_type
+		status = []
+		def start_response(result, headers, exc_info=None):
+			status.append(result)
+		data = self.app(environ, start_response)
+		try:
+			body = b"".join(data)
+		finally:
+			if hasattr(data, "close"):
+				data.close()
+		return status[0], body
+
+def _request_fn(ctx, *args, **kwargs):
+	def fn():
+		status, body = ctx.request(*args, **kwargs)
+		if not status.startswith("2"):
+			raise RuntimeError("Request failed: {0}".format(status))
+	return fn
+
+@case("parse_timestamp", sized=False)
+def parse_timestamp(ctx):
+	stamps = [ts.strftime(fuse.api.DATE_FORMAT) for ts, v in dataset(1000)]
+	def fn():
+		for s in stamps:
+			fuse.api.parse_timestamp(s)
+	return fn, len(stamps)
+
+@case("db.add_value")
+def db_add_value(ctx, size):
+	sid = ctx.new_series("bench-ingest-{0}".format(size))
+	# Each iteration writes new points after the previous ones
+	offsets = itertools.count()
+	def fn():
+		start = BASE + STEP * size * next(offsets)
+		for ts, value in dataset(size, start):
+			ctx.db.add_value(sid, ts, value)
+	return fn, size
+
+@case("db.get_values")
+def db_get_values(ctx, size):
+	sid = ctx.series_with(size)
+	def fn():
+		list(ctx.db.get_values(sid))
+	return fn, size
+
+@case("db.get_values.short")
+def db_get_values_short(ctx, size):
+	"""Read successive ten-point windows of the series
+	"""
+	sid = ctx.series_with(size)
+	windows = itertools.cycle(range(0, max(size - 10, 1), 10))
+	def fn():
+		start = BASE + STEP * next(windows)
+		list(ctx.db.get_values(sid, start, start + STEP * 10))
+	return fn, 1
+
+@case("db.get_summaries")
+def db_get_summaries(ctx, size):
+	"""The maintained summary of a series, which costs the same
+	however much data the series has
+	"""
+	sid = ctx.series_with(size)
+	def fn():
+		ctx.db.get_summaries([sid])
+	return fn, 1
+
+@case("db.is_series", sized=False)
+def db_is_series(ctx):
+	sid = ctx.series_with(1)
+	def fn():
+		ctx.db.is_series(sid)
+	return fn, 1
+
+def unprepared(setup):
+	"""Wrap a database case so that it runs without prepared
+	statements, for comparison
+	"""
+	def wrapped(ctx, *args):
+		fn, ops = setup(ctx, *args)
+		def unprepared_fn():
+			prepare = getattr(ctx.db, "prepare", False)
+			ctx.db.prepare = False
+			try:
+				fn()
+			finally:
+				ctx.db.prepare = prepare
+		return unprepared_fn, ops
+	return wrapped
+
+for _name, _sized, _setup in list(CASES):
+	if _name.startswith("db."):
+		case(_name + ".unprepared", sized=_sized)(unprepared(_setup))
+
+@case("encode.json")
+def encode_json(ctx, size):
+	data = dataset(size)
+	def fn():
+		b"".join(conneg.JSONTransformer().transform(data, {}))
+	return fn, size
+
+@case("encode.json.array")
+def encode_json_array(ctx, size):
+	data = value_array(size)
+	def fn():
+		b"".join(conneg.JSONTransformer().transform(data, {}))
+	return fn, size
+
+@case("encode.csv")
+def encode_csv(ctx, size):
+	data = dataset(size)
+	def fn():
+		b"".join(conneg.CSVDataTransformer().transform(data, {}))
+	return fn, size
+
+@case("encode.csv.array")
+def encode_csv_array(ctx, size):
+	data = value_array(size)
+	def fn():
+		b"".join(conneg.CSVDataTransformer().transform(data, {}))
+	return fn, size
+
+@case("decimate.lttb")
+def decimate_lttb(ctx, size):
+	data = value_array(size)
+	def fn():
+		decimate.decimate(data, 2000, "lttb")
+	return fn, 1
+
+@case("decimate.minmax")
+def decimate_minmax(ctx, size):
+	data = value_array(size)
+	def fn():
+		decimate.decimate(data, 2000, "minmax")
+	return fn, 1
+
+@case("middleware.chain", sized=False)
+def middleware_chain(ctx):
+	"""The cost of the standard middleware chain alone, around a
+	handler which does nothing
+	"""
+	class NullMapper(object):
+		def add(self, *args, **kwargs):
+			pass
+	api = fuse.api.APIWrapper(ctx.conf, ctx.db, NullMapper())
+	def null_handler(req, res):
+		req["transformers"] = fuse.api.STD_TRANSFORMERS
+		res.data = muddleware.BinaryJSONIterator([])
+	app = api.wrap(null_handler)
+	environ = {}
+	wsgiref.util.setup_testing_defaults(environ)
+	def start_response(result, headers, exc_info=None):
+		pass
+	def fn():
+		data = app(dict(environ), start_response)
+		b"".join(data)
+		data.close()
+	return fn, 1
+
+@case("stack.get_series_info", sized=False)
+def stack_series_info(ctx):
+	sid = ctx.series_with(1)
+	return _request_fn(ctx, "GET", "/api/series/{0}".format(sid)), 1
+
+@case("stack.get_data")
+def stack_get_data(ctx, size):
+	sid = ctx.series_with(size)
+	return _request_fn(ctx, "GET", "/api/series/{0}/data".format(sid)), 1
+
+@case("stack.get_data.csv")
+def stack_get_data_csv(ctx, size):
+	sid = ctx.series_with(size)
+	return _request_fn(ctx, "GET", "/api/series/{0}/data.csv".format(sid)), 1
+
+@case("stack.get_data.decimated")
+def stack_get_data_decimated(ctx, size):
+	sid = ctx.series_with(size)
+	return _request_fn(ctx, "GET", "/api/series/{0}/data".format(sid),
+					   "points=2000"), 1
+
+@case("stack.get_data.percentiles")
+def stack_get_data_percentiles(ctx, size):
+	sid = ctx.series_with(size)
+	return _request_fn(ctx, "GET", "/api/series/{0}/data".format(sid),
+					   "agg=p50,p95,p99&interval=604800"), 1
+
+@case("stack.add_data")
+def stack_add_data(ctx, size):
+	sid = ctx.new_series("bench-post-{0}".format(size))
+	offsets = itertools.count()
+	def fn():
+		start = BASE + STEP * size * next(offsets)
+		body = "[" + ",".join(
+			'["{0}", {1}]'.format(ts.strftime(fuse.api.DATE_FORMAT), v)
+			for ts, v in dataset(size, start)) + "]"
+		status, res = ctx.request("POST", "/api/series/{0}/data".format(sid),
+								  body=body.encode("utf8"),
+								  content_type="application/json")
+		if not status.startswith("2"):
+			raise RuntimeError("Request failed: {0}".format(status))
+	return fn, size
+
+@case("stack.add_data.packed")
+def stack_add_data_packed(ctx, size):
+	sid = ctx.new_series("bench-post-packed-{0}".format(size))
+	offsets = itertools.count()
+	record = struct.Struct("<qd")
+	def fn():
+		start = BASE + STEP * size * next(offsets)
+		body = b"".join(
+			record.pack((ts - _EPOCH) // _USEC, v)
+			for ts, v in dataset(size, start))
+		status, res = ctx.request("POST", "/api/series/{0}/data".format(sid),
+								  body=body,
+								  content_type="application/octet-stream")
+		if not status.startswith("2"):
+			raise RuntimeError("Request failed: {0}".format(status))
+	return fn, size
@@ -0,0 +1,92 @@
+"""Timing harness for the benchmarks: run a function repeatedly,
+summarise its timings, and compare a set of results against a stored
+baseline.
+"""
+
+import time
+import json
+import platform
+import sys
+
+def percentile(samples, pct):
+	"""Return the pct'th percentile of a sorted list of samples, by
+	linear interpolation between the closest ranks
+	"""
+	if not samples:
+		return 0.0
+	pos = (len(samples) - 1) * pct / 100.0
+	lo = int(pos)
+	hi = min(lo + 1, len(samples) - 1)
+	return samples[lo] + (samples[hi] - samples[lo]) * (pos - lo)
+
+def summarise(samples, ops):
+	"""Summarise a list of per-iteration timings (in seconds), where
+	each iteration performed ops operations. Latencies are reported
+	per iteration, in microseconds; throughput in operations per
+	second.
+	"""
+	samples = sorted(samples)
+	total = sum(samples)
+	return { "iterations": len(samples),
+			 "ops_per_iteration": ops,
+			 "p50_us": percentile(samples, 50) * 1e6,
+			 "p99_us": percentile(samples, 99) * 1e6,
+			 "mean_us": total / len(samples) * 1e6,
+			 "throughput": ops * len(samples) / total if total > 0 else 0.0,
+			 }
+
+def measure(fn, ops=1, min_time=0.5, min_iterations=5, max_iterations=10000,
+			warmup=1):
+	"""Call fn repeatedly (after warmup calls), until at least
+	min_time seconds and min_iterations calls have been spent on it,
+	and return the summary of its timings.
+	"""
+	for i in range(warmup):
+		fn()
+	samples = []
+	clock = time.perf_counter
+	deadline = clock() + min_time
+	while len(samples) < max_iterations:
+		start = clock()
+		fn()
+		samples.append(clock() - start)
+		if len(samples) >= min_iterations and clock() >= deadline:
+			break
+	return summarise(samples, ops)
+
+def environment():
+	"""Describe the environment the benchmarks were run in
+	"""
+	return { "python": sys.version.split()[0],
+			 "implementation": platform.python_implementation(),
+			 "platform": platform.platform(),
+			 "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+			 }
+
+def compare(results, baseline, threshold=0.2):
+	"""Compare results with a baseline. A case is a regression if its
+	median latency is more than threshold (as a fraction) above the
+	baseline's. Returns a list of (case, baseline p50, current p50,
+	change) for every case present in both, and a list of the cases
+	which regressed.
+	"""
+	rows = []
+	regressed = []
+	for case, cur in sorted(results.items()):
+		base = baseline.get(case)
+		if base is None or base["p50_us"] <= 0:
+			continue
+		change = cur["p50_us"] / base["p50_us"] - 1.0
+		rows.append((case, base["p50_us"], cur["p50_us"], change))
+		if change > threshold:
+			regressed.append(case)
+	return rows, regressed
+
+def load(fname):
+	with open(fname) as f:
+		return json.load(f)
+
+def save(fname, data):
+	with open(fname, "w") as f:
+		json.dump(data, f, indent=1, sort_keys=True)
+		f.write("\n")
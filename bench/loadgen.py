@@ -0,0 +1,229 @@
+"""Mixed-workload load generator for a running FUSE server.
+
+The load generator creates a set of series through the API, then
+issues a mix of operations at a fixed target rate for a fixed time:
+
+  ingest   POST a logger-style batch of new points to one series
+  range    GET a dashboard-style window of recent data from one series
+  list     GET the full series list
+  info     GET the metadata for one series
+
+Operations are scheduled open-loop: each is due at a fixed time,
+whether or not earlier operations have finished, and its latency is
+measured from the time it was due. This means a server which falls
+behind shows up as increased latency, rather than as a reduced
+request rate.
+"""
+
+import sys
+import time
+import json
+import random
+import argparse
+import datetime
+import threading
+import concurrent.futures
+
+import requests
+
+import bench.harness as harness
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
+_UTC = datetime.timezone.utc
+START = datetime.datetime(2012, 8, 28, 0, 0, 0, 0, _UTC)
+
+class OpStats(object):
+	"""Latencies and error counts for one type of operation
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.latencies = []
+		self.errors = 0
+
+	def record(self, latency, ok):
+		with self.lock:
+			self.latencies.append(latency)
+			if not ok:
+				self.errors += 1
+
+	def summary(self, elapsed):
+		lat = sorted(self.latencies)
+		n = len(lat)
+		return { "count": n,
+				 "errors": self.errors,
+				 "error_rate": self.errors / n if n else 0.0,
+				 "throughput": n / elapsed if elapsed > 0 else 0.0,
+				 "p50_ms": harness.percentile(lat, 50) * 1000,
+				 "p90_ms": harness.percentile(lat, 90) * 1000,
+				 "p99_ms": harness.percentile(lat, 99) * 1000,
+				 "max_ms": lat[-1] * 1000 if lat else 0.0,
+				 }
+
+class LoadGenerator(object):
+	def __init__(self, base_uri, period=30, batch=20, window=2880):
+		self.base_uri = base_uri.rstrip("/") + "/"
+		self.period = datetime.timedelta(seconds=period)
+		self.batch = batch
+		self.window = window
+		self.series = []
+		self.written = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.stats = {}
+
+	def session(self):
+		"""Return this thread's HTTP session, so connections are
+		reused
+		"""
+		s = getattr(self.local, "session", None)
+		if s is None:
+			s = requests.Session()
+			self.local.session = s
+		return s
+
+	def provision(self, count, preload=0):
+		"""Create count series, each holding preload points
+		"""
+		for i in range(count):
+			desc = { "name": "loadgen-{0}".format(i),
+					 "period": int(self.period.total_seconds()),
+					 "type": "mean" }
+			r = self.session().post(self.base_uri + "series/",
+									data=json.dumps(desc).encode("utf8"),
+									headers={"Content-Type": "application/json"})
+			r.raise_for_status()
+			sid = int(r.json())
+			self.series.append(sid)
+			self.written[sid] = 0
+			while self.written[sid] < preload:
+				self.ingest(sid)
+
+	def next_batch(self, sid):
+		"""Reserve the timestamps for the next batch of points for a
+		series
+		"""
+		with self.lock:
+			first = self.written[sid]
+			self.written[sid] += self.batch
+		return [START + self.period * (first + i) for i in range(self.batch)]
+
+	def ingest(self, sid):
+		data = [(ts.strftime(DATE_FORMAT), round(random.gauss(20, 5), 3))
+				for ts in self.next_batch(sid)]
+		return self.session().post(
+			"{0}series/{1}/data".format(self.base_uri, sid),
+			data=json.dumps(data).encode("utf8"),
+			headers={"Content-Type": "application/json"})
+
+	def range(self, sid):
+		with self.lock:
+			end = self.written[sid]
+		start = max(0, end - self.window)
+		params = { "startdate": (START + self.period * start).strftime(DATE_FORMAT),
+				   "enddate": (START + self.period * end).strftime(DATE_FORMAT) }
+		return self.session().get(
+			"{0}series/{1}/data".format(self.base_uri, sid), params=params)
+
+	def list(self, sid):
+		return self.session().get(self.base_uri + "series/")
+
+	def info(self, sid):
+		return self.session().get("{0}series/{1}".format(self.base_uri, sid))
+
+	def execute(self, op, due):
+		"""Run one operation, and record its latency from the time it
+		was due
+		"""
+		sid = random.choice(self.series)
+		try:
+			r = getattr(self, op)(sid)
+			ok = r.status_code < 400
+		except requests.RequestException:
+			ok = False
+		self.stats[op].record(time.perf_counter() - due, ok)
+
+	def run(self, mix, rate, duration, threads):
+		"""Issue operations chosen at random according to mix (a dict
+		of operation name to weight), at rate operations per second,
+		for duration seconds. Returns the elapsed time.
+		"""
+		ops = list(mix)
+		weights = [mix[op] for op in ops]
+		self.stats = { op: OpStats() for op in ops }
+		interval = 1.0 / rate
+		total = int(rate * duration)
+		with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+			start = time.perf_counter()
+			for i in range(total):
+				due = start + i * interval
+				delay = due - time.perf_counter()
+				if delay > 0:
+					time.sleep(delay)
+				op = random.choices(ops, weights)[0]
+				pool.submit(self.execute, op, due)
+		# Include the time taken for the last operations to complete
+		return time.perf_counter() - start
+
+	def report(self, elapsed):
+		return { op: st.summary(elapsed) for op, st in sorted(self.stats.items()) }
+
+def parse_mix(text):
+	"""Parse an operation mix of the form "ingest=50,range=40,list=10"
+	"""
+	mix = {}
+	for part in text.split(","):
+		op, weight = part.split("=")
+		if op not in ("ingest", "range", "list", "info"):
+			raise ValueError("Unknown operation '{0}'".format(op))
+		mix[op] = float(weight)
+	return mix
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(
+		description="Drive a mixed workload against a FUSE server")
+	parser.add_argument("--url", default="http://localhost:1731/api/",
+						help="base URI of the API")
+	parser.add_argument("--series", type=int, default=20,
+						help="number of series to create")
+	parser.add_argument("--preload", type=int, default=200,
+						help="points to load into each series before starting")
+	parser.add_argument("--mix", default="ingest=50,range=35,list=5,info=10",
+						help="relative weights of the operations")
+	parser.add_argument("--rate", type=float, default=50,
+						help="target operations per second")
+	parser.add_argument("--duration", type=float, default=30,
+						help="seconds to run for")
+	parser.add_argument("--threads", type=int, default=16,
+						help="maximum concurrent requests")
+	parser.add_argument("--batch", type=int, default=20,
+						help="points in each ingest batch")
+	parser.add_argument("--window", type=int, default=2880,
+						help="points covered by each range read")
+	parser.add_argument("--output", default=None,
+						help="file to write the results to (JSON)")
+	args = parser.parse_args(argv)
+
+	gen = LoadGenerator(args.url, batch=args.batch, window=args.window)
+	print("Creating {0} series".format(args.series), file=sys.stderr)
+	gen.provision(args.series, args.preload)
+	print("Running at {0} ops/s for {1} s".format(args.rate, args.duration),
+		  file=sys.stderr)
+	elapsed = gen.run(parse_mix(args.mix), args.rate, args.duration, args.threads)
+	report = gen.report(elapsed)
+
+	print("{0:8s} {1:>8s} {2:>7s} {3:>9s} {4:>9s} {5:>9s} {6:>9s} {7:>9s}".format(
+		"op", "count", "errors", "ops/s", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+	for op, r in report.items():
+		print("{0:8s} {1:8d} {2:7d} {3:9.1f} {4:9.2f} {5:9.2f} {6:9.2f} {7:9.2f}"
+			  .format(op, r["count"], r["errors"], r["throughput"],
+					  r["p50_ms"], r["p90_ms"], r["p99_ms"], r["max_ms"]))
+
+	if args.output is not None:
+		harness.save(args.output, { "environment": harness.environment(),
+									"arguments": vars(args),
+									"elapsed": elapsed,
+									"operations": report })
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
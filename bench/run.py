@@ -0,0 +1,111 @@
+"""Benchmark driver.
+
+	python3 -m bench.run [options]
+
+Runs the benchmark cases in bench.cases against the database named
+in a configuration module (by default test.test_config; use --db-type
+memory to run without a database server), and writes the results as
+JSON. Latencies are per iteration of each case; the throughput is in
+operations (points, timestamps or requests, depending on the case)
+per second.
+
+With --baseline, the results are compared against a stored set of
+results, and the exit status is 1 if any case's median latency has
+regressed by more than --threshold.
+"""
+
+import sys
+import argparse
+import importlib
+import types
+import fnmatch
+import logging
+
+import fuse.app
+import fuse.db
+
+import bench.harness as harness
+import bench.cases as cases
+
+log = logging.getLogger("bench")
+
+def load_config(name, db_type=None):
+	"""Load the named configuration module, overriding its database
+	type if requested
+	"""
+	conf = importlib.import_module(name)
+	if db_type is None:
+		return conf
+	overridden = types.SimpleNamespace(**{
+		k: v for k, v in vars(conf).items() if not k.startswith("__") })
+	overridden.db_type = db_type
+	return overridden
+
+def run(ctx, sizes, pattern="*", min_time=0.5):
+	"""Run all the cases matching pattern, returning a dict of results
+	keyed by case name (with the size appended for sized cases)
+	"""
+	results = {}
+	for name, sized, setup in cases.CASES:
+		for size in (sizes if sized else [None]):
+			key = name if size is None else "{0}[{1}]".format(name, size)
+			if not fnmatch.fnmatch(key, pattern):
+				continue
+			if size is None:
+				fn, ops = setup(ctx)
+			else:
+				fn, ops = setup(ctx, size)
+			results[key] = harness.measure(fn, ops, min_time=min_time)
+			r = results[key]
+			print("{0:36s} p50 {1:12.1f} us  p99 {2:12.1f} us  {3:14.1f} ops/s"
+				  .format(key, r["p50_us"], r["p99_us"], r["throughput"]),
+				  file=sys.stderr)
+	return results
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Run the FUSE benchmarks")
+	parser.add_argument("--config", default="test.test_config",
+						help="configuration module to use")
+	parser.add_argument("--db-type", default=None,
+						help="override the configured database type")
+	parser.add_argument("--sizes", default="100,1000,10000",
+						help="comma-separated series sizes")
+	parser.add_argument("--cases", default="*",
+						help="glob pattern selecting the cases to run")
+	parser.add_argument("--min-time", type=float, default=0.5,
+						help="minimum time to spend on each case (s)")
+	parser.add_argument("--output", default=None,
+						help="file to write the results to (JSON)")
+	parser.add_argument("--baseline", default=None,
+						help="results file to compare against")
+	parser.add_argument("--threshold", type=float, default=0.2,
+						help="fractional slowdown counted as a regression")
+	args = parser.parse_args(argv)
+
+	conf = load_config(args.config, args.db_type)
+	sizes = [int(s) for s in args.sizes.split(",") if s]
+	db = fuse.db.get_database(conf)
+	ctx = cases.Context(conf, db, fuse.app.get_app(conf))
+	try:
+		results = run(ctx, sizes, args.cases, args.min_time)
+	finally:
+		ctx.cleanup()
+
+	output = { "environment": harness.environment(),
+			   "db_type": conf.db_type,
+			   "results": results }
+	if args.output is not None:
+		harness.save(args.output, output)
+
+	if args.baseline is None:
+		return 0
+	baseline = harness.load(args.baseline)["results"]
+	rows, regressed = harness.compare(results, baseline, args.threshold)
+	for case, base, cur, change in rows:
+		flag = " REGRESSION" if case in regressed else ""
+		print("{0:36s} {1:12.1f} -> {2:12.1f} us  {3:+7.1%}{4}"
+			  .format(case, base, cur, change, flag))
+	return 1 if regressed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
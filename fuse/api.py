@@ -10,18 +10,83 @@ import urllib.parse
 
 import fuse.muddleware as muddleware
 import fuse.conneg as conneg
+import fuse.metrics as metrics
+import fuse.trace as trace
+import fuse.arrays as arrays
+import fuse.watermark as watermark
+import fuse.live as live
+import fuse.spool as spool
+import fuse.decimate as decimate
+import fuse.sketch as sketch
 
 BJI = muddleware.BinaryJSONIterator
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+USEC = datetime.timedelta(microseconds=1)
+NAN = float("nan")
+# The grid layout is refused if it would have more than this many
+# slots per data point
+GRID_MAX_SPARSITY = 16
 STD_TRANSFORMERS = { 'json': conneg.JSONTransformer }
+METRICS_TRANSFORMERS = {
+	'default': lambda: conneg.TextTransformer(
+		"text/plain; version=0.0.4; charset=utf-8") }
+EXPORT_TRANSFORMERS = {
+	'default': lambda: conneg.TextTransformer("text/csv; charset=utf-8") }
+LIVE_TRANSFORMERS = {
+	'default': lambda: conneg.TextTransformer("text/event-stream") }
 
 """
 REST API structure:
-/api/series/        GET full list of series IDs, POST to add series
+/api/series/        GET list of series, a page at a time (?name=,
+                    ?prefix=, ?type=, ?period=<secs>[-<secs>]
+                    to filter; ?limit= for the page size; the
+                    Link header points to the next page),
+                    POST to add series
     {seriesid}/     GET for series metadata,
-	                PUT to alter series metadata,
-		data/		GET for series data,
-					POST to add/modify data records
+	                PUT to alter series metadata (retention,
+	                    in seconds, only),
+		data/		GET for series data; ?layout=grid for a
+					compact grid of values (as JSON or
+					binary only), ?type=csv or
+					?type=bin for CSV or packed binary output,
+					?since_ingest=<token> for only the points
+					written since a watermark,
+					?points=<n> to decimate the data to at
+					most n points for plotting, with
+					?decimate=lttb (the default) or minmax,
+					?agg=p50,p95,... for estimated percentiles
+					of each day, or each ?interval=<secs> (a
+					whole number of days, counted from the
+					start date, if given),
+					POST to add/modify data records, as JSON or
+					as packed (int64 usec, float64) records
+					in application/octet-stream (202 if
+					spooled for writing later); the
+					X-Fuse-Written and X-Fuse-Unchanged
+					headers count the points which changed
+					and those already stored
+/api/series/{seriesid}/rollup
+                    GET summaries (count, min, max, mean per
+                    bucket) of data past the series' retention
+/api/series/{seriesid}/summary
+                    GET the count, min, max, first and last times
+                    and latest value of the series' data
+/api/series/summary GET summaries of several series (?series=1,2,...)
+                    or of a page of the series list (filtered and
+                    paged as for /api/series/)
+/api/series/{seriesid}/live
+                    GET new data as it is written, as a stream of
+                    Server-Sent Events
+/api/live           GET new data of several series (?series=1,2,...)
+                    or of all series, as it is written
+/api/changes        GET points of all series written since a
+                    watermark (?since=<token>)
+/api/export         GET all data, as CSV (series, time, value)
+/api/series/{seriesid}/export
+                    GET all data for one series, as CSV
+/api/_metrics       GET server metrics, in Prometheus text format
+/api/_queries       GET database statement statistics
 """
 
 # Helper functions
@@ -34,6 +99,19 @@ def fail_as(res, result, message, data):
 	res.data = (message.encode("utf8"),)
 
 
+def get_body(req):
+	"""Read the request body
+	"""
+	try:
+		clen = int(req["CONTENT_LENGTH"])
+	except ValueError:
+		clen = 0 # FIXME: We could just return HTTP 411 here "Length required"
+	except KeyError:
+		clen = 0 # FIXME: We could just return HTTP 411 here "Length required"
+
+	return req["wsgi.input"].read(clen)
+
+
 def get_json(req, res):
 	# Check what data type we've been passed: it should be
 	# application/json
@@ -42,14 +120,7 @@ def get_json(req, res):
 	if ct != "application/json":
 		log.warn("Incorrect content type (%s) %s given", type(ct), ct)
 
-	try:
-		clen = int(req["CONTENT_LENGTH"])
-	except ValueError:
-		clen = 0 # FIXME: We could just return HTTP 411 here "Length required"
-	except KeyError:
-		clen = 0 # FIXME: We could just return HTTP 411 here "Length required"
-
-	inp = req["wsgi.input"].read(clen)
+	inp = get_body(req)
 	# FIXME: Use the Content-Encoding(?) header to work out what
 	# we should be decoding this as?
 	# FIXME: Add these checks as decorators from the muddleware
@@ -72,30 +143,223 @@ def get_json(req, res):
 	return struct, request_text
 
 
-def parse_timestamp(ts):
-	# FIXME: Allow TZ-free input (under protest) as well.
-	for fmt in (DATE_FORMAT,
-				"%Y-%m-%dT%H:%M:%S%z",
-				#"%Y-%m-%dT%H:%M:%S",
-				#"%Y-%m-%dT%H:%M:%S.%f"
-				):
+def get_range(req, res):
+	"""Parse the startDate and endDate query-string parameters into
+	keyword arguments for the database's range queries. Returns None
+	(having set up the error response) if either is unparsable.
+	"""
+	kwargs = {}
+	# Get query-string arguments
+	try:
+		qstring = urllib.parse.parse_qs(req["QUERY_STRING"])
+	except KeyError:
+		qstring = {}
+	# Sanitise parameters
+	for k, v in qstring.items():
+		lk = k.lower()
+		if lk == "startdate":
+			try:
+				kwargs["from_ts"] = parse_timestamp(v[0])
+			except ValueError:
+				fail_as(res, "400 Unparsable parameter",
+						"Start date was not parsable", v[0])
+				return None
+		if lk == "enddate":
+			try:
+				kwargs["to_ts"] = parse_timestamp(v[0])
+			except ValueError:
+				fail_as(res, "400 Unparsable parameter",
+						"End date was not parsable", v[0])
+				return None
+		# FIXME: Further processing of other parameters here.
+		# No parameter should be passed unvalidated or without a
+		# definite key.
+	return kwargs
+
+
+def parse_points(desc):
+	"""Parse a JSON array of (time, value) pairs into lists of
+	timestamps (in microseconds since the Unix epoch) and values.
+	Returns the timestamps, the values, the pairs they came from, and
+	the pairs which could not be parsed. A null value is stored as
+	NULL, and is returned here as NaN.
+	"""
+	stamps = []
+	values = []
+	lines = []
+	errors = []
+	with trace.span("parse"):
+		for line in desc:
+			try:
+				ts, value = line
+				stamp = arrays.to_stamp(parse_timestamp(ts))
+				value = NAN if value is None else float(value)
+				if not arrays.MIN_STAMP <= stamp <= arrays.MAX_STAMP:
+					raise ValueError(stamp)
+			except (ValueError, TypeError):
+				errors.append(line)
+				continue
+			stamps.append(stamp)
+			values.append(value)
+			lines.append(line)
+	return stamps, values, lines, errors
+
+
+def parse_series_query(req, res, page_size, page_max):
+	"""Parse the query-string parameters of a series list request into
+	keyword arguments for the database's list_series. Returns None
+	(having set up the error response) if any is unparsable.
+	"""
+	kwargs = { "limit": page_size }
+	qstring = urllib.parse.parse_qs(req.get("QUERY_STRING", ""))
+	for k, v in qstring.items():
+		lk = k.lower()
 		try:
-			return datetime.datetime.strptime(ts, fmt)
+			if lk == "name":
+				kwargs["name"] = v[0]
+			elif lk == "prefix":
+				kwargs["prefix"] = v[0]
+			elif lk == "type":
+				kwargs["ts_type"] = v[0]
+			elif lk == "period":
+				period = [datetime.timedelta(seconds=int(p))
+						  for p in v[0].split("-", 1)]
+				kwargs["period"] = period if len(period) == 2 else period[0]
+			elif lk == "after":
+				kwargs["after"] = int(v[0])
+			elif lk == "limit":
+				kwargs["limit"] = min(int(v[0]), page_max)
+				if kwargs["limit"] < 1:
+					raise ValueError(v[0])
 		except ValueError:
-			pass
+			fail_as(res, "400 Unparsable parameter",
+					"{0} was not parsable".format(k), v[0])
+			return None
+	return kwargs
+
+
+def next_page(req, last):
+	"""Return the URL of the next page of a paginated list, given the
+	last ID on this page
+	"""
+	qstring = [(k, v) for k, v in urllib.parse.parse_qsl(req.get("QUERY_STRING", ""))
+			   if k.lower() != "after"]
+	qstring.append(("after", str(last)))
+	return "{0}{1}?{2}".format(req.get("SCRIPT_NAME", ""), req.get("PATH_INFO", ""),
+							   urllib.parse.urlencode(qstring))
+
+
+def parse_watermark(res, token):
+	"""Parse a watermark token from the query string. Returns None
+	(having set up the error response) if it is malformed.
+	"""
+	try:
+		return watermark.Watermark.parse(token)
+	except ValueError:
+		fail_as(res, "400 Unparsable parameter",
+				"Watermark was not parsable", token)
+		return None
+
+
+def set_watermark(res, mark, changes, limit):
+	"""Add the headers describing a page of changes: the watermark to
+	fetch the next page from, and whether there may be more
+	"""
+	count = sum(len(v) for v in changes.values())
+	res.headers["X-Fuse-Watermark"] = str(mark)
+	res.headers["X-Fuse-Complete"] = "false" if count >= limit else "true"
+
+
+def accepts_gzip(req):
+	"""Check whether the client will accept a gzip-encoded response
+	"""
+	for enc in req.get("HTTP_ACCEPT_ENCODING", "").split(","):
+		parts = [p.strip() for p in enc.split(";")]
+		if parts[0].lower() not in ("gzip", "x-gzip"):
+			continue
+		for p in parts[1:]:
+			name, _, value = p.partition("=")
+			if name.strip().lower() == "q":
+				try:
+					return float(value) > 0
+				except ValueError:
+					return False
+		return True
+	return False
+
+
+def parse_retention(value):
+	"""Parse a retention period, given in seconds, or None for no
+	limit. Raises ValueError if it is not a positive number.
+	"""
+	if value is None:
+		return None
+	try:
+		seconds = float(value)
+	except TypeError:
+		raise ValueError("retention '{0}' is not a number".format(value))
+	if not seconds > 0:
+		raise ValueError("retention must be positive")
+	try:
+		return datetime.timedelta(seconds=seconds)
+	except OverflowError:
+		raise ValueError("retention '{0}' is too long".format(value))
+
+
+def parse_timestamp(ts):
+	# FIXME: Allow TZ-free input (under protest) as well.
+	with trace.span("parse_timestamp"):
+		for fmt in (DATE_FORMAT,
+					"%Y-%m-%dT%H:%M:%S%z",
+					#"%Y-%m-%dT%H:%M:%S",
+					#"%Y-%m-%dT%H:%M:%S.%f"
+					):
+			try:
+				return datetime.datetime.strptime(ts, fmt)
+			except ValueError:
+				pass
 	raise ValueError("time data '{0}' cannot be parsed".format(ts))
 
 class APIWrapper(object):
-	def __init__(self, config, db, mapper):
-		mapper.wrap = muddleware.compose(
-			[conneg.Conneg,
-			 muddleware.CORS(),
-			 muddleware.AccessFunctionWrapper])
+	def __init__(self, config, db, mapper, registry=metrics.REGISTRY):
+		self.registry = registry
+		self.trace_sample_rate = getattr(config, "trace_sample_rate", 0.0)
+		self.trace_file = getattr(config, "trace_file", None)
+		self.server_timing = getattr(config, "server_timing", True)
+		self.csv_chunk_size = getattr(config, "csv_chunk_size",
+									  conneg.CSV_CHUNK_SIZE)
+		self.sync_settle = datetime.timedelta(
+			seconds=getattr(config, "sync_settle_seconds", 5))
+		self.sync_limit = getattr(config, "sync_limit", 100000)
+		self.series_page_size = getattr(config, "series_page_size", 1000)
+		self.series_page_max = getattr(config, "series_page_max", 10000)
+		self.decimate_chunk_points = getattr(config, "decimate_chunk_points",
+											 1 << 18)
+		self.live_heartbeat = getattr(config, "live_heartbeat", 15)
+		self.hub = live.Hub(db, getattr(config, "live_queue", 100), registry)
+		self.ingested = registry.counter(
+			"fuse_ingest_points_total",
+			"Data points uploaded, by whether they were written, were "
+			"already stored unchanged, or were rejected", ("result",))
+		self.spool = None
+		spool_dir = getattr(config, "spool_dir", None)
+		if spool_dir is not None:
+			self.spool = spool.Spool(
+				db, spool_dir,
+				flush_points=getattr(config, "spool_flush_points", 50000),
+				flush_seconds=getattr(config, "spool_flush_seconds", 1.0),
+				max_bytes=getattr(config, "spool_max_bytes", 1 << 28),
+				registry=registry)
+			self.spool.start()
+		mapper.wrap = self.wrap
 
 		mapper.prefix = "/api"
+		mapper.add("/_metrics[/]", GET=self.get_metrics)
+		mapper.add("/_queries[/]", GET=self.get_query_stats)
 		mapper.add("/series[/]",
 				   GET=self.get_series_list,
 				   POST=self.add_series)
+		mapper.add("/series/summary[/]", GET=self.get_summaries)
 		mapper.add("/series/{series_id:digits}[/]",
 				   GET=self.get_series_info,
 				   PUT=self.alter_series,
@@ -108,14 +372,66 @@ class APIWrapper(object):
 		mapper.add("/series/{series_id:digits}/data.{extension}[/]",
 				   GET=self.get_data,
 				   POST=self.add_data)
+		mapper.add("/series/{series_id:digits}/rollup[/]",
+				   GET=self.get_rollup)
+		mapper.add("/series/{series_id:digits}/summary[/]",
+				   GET=self.get_summary)
+		mapper.add("/series/{series_id:digits}/export[/]",
+				   GET=self.export_data)
+		mapper.add("/export[/]", GET=self.export_data)
+		mapper.add("/changes[/]", GET=self.get_changes)
+		mapper.add("/series/{series_id:digits}/live[/]", GET=self.get_live)
+		mapper.add("/live[/]", GET=self.get_live)
 		self.db = db
 
+	def wrap(self, fn):
+		"""Wrap a request handler function in the standard middleware
+		chain. The handler's name is used to label its metrics and
+		traces.
+		"""
+		return muddleware.compose(
+			[muddleware.Metrics(self.registry, fn.__name__),
+			 muddleware.Tracing(fn.__name__,
+								sample_rate=self.trace_sample_rate,
+								trace_file=self.trace_file,
+								header=self.server_timing),
+			 conneg.Conneg,
+			 muddleware.CORS(),
+			 muddleware.AccessFunctionWrapper])(fn)
+
+	def get_metrics(self, req, res):
+		"""Return the server's metrics in Prometheus text format
+		"""
+		req["transformers"] = METRICS_TRANSFORMERS
+		res.data = BJI(self.registry.render())
+
+	def get_query_stats(self, req, res):
+		"""Return the database's per-statement statistics, if it
+		keeps any
+		"""
+		req["transformers"] = STD_TRANSFORMERS
+		stats = []
+		if hasattr(self.db, "query_stats"):
+			stats = self.db.query_stats()
+		res.data = BJI(stats)
+
 	def get_series_list(self, req, res):
-		"""Retrieve and return a list of all series
+		"""Retrieve and return a page of the list of series, optionally
+		filtered by name, prefix, type and period (in seconds, or a
+		range, lo-hi). If there may be more, the Link header gives the
+		URL of the next page.
 		"""
-		# FIXME: Check the query string for search parameters
 		req["transformers"] = STD_TRANSFORMERS
-		res.data = BJI(self.db.list_series())
+		kwargs = parse_series_query(req, res, self.series_page_size,
+									self.series_page_max)
+		if kwargs is None: return
+
+		with trace.span("query"):
+			series = self.db.list_series(**kwargs)
+		if len(series) >= kwargs["limit"]:
+			res.headers["Link"] = '<{0}>; rel="next"'.format(
+				next_page(req, max(series)))
+		res.data = BJI(series)
 
 	def add_series(self, req, res):
 		"""Add a new series (data in JSON), returning the ID of the
@@ -159,7 +475,8 @@ class APIWrapper(object):
 								("unit", "unit", None),
 								("description", "description", None),
 								("limit", "get_limit", int),
-								("epoch", "epoch", parse_timestamp)):
+								("epoch", "epoch", parse_timestamp),
+								("retention", "retention", parse_retention)):
 			if typ is None:
 				typ = lambda x: x
 			try:
@@ -190,48 +507,361 @@ class APIWrapper(object):
 		res.data = BJI(self.db.list_series(sid=sid))
 
 	def alter_series(self, req, res):
-		pass
+		"""Alter a series' metadata (data in JSON). Only the retention
+		period (in seconds, or null to keep the data for ever) can be
+		changed.
+		"""
+		req["transformers"] = STD_TRANSFORMERS
+		sid = int(req["wsgiorg.routing_args"][1]["series_id"])
+		if not self.db.is_series(sid):
+			fail_as(res, "404 Not found", "Series not found", str(sid))
+			return
 
-	def get_data(self, req, res):
-		"""Retrieve data from a series, filtered by date range, and
-		(optionally) processed with temporal quanta and
-		min/max/mean/stdev filters.
+		desc, request_text = get_json(req, res)
+		if desc is None: return
+
+		if not isinstance(desc, dict):
+			fail_as(res, "400 Bad request",
+					"The request data was not a JSON dictionary",
+					request_text)
+			return
+		others = sorted(k for k in desc if k != "retention")
+		if others:
+			fail_as(res, "400 Bad request",
+					"These parameters cannot be altered", ", ".join(others))
+			return
+
+		if "retention" in desc:
+			try:
+				retention = parse_retention(desc["retention"])
+			except ValueError:
+				fail_as(res, "400 Bad syntax", "retention is not parsable",
+						str(desc["retention"]))
+				return
+			self.db.set_retention(sid, retention)
+
+		res.data = BJI(self.db.list_series(sid=sid))
+
+	def get_rollup(self, req, res):
+		"""Retrieve the summaries of a series' expired data, as a list
+		of (bucket start, count, min, max, mean), filtered by date
+		range
 		"""
 		req["transformers"] = STD_TRANSFORMERS
-		req["transformers"]["csv"] = conneg.CSVDataTransformer
 		sid = int(req["wsgiorg.routing_args"][1]["series_id"])
 		if not self.db.is_series(sid):
 			fail_as(res, "404 Not found", "Series not found", str(sid))
 			return
 
-		kwargs = {}
-		# Get query-string arguments
-		try:
-			qstring = urllib.parse.parse_qs(req["QUERY_STRING"])
-		except KeyError:
-			qstring = {}
-		# Sanitise parameters
+		kwargs = get_range(req, res)
+		if kwargs is None: return
+
+		with trace.span("query"):
+			rollup = self.db.get_rollup(sid, **kwargs)
+		res.data = BJI(rollup)
+
+	def get_summary(self, req, res):
+		"""Retrieve the summary of a series' data: the number of
+		points, the min and max values, the first and last times, and
+		the latest value
+		"""
+		req["transformers"] = STD_TRANSFORMERS
+		sid = int(req["wsgiorg.routing_args"][1]["series_id"])
+		with trace.span("query"):
+			summary = self.db.get_summaries([sid]).get(sid)
+		if summary is None:
+			fail_as(res, "404 Not found", "Series not found", str(sid))
+			return
+		res.data = BJI(summary)
+
+	def get_summaries(self, req, res):
+		"""Retrieve the summaries of the series listed in the series
+		parameter, or of a page of the series list (filtered as for the
+		list itself), as a dict keyed by series ID. When paging, the
+		Link header gives the URL of the next page, if there may be
+		more.
+		"""
+		req["transformers"] = STD_TRANSFORMERS
+		sids = None
+		qstring = urllib.parse.parse_qs(req.get("QUERY_STRING", ""))
+		for k, v in qstring.items():
+			if k.lower() == "series":
+				try:
+					sids = [int(s) for s in v[0].split(",") if s.strip()]
+				except ValueError:
+					fail_as(res, "400 Unparsable parameter",
+							"Series list was not parsable", v[0])
+					return
+				if len(sids) > self.series_page_max:
+					fail_as(res, "400 Too many series",
+							"At most {0} series may be summarised at once".format(
+								self.series_page_max), str(len(sids)))
+					return
+
+		if sids is None:
+			kwargs = parse_series_query(req, res, self.series_page_size,
+										self.series_page_max)
+			if kwargs is None: return
+			with trace.span("list"):
+				sids = sorted(self.db.list_series(**kwargs))
+			if len(sids) >= kwargs["limit"]:
+				res.headers["Link"] = '<{0}>; rel="next"'.format(
+					next_page(req, sids[-1]))
+
+		with trace.span("query"):
+			summaries = self.db.get_summaries(sids)
+		res.data = BJI(summaries)
+
+	def get_data(self, req, res):
+		"""Retrieve data from a series, filtered by date range, and
+		(optionally) processed with temporal quanta and
+		min/max/mean/stdev filters.
+		"""
+		req["transformers"] = dict(
+			STD_TRANSFORMERS,
+			csv=lambda: conneg.CSVDataTransformer(chunk_size=self.csv_chunk_size),
+			bin=conneg.BinaryTransformer)
+		sid = int(req["wsgiorg.routing_args"][1]["series_id"])
+		with trace.span("is_series"):
+			if not self.db.is_series(sid):
+				fail_as(res, "404 Not found", "Series not found", str(sid))
+				return
+
+		kwargs = get_range(req, res)
+		if kwargs is None: return
+
+		qstring = urllib.parse.parse_qs(req.get("QUERY_STRING", ""))
+		# The output format, as the content negotiation will pick it
+		fmt = req["wsgiorg.routing_args"][1].get("extension")
+		layout = "points"
+		since = None
+		points = None
+		method = None
+		qs = None
+		interval = sketch.BUCKET_US
 		for k, v in qstring.items():
 			lk = k.lower()
-			if lk == "startdate":
+			if lk == "layout":
+				layout = v[0].lower()
+			if lk == "type":
+				fmt = v[-1]
+			if lk == "since_ingest":
+				since = parse_watermark(res, v[0])
+				if since is None: return
+			if lk == "points":
+				try:
+					points = int(v[0])
+				except ValueError:
+					fail_as(res, "400 Unparsable parameter",
+							"Points was not parsable", v[0])
+					return
+			if lk == "decimate":
+				method = v[0].lower()
+			if lk == "agg":
 				try:
-					kwargs["from_ts"] = parse_timestamp(v[0])
+					qs = sketch.parse_percentiles(v[0])
 				except ValueError:
 					fail_as(res, "400 Unparsable parameter",
-							"Start date was not parsable", v[0])
+							"Aggregates must be percentiles, as p50,p95,...", v[0])
 					return
-			if lk == "enddate":
+			if lk == "interval":
 				try:
-					kwargs["to_ts"] = parse_timestamp(v[0])
+					interval = int(v[0]) * 1000000
 				except ValueError:
+					interval = None
+				if interval is None or interval <= 0 or interval % sketch.BUCKET_US:
 					fail_as(res, "400 Unparsable parameter",
-							"End date was not parsable", v[0])
+							"Interval must be a whole number of days, in seconds",
+							v[0])
 					return
-			# FIXME: Further processing of other parameters here.
-			# No parameter should be passed unvalidated or without a
-			# definite key.
+		if layout not in ("points", "grid"):
+			fail_as(res, "400 Unparsable parameter",
+					"Layout must be points or grid", layout)
+			return
+		if layout == "grid" and fmt is not None and fmt.lower() == "csv":
+			fail_as(res, "400 Unsupported parameters",
+					"The grid layout can't be rendered as CSV",
+					req.get("QUERY_STRING", ""))
+			return
+		if method is not None and points is None:
+			fail_as(res, "400 Missing parameter",
+					"Decimation needs the number of points", method)
+			return
+		if points is not None:
+			method = method or "lttb"
+			try:
+				decimate.check(method, points)
+			except ValueError as ex:
+				fail_as(res, "400 Unparsable parameter",
+						"Decimation must be lttb or minmax, to at least "
+						"{0} points".format(decimate.MIN_POINTS), str(ex))
+				return
 
-		res.data = BJI(list(self.db.get_values(sid, **kwargs)))
+		if qs is not None:
+			if since is not None or points is not None or layout != "points":
+				fail_as(res, "400 Unsupported parameters",
+						"Percentiles can't be decimated, laid out as a grid "
+						"or limited to recent writes", req.get("QUERY_STRING", ""))
+				return
+			# The values are rows of percentiles, which the packed
+			# binary format can't hold
+			del req["transformers"]["bin"]
+			with trace.span("query"):
+				sketches = self.db.get_sketches(sid, **kwargs)
+			origin = 0
+			if "from_ts" in kwargs:
+				origin = sketch.bucket_of(arrays.to_stamp(kwargs["from_ts"]))
+			with trace.span("merge"):
+				data = sketch.percentiles(sketches, qs, interval, origin, sid)
+		elif since is None and points is not None:
+			data = self.get_decimated(sid, points, method, **kwargs)
+		else:
+			with trace.span("query"):
+				if since is None:
+					data = self.db.get_values_array(sid, **kwargs)
+				else:
+					# Only the points written since the watermark
+					changes, mark = self.db.get_changes(
+						sid, since, self.sync_limit, self.sync_settle)
+					data = changes.get(sid, arrays.ValueArray([], [], sid))
+					set_watermark(res, mark, changes, self.sync_limit)
+			if points is not None:
+				with trace.span("decimate"):
+					data = decimate.decimate(data, points, method)
+
+		if layout == "grid":
+			info = self.db.list_series(sid=sid)[sid]
+			try:
+				data = arrays.to_grid(data, (info["epoch"] - EPOCH) // USEC,
+									  info["period"] // USEC, GRID_MAX_SPARSITY)
+			except ValueError as ex:
+				fail_as(res, "400 Too sparse",
+						"The data is too sparse for the grid layout", str(ex))
+				return
+		res.data = BJI(data)
+
+	def get_decimated(self, sid, points, method, from_ts=None, to_ts=None):
+		"""Read a series' data in the given range, decimated to at most
+		points points. A range of more than decimate_chunk_points
+		points (estimated from the series' summary) is read and
+		decimated in slices of about that many, so that the whole
+		range is never held in memory.
+		"""
+		with trace.span("summary"):
+			summary = self.db.get_summaries([sid]).get(sid)
+		if summary is None or not summary["count"]:
+			return arrays.ValueArray(*arrays.empty(), sid=sid)
+		first = arrays.to_stamp(summary["first"])
+		last = arrays.to_stamp(summary["last"])
+		start = first if from_ts is None else max(first, arrays.to_stamp(from_ts))
+		end = last if to_ts is None else min(last, arrays.to_stamp(to_ts) - 1)
+		if end < start:
+			return arrays.ValueArray(*arrays.empty(), sid=sid)
+		span = end - start + 1
+		estimate = summary["count"] * span // (last - first + 1)
+		if estimate <= self.decimate_chunk_points:
+			with trace.span("query"):
+				data = self.db.get_values_array(sid, from_ts=from_ts, to_ts=to_ts)
+			with trace.span("decimate"):
+				return decimate.decimate(data, points, method)
+
+		slices = -(-estimate // self.decimate_chunk_points)
+		dec = decimate.Decimator(method, points, start, end)
+		for i in range(slices):
+			# The first and last slices stay open-ended, to catch
+			# points written since the summary was read
+			lo = start + span * i // slices
+			hi = start + span * (i + 1) // slices
+			with trace.span("query"):
+				data = self.db.get_values_array(
+					sid,
+					from_ts=from_ts if i == 0 else arrays.to_datetime(lo),
+					to_ts=to_ts if i == slices - 1 else arrays.to_datetime(hi))
+			with trace.span("decimate"):
+				dec.feed(data.stamps, data.values)
+		return dec.result(sid)
+
+	def get_changes(self, req, res):
+		"""Retrieve the points of all series written since a
+		watermark, as a dict mapping series IDs to lists of points
+		"""
+		req["transformers"] = STD_TRANSFORMERS
+		since = watermark.Watermark(0)
+		qstring = urllib.parse.parse_qs(req.get("QUERY_STRING", ""))
+		for k, v in qstring.items():
+			if k.lower() == "since":
+				since = parse_watermark(res, v[0])
+				if since is None: return
+
+		with trace.span("query"):
+			changes, mark = self.db.get_changes(
+				None, since, self.sync_limit, self.sync_settle)
+		set_watermark(res, mark, changes, self.sync_limit)
+		res.data = BJI(changes)
+
+	def get_live(self, req, res):
+		"""Stream new data points of a series (or of the series listed
+		in the series parameter, or of all series) as Server-Sent
+		Events, as they are written
+		"""
+		req["transformers"] = LIVE_TRANSFORMERS
+		if not req.get("fuse.threaded", False):
+			# The stream would hold up every other request
+			fail_as(res, "503 Service unavailable",
+					"Live streams need a threaded server", "threaded_server")
+			return
+		sid = req.get("wsgiorg.routing_args", [None, {}])[1].get("series_id")
+		sids = None
+		if sid is not None:
+			sids = [int(sid)]
+		qstring = urllib.parse.parse_qs(req.get("QUERY_STRING", ""))
+		for k, v in qstring.items():
+			if k.lower() == "series" and sids is None:
+				try:
+					sids = [int(s) for s in v[0].split(",") if s.strip()]
+				except ValueError:
+					fail_as(res, "400 Unparsable parameter",
+							"Series list was not parsable", v[0])
+					return
+		for s in sids or []:
+			if not self.db.is_series(s):
+				fail_as(res, "404 Not found", "Series not found", str(s))
+				return
+		# The stream may stay open indefinitely, and doesn't need the
+		# database, so let the connection go now
+		self.db.release()
+
+		res.headers["Cache-Control"] = "no-cache"
+		res.headers["X-Accel-Buffering"] = "no"
+		res.data = live.EventStream(self.hub, self.hub.subscribe(sids),
+									self.live_heartbeat)
+
+	def export_data(self, req, res):
+		"""Export the data of a series (or of all series) as CSV,
+		optionally filtered by date range. The data is streamed from
+		the database in large chunks, and is gzipped if the client
+		accepts it.
+		"""
+		req["transformers"] = EXPORT_TRANSFORMERS
+		sid = req.get("wsgiorg.routing_args", [None, {}])[1].get("series_id")
+		if sid is not None:
+			sid = int(sid)
+			if not self.db.is_series(sid):
+				fail_as(res, "404 Not found", "Series not found", str(sid))
+				return
+
+		kwargs = get_range(req, res)
+		if kwargs is None: return
+
+		fname = "series-{0}.csv".format(sid) if sid is not None else "export.csv"
+		res.headers["Content-Disposition"] = (
+			'attachment; filename="{0}"'.format(fname))
+		res.headers["Vary"] = "Accept-Encoding"
+		data = self.db.export(sid, **kwargs)
+		if accepts_gzip(req):
+			res.headers["Content-Encoding"] = "gzip"
+			data = muddleware.GzipIterator(data)
+		res.data = data
 
 	def add_data(self, req, res):
 		"""Add data to a series. Data format is an array of (time,
@@ -244,6 +874,11 @@ class APIWrapper(object):
 			fail_as(res, "404 Not found", "Series not found", str(sid))
 			return
 
+		ct = req.get("CONTENT_TYPE", "").split(";")[0].strip()
+		if ct == "application/octet-stream":
+			self.add_data_packed(req, res, sid)
+			return
+
 		desc, request_text = get_json(req, res)
 		if desc is None: return
 
@@ -253,17 +888,71 @@ class APIWrapper(object):
 					request_text)
 			return
 
-		errors = []
-		for line in desc:
-			try:
-				ts, value = line
-				ts = parse_timestamp(ts)
-				rv = self.db.add_value(sid, ts, value)
-			except ValueError:
-				rv = False
+		stamps, values, lines, errors = parse_points(desc)
+		if self.spool is not None:
+			self.write_behind(res, sid, stamps, values, errors)
+			return
 
-			if not rv:
-				res.result = "206 Partial update"
-				errors.append([ts.strftime(DATE_FORMAT), value])
+		bad, written = self.db.add_values_array(sid, stamps, values)
+		errors += [lines[i] for i in bad]
+		self.count_written(res, len(stamps) - len(bad), written, len(errors))
+		if errors:
+			res.result = "206 Partial update"
+		res.data = BJI(errors)
 
+	def add_data_packed(self, req, res, sid):
+		"""Add data to a series from a body of packed binary records:
+		little-endian (int64 microseconds since the Unix epoch,
+		float64 value) pairs, 16 bytes each. Any records which could
+		not be stored are returned as they were sent, as (int, float)
+		pairs.
+		"""
+		inp = get_body(req)
+		try:
+			stamps, values = arrays.decode_records(inp)
+		except ValueError:
+			fail_as(res, "400 Bad request",
+					"The request data was not a whole number of 16-byte records",
+					str(len(inp)))
+			return
+
+		if self.spool is not None:
+			bad, good_stamps, good_values = arrays.split_valid(stamps, values)
+			errors = [[int(stamps[i]), float(values[i])] for i in bad]
+			self.write_behind(res, sid, good_stamps, good_values, errors)
+			return
+
+		bad, written = self.db.add_values_array(sid, stamps, values)
+		errors = [[int(stamps[i]), float(values[i])] for i in bad]
+		self.count_written(res, len(stamps) - len(bad), written, len(errors))
+		if errors:
+			res.result = "206 Partial update"
+		res.data = BJI(errors)
+
+	def count_written(self, res, stored, written, rejected):
+		"""Report how many of the points stored actually changed the
+		database, and how many were already there with the same value
+		"""
+		res.headers["X-Fuse-Written"] = str(written)
+		res.headers["X-Fuse-Unchanged"] = str(stored - written)
+		self.ingested.inc(("written",), written)
+		self.ingested.inc(("unchanged",), stored - written)
+		self.ingested.inc(("rejected",), rejected)
+
+	def write_behind(self, res, sid, stamps, values, errors):
+		"""Spool validated data points, and acknowledge them with 202
+		(or 206, listing the errors, if some were rejected). If the
+		spool is full, nothing is stored, and the client is asked to
+		retry later.
+		"""
+		try:
+			with trace.span("spool"):
+				self.spool.append(sid, stamps, values)
+		except spool.SpoolFull:
+			fail_as(res, "503 Service unavailable",
+					"Too much data is waiting to be written; retry later",
+					str(sid))
+			res.headers["Retry-After"] = "1"
+			return
+		res.result = "206 Partial update" if errors else "202 Accepted"
 		res.data = BJI(errors)
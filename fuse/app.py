@@ -2,6 +2,7 @@
 
 import logging
 import logging.config
+import datetime
 
 log = logging.getLogger()
 logging.basicConfig(level=logging.INFO)
@@ -16,6 +17,7 @@ import fuse.config
 import fuse.muddleware as muddleware
 import fuse.api
 import fuse.db
+import fuse.retention
 
 def get_app(conf=fuse.config):
 	# Create the mapper object: the core decision-maker
@@ -23,8 +25,38 @@ def get_app(conf=fuse.config):
 
 	# Middleware called in this order, before the mapper
 	application = muddleware.ExceptionHandler(mapper)
+	profile_dir = getattr(conf, "profile_dir", None)
+	if profile_dir is not None:
+		application = muddleware.Profiler(
+			application, profile_dir,
+			token=getattr(conf, "profile_token", None),
+			sample_rate=getattr(conf, "profile_sample_rate", 0.0),
+			memory=getattr(conf, "profile_memory", False),
+			keep=getattr(conf, "profile_keep", 50))
 
 	# Set up the various components
-	fuse.api.APIWrapper(conf, fuse.db.get_database(conf), mapper)
+	db = fuse.db.get_database(conf)
+	fuse.api.APIWrapper(conf, db, mapper)
+
+	# Roll up and delete data past its series' retention period
+	interval = getattr(conf, "retention_interval", 600)
+	if interval is not None:
+		fuse.retention.RetentionWorker(
+			db,
+			bucket=datetime.timedelta(
+				seconds=getattr(conf, "retention_bucket_seconds", 3600)),
+			batch_size=getattr(conf, "retention_batch_size", 5000),
+			pause=getattr(conf, "retention_pause", 0.5),
+			interval=interval).start()
+
+	# Hand the request thread's database connection back for reuse
+	# once the response is done with
+	application = muddleware.Release(application, db.release)
+
+	# Whether each request has its own thread. wsgi.multithread can't
+	# be relied on to say: wsgiref always sets it.
+	application = muddleware.Environ(
+		application,
+		{ "fuse.threaded": getattr(conf, "threaded_server", False) })
 
 	return application
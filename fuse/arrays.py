@@ -0,0 +1,499 @@
+"""Helpers for handling time-series data as arrays rather than as
+lists of Python objects.
+
+Timestamps are held as 64-bit integers counting microseconds since
+the Unix epoch, and values as 64-bit floats. If NumPy is available,
+the arrays are NumPy arrays; otherwise they are array.array objects
+(typecodes "q" and "d"), which support the buffer protocol and
+indexing in the same way, but not NumPy's vector operations.
+"""
+
+import sys
+import struct
+import array
+import datetime
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# PostgreSQL's binary COPY format: a fixed signature, a flags word and
+# a header extension, then one record per row, then a trailer
+PGCOPY_SIGNATURE = b"PGCOPY\n\377\r\n\0"
+PGCOPY_TRAILER = b"\377\377"
+
+# PostgreSQL timestamps count from 2000-01-01, not from 1970-01-01
+PG_EPOCH_US = 946684800 * 1000000
+
+# A row of (timestamp, float8): field count, then length and data for
+# each field
+_ROW = struct.Struct(">hiqid")
+ROW_SIZE = _ROW.size
+_ROW_PREFIX = struct.pack(">hi", 2, 8)
+_VALUE_PREFIX = struct.pack(">i", 8)
+
+# The packed format accepted from clients: little-endian (int64
+# microseconds since the Unix epoch, float64 value) records
+RECORD_SIZE = 16
+
+# The range of timestamps which can be represented as datetimes
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_USEC = datetime.timedelta(microseconds=1)
+MIN_STAMP = (datetime.datetime(1, 1, 2, tzinfo=datetime.timezone.utc)
+			 - _EPOCH) // datetime.timedelta(microseconds=1)
+MAX_STAMP = (datetime.datetime(9999, 12, 31, tzinfo=datetime.timezone.utc)
+			 - _EPOCH) // datetime.timedelta(microseconds=1)
+
+if numpy is not None:
+	_RECORD_DTYPE = numpy.dtype([("stamp", "<i8"), ("value", "<f8")])
+	_ROW_DTYPE = numpy.dtype([("nfields", ">i2"),
+							  ("stamp_len", ">i4"),
+							  ("stamp", ">i8"),
+							  ("value_len", ">i4"),
+							  ("value", ">f8")])
+
+_DAY_US = 86400 * 1000000
+_NAN = float("nan")
+
+class ValueArray(object):
+	"""The data points of a series, held as parallel arrays of
+	timestamps (microseconds since the Unix epoch) and values rather
+	than as a list of (datetime, float) tuples. Iterating over it
+	yields (datetime, float) pairs as they are needed; the
+	transformers can render it without doing so.
+
+	With NumPy, values may also be a two-dimensional array with
+	several values for each timestamp (e.g. a set of aggregates), in
+	which case the values are tuples; without it, a list of tuples.
+	"""
+	__slots__ = ("stamps", "values", "sid")
+
+	def __init__(self, stamps, values, sid=None):
+		self.stamps = stamps
+		self.values = values
+		self.sid = sid
+
+	def __len__(self):
+		return len(self.stamps)
+
+	def __iter__(self):
+		for stamp, value in zip(self.stamps, self.value_list()):
+			yield to_datetime(stamp), _row_value(value)
+
+	def __getitem__(self, i):
+		return to_datetime(self.stamps[i]), _row_value(self.values[i])
+
+	def value_list(self, nulls=False):
+		"""Return the values as a list of Python floats. If nulls is
+		true, NaNs (i.e. NULLs in the database) are returned as None.
+		"""
+		return _to_list(self.values, nulls)
+
+	def value_columns(self, nulls=False):
+		"""Return the values as a list of columns, each a list of
+		Python floats, with NaNs as None if nulls is true
+		"""
+		if getattr(self.values, "ndim", 1) == 2:
+			return _to_list(self.values.T, nulls)
+		if len(self.values) and isinstance(self.values[0], tuple):
+			return [_to_list(column, nulls) for column in zip(*self.values)]
+		return [self.value_list(nulls)]
+
+	def as_json(self):
+		"""Return the data as a list of (ISO 8601 timestamp, value)
+		pairs, ready for the JSON encoder. NaNs are rendered as nulls.
+		"""
+		return list(zip(format_stamps(self.stamps), self.value_list(True)))
+
+class Grid(object):
+	"""The data points of a series laid out on its regular grid of
+	timestamps (epoch + n * period), rather than each with its own
+	timestamp. values holds a value for every grid slot from start
+	onwards, with NaN where there is no data. Points which don't fall
+	on the grid are kept separately, in off_stamps and off_values.
+	Times are in microseconds since the Unix epoch.
+	"""
+	__slots__ = ("start", "period", "values", "off_stamps", "off_values")
+
+	# The header of the binary form: magic, start, period, number of
+	# values, number of off-grid points
+	HEADER = struct.Struct("<4sqqII")
+	MAGIC = b"FGRD"
+
+	def __init__(self, start, period, values, off_stamps, off_values):
+		self.start = start
+		self.period = period
+		self.values = values
+		self.off_stamps = off_stamps
+		self.off_values = off_values
+
+	def as_json(self):
+		"""Return the grid as a dict ready for the JSON encoder. Gaps
+		are rendered as nulls, and the period in seconds.
+		"""
+		values = _to_list(self.values, True)
+		off = ValueArray(self.off_stamps, self.off_values)
+		return { "start": (format_stamps([self.start])[0]
+						   if self.start is not None else None),
+				 "period": self.period / 1000000,
+				 "values": values,
+				 "offgrid": off.as_json(),
+				 }
+
+	def to_bytes(self):
+		"""Return the binary form of the grid: the header, then the
+		values as little-endian float64 (NaN for gaps), then the
+		off-grid points as packed (int64, float64) records.
+		"""
+		header = self.HEADER.pack(self.MAGIC,
+								  self.start if self.start is not None else 0,
+								  self.period, len(self.values),
+								  len(self.off_stamps))
+		values = array.array("d", self.values)
+		if sys.byteorder != "little":
+			values.byteswap()
+		return (header + values.tobytes()
+				+ encode_records(self.off_stamps, self.off_values))
+
+def to_grid(data, epoch, period, max_sparsity=None, use_numpy=True):
+	"""Lay out a ValueArray on the grid of timestamps epoch + n *
+	period. If max_sparsity is given, and the grid would have more
+	than that many slots per data point (plus a small allowance),
+	raise ValueError rather than build it.
+	"""
+	if (numpy is not None and use_numpy
+		and isinstance(data.stamps, numpy.ndarray)):
+		stamps = data.stamps
+		values = numpy.asarray(data.values, dtype=numpy.float64)
+		on = (stamps - epoch) % period == 0
+		on_stamps = stamps[on]
+		off = ~on
+		off_stamps, off_values = stamps[off], values[off]
+		if len(on_stamps) == 0:
+			return Grid(None, period, numpy.empty(0), off_stamps, off_values)
+		start = int(on_stamps[0])
+		slots = (int(on_stamps[-1]) - start) // period + 1
+		_check_sparsity(slots, len(stamps), max_sparsity)
+		grid = numpy.full(slots, numpy.nan)
+		grid[(on_stamps - start) // period] = values[on]
+		return Grid(start, period, grid, off_stamps, off_values)
+
+	on = [(s, v) for s, v in zip(data.stamps, data.values)
+		  if (s - epoch) % period == 0]
+	off = [(s, v) for s, v in zip(data.stamps, data.values)
+		   if (s - epoch) % period != 0]
+	off_stamps = array.array("q", [s for s, v in off])
+	off_values = array.array("d", [v for s, v in off])
+	if not on:
+		return Grid(None, period, array.array("d"), off_stamps, off_values)
+	start = on[0][0]
+	slots = (on[-1][0] - start) // period + 1
+	_check_sparsity(slots, len(data.stamps), max_sparsity)
+	grid = array.array("d", [float("nan")]) * slots
+	for s, v in on:
+		grid[(s - start) // period] = v
+	return Grid(start, period, grid, off_stamps, off_values)
+
+def _check_sparsity(slots, points, max_sparsity):
+	if max_sparsity is not None and slots > max_sparsity * points + 1024:
+		raise ValueError(
+			"{0} points are too sparse for a grid of {1} slots".format(points, slots))
+
+def _to_list(values, nulls):
+	"""Return an array, or a sequence of floats or of tuples of them,
+	as a list, with NaNs replaced by None if nulls is true
+	"""
+	if numpy is not None and isinstance(values, numpy.ndarray):
+		if nulls and values.dtype.kind == "f":
+			missing = numpy.isnan(values)
+			if missing.any():
+				values = values.astype(object)
+				values[missing] = None
+		return values.tolist()
+	if not nulls:
+		return list(values)
+	return [tuple(None if x != x else x for x in v) if isinstance(v, tuple)
+			else (None if v != v else v)
+			for v in values]
+
+def _row_value(value):
+	if hasattr(value, "tolist"):
+		value = value.tolist()
+	if isinstance(value, (list, tuple)):
+		return tuple(value)
+	return float(value)
+
+class CopyFormatError(ValueError):
+	"""The data was not in the expected binary COPY format"""
+	pass
+
+def empty():
+	"""Return a pair of empty (timestamp, value) arrays
+	"""
+	if numpy is not None:
+		return (numpy.empty(0, dtype=numpy.int64),
+				numpy.empty(0, dtype=numpy.float64))
+	return array.array("q"), array.array("d")
+
+def decode_copy(buf, use_numpy=True):
+	"""Decode the output of COPY ... TO STDOUT (FORMAT binary) for a
+	query returning (timestamp with time zone, double precision)
+	columns, none of them null. Returns a pair of arrays of timestamps
+	(as microseconds since the Unix epoch) and values.
+	"""
+	mv = memoryview(buf)
+	if mv[:len(PGCOPY_SIGNATURE)] != PGCOPY_SIGNATURE:
+		raise CopyFormatError("Missing binary COPY signature")
+	offset = len(PGCOPY_SIGNATURE)
+	flags, ext_len = struct.unpack_from(">ii", mv, offset)
+	offset += 8 + ext_len
+	if mv[-2:] != PGCOPY_TRAILER:
+		raise CopyFormatError("Missing binary COPY trailer")
+	body = mv[offset:-2]
+	if len(body) % ROW_SIZE != 0:
+		raise CopyFormatError(
+			"Data length {0} is not a whole number of rows".format(len(body)))
+
+	if numpy is not None and use_numpy:
+		return _decode_numpy(body)
+	return _decode_array(body)
+
+def _decode_numpy(body):
+	rows = numpy.frombuffer(body, dtype=_ROW_DTYPE)
+	if (numpy.any(rows["nfields"] != 2)
+		or numpy.any(rows["stamp_len"] != 8)
+		or numpy.any(rows["value_len"] != 8)):
+		raise CopyFormatError("Unexpected row layout")
+	stamps = rows["stamp"].astype(numpy.int64)
+	stamps += PG_EPOCH_US
+	return stamps, rows["value"].astype(numpy.float64)
+
+def _gather(body, start, nrows):
+	"""Collect the 8-byte field at offset start in each row into a
+	contiguous buffer. This takes one slice per byte of the field,
+	rather than any work per row.
+	"""
+	out = bytearray(8 * nrows)
+	for k in range(8):
+		out[k::8] = body[start + k::ROW_SIZE]
+	return out
+
+def _decode_array(body):
+	body = bytes(body)
+	nrows = len(body) // ROW_SIZE
+	for start, prefix in ((0, _ROW_PREFIX), (14, _VALUE_PREFIX)):
+		for k, byte in enumerate(prefix):
+			field = body[start + k::ROW_SIZE]
+			if field.count(byte) != nrows:
+				raise CopyFormatError("Unexpected row layout")
+
+	stamps = array.array("q")
+	stamps.frombytes(_gather(body, 6, nrows))
+	values = array.array("d")
+	values.frombytes(_gather(body, 18, nrows))
+	if sys.byteorder == "little":
+		stamps.byteswap()
+		values.byteswap()
+	stamps = array.array("q", [s + PG_EPOCH_US for s in stamps])
+	return stamps, values
+
+def encode_copy(stamps, values, use_numpy=True):
+	"""Encode arrays of timestamps (as microseconds since the Unix
+	epoch) and values as input for COPY ... FROM STDIN (FORMAT
+	binary) into (timestamp with time zone, double precision)
+	columns. The inverse of decode_copy.
+	"""
+	header = PGCOPY_SIGNATURE + struct.pack(">ii", 0, 0)
+	nrows = len(stamps)
+	if numpy is not None and use_numpy:
+		rows = numpy.empty(nrows, dtype=_ROW_DTYPE)
+		rows["nfields"] = 2
+		rows["stamp_len"] = 8
+		rows["stamp"] = numpy.asarray(stamps, dtype=numpy.int64) - PG_EPOCH_US
+		rows["value_len"] = 8
+		rows["value"] = values
+		return header + rows.tobytes() + PGCOPY_TRAILER
+
+	pg_stamps = array.array("q", [s - PG_EPOCH_US for s in stamps])
+	pg_values = array.array("d", values)
+	if sys.byteorder == "little":
+		pg_stamps.byteswap()
+		pg_values.byteswap()
+	out = bytearray(ROW_SIZE * nrows)
+	for start, prefix in ((0, _ROW_PREFIX), (14, _VALUE_PREFIX)):
+		for k, byte in enumerate(prefix):
+			if byte:
+				out[start + k::ROW_SIZE] = bytes((byte,)) * nrows
+	for start, field in ((6, pg_stamps.tobytes()), (18, pg_values.tobytes())):
+		for k in range(8):
+			out[start + k::ROW_SIZE] = field[k::8]
+	return header + bytes(out) + PGCOPY_TRAILER
+
+def decode_records(buf, use_numpy=True):
+	"""View a buffer of packed little-endian (int64, float64) records
+	as a pair of (timestamp, value) arrays. With NumPy, or on a
+	little-endian machine, the arrays are views on the buffer rather
+	than copies. Raises ValueError if the buffer is not a whole number
+	of records.
+	"""
+	mv = memoryview(buf)
+	if mv.nbytes % RECORD_SIZE != 0:
+		raise ValueError(
+			"Data length {0} is not a whole number of records".format(mv.nbytes))
+	if numpy is not None and use_numpy:
+		records = numpy.frombuffer(mv, dtype=_RECORD_DTYPE)
+		return records["stamp"], records["value"]
+
+	mv = mv.cast("B")
+	if sys.byteorder == "little":
+		return mv.cast("q")[0::2], mv.cast("d")[1::2]
+	stamps = array.array("q", mv.cast("q")[0::2])
+	values = array.array("d", mv.cast("d")[1::2])
+	stamps.byteswap()
+	values.byteswap()
+	return stamps, values
+
+def encode_records(stamps, values, use_numpy=True):
+	"""Pack arrays of timestamps and values as little-endian (int64,
+	float64) records: the inverse of decode_records
+	"""
+	if numpy is not None and use_numpy:
+		records = numpy.empty(len(stamps), dtype=_RECORD_DTYPE)
+		records["stamp"] = stamps
+		records["value"] = values
+		return records.tobytes()
+
+	stamps = array.array("q", stamps).tobytes()
+	values = array.array("d", values).tobytes()
+	out = bytearray(len(stamps) * 2)
+	for k in range(8):
+		out[k::RECORD_SIZE] = stamps[k::8]
+		out[8 + k::RECORD_SIZE] = values[k::8]
+	if sys.byteorder != "little":
+		# Swap each 8-byte field in place
+		swapped = array.array("q", bytes(out))
+		swapped.byteswap()
+		out = swapped.tobytes()
+	return bytes(out)
+
+def split_valid(stamps, values):
+	"""Separate out the records whose timestamps are out of range.
+	Returns the indexes of the bad records, and arrays of the
+	timestamps and values of the good ones.
+	"""
+	if numpy is not None and isinstance(stamps, numpy.ndarray):
+		bad = (stamps < MIN_STAMP) | (stamps > MAX_STAMP)
+		if not bad.any():
+			return [], stamps, values
+		good = ~bad
+		return (numpy.flatnonzero(bad).tolist(),
+				stamps[good], numpy.asarray(values)[good])
+
+	bad = [i for i, s in enumerate(stamps) if not MIN_STAMP <= s <= MAX_STAMP]
+	if not bad:
+		return [], stamps, values
+	skip = set(bad)
+	return (bad,
+			array.array("q", [s for i, s in enumerate(stamps) if i not in skip]),
+			array.array("d", [v for i, v in enumerate(values) if i not in skip]))
+
+def _digits(out, col, x, width):
+	"""Write the decimal digits of the integer array x into columns
+	col to col+width of the byte matrix out
+	"""
+	for k in range(width - 1, -1, -1):
+		x, digit = numpy.divmod(x, 10)
+		out[:, col + k] = digit + 48
+
+def format_stamps(stamps, use_numpy=True, iso=True):
+	"""Format timestamps (microseconds since the Unix epoch) as
+	strings in UTC. If iso is true, they are in the ISO 8601 form used
+	by the API ("2012-08-28T12:00:00.000000+0000"); otherwise they are
+	as str() renders a datetime ("2012-08-28 12:00:00+00:00", with the
+	microseconds only if they are non-zero). Returns a list of
+	strings.
+	"""
+	if numpy is not None and use_numpy and len(stamps) > 0:
+		days, usec = numpy.divmod(numpy.asarray(stamps, dtype=numpy.int64),
+								  _DAY_US)
+		# Convert days to calendar dates: see
+		# http://howardhinnant.github.io/date_algorithms.html#civil_from_days
+		z = days + 719468
+		era = z // 146097
+		doe = z - era * 146097
+		yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+		doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+		mp = (5 * doy + 2) // 153
+		day = doy - (153 * mp + 2) // 5 + 1
+		month = numpy.where(mp < 10, mp + 3, mp - 9)
+		year = yoe + era * 400 + (month <= 2)
+
+		template = (b"0000-00-00T00:00:00.000000+0000" if iso
+					else b"0000-00-00 00:00:00.000000+00:00")
+		width = len(template)
+		out = numpy.empty((len(days), width), dtype=numpy.uint8)
+		out[:] = numpy.frombuffer(template, dtype=numpy.uint8)
+		_digits(out, 0, year, 4)
+		_digits(out, 5, month, 2)
+		_digits(out, 8, day, 2)
+		secs, usec = numpy.divmod(usec, 1000000)
+		mins, secs = numpy.divmod(secs, 60)
+		hours, mins = numpy.divmod(mins, 60)
+		_digits(out, 11, hours, 2)
+		_digits(out, 14, mins, 2)
+		_digits(out, 17, secs, 2)
+		_digits(out, 20, usec, 6)
+		if not iso:
+			# Drop the microseconds where they are zero: trailing NULs
+			# are not part of a numpy bytes string
+			whole = usec == 0
+			out[whole, 19:25] = numpy.frombuffer(b"+00:00", dtype=numpy.uint8)
+			out[whole, 25:] = 0
+		return (out.view("S{0}".format(width)).ravel()
+				.astype("U{0}".format(width)).tolist())
+
+	dates = {}
+	rv = []
+	for stamp in stamps:
+		days, usec = divmod(int(stamp), _DAY_US)
+		date = dates.get(days)
+		if date is None:
+			d = _EPOCH + datetime.timedelta(days=days)
+			date = "%04d-%02d-%02d%s" % (d.year, d.month, d.day,
+										 "T" if iso else " ")
+			dates[days] = date
+		secs, usec = divmod(usec, 1000000)
+		mins, secs = divmod(secs, 60)
+		hours, mins = divmod(mins, 60)
+		if iso:
+			rv.append("%s%02d:%02d:%02d.%06d+0000" % (date, hours, mins, secs, usec))
+		elif usec:
+			rv.append("%s%02d:%02d:%02d.%06d+00:00" % (date, hours, mins, secs, usec))
+		else:
+			rv.append("%s%02d:%02d:%02d+00:00" % (date, hours, mins, secs))
+	return rv
+
+def to_stamp(dt):
+	"""Convert a datetime to a timestamp in microseconds since the
+	Unix epoch
+	"""
+	return (dt - _EPOCH) // _USEC
+
+def from_points(points, sid=None):
+	"""Build a ValueArray from a sequence of (timestamp, value) pairs,
+	with timestamps in microseconds since the Unix epoch. None values
+	(NULLs) become NaN.
+	"""
+	stamps = array.array("q", [s for s, v in points])
+	values = array.array("d", [_NAN if v is None else v for s, v in points])
+	if numpy is not None:
+		stamps = numpy.array(stamps, dtype=numpy.int64)
+		values = numpy.array(values, dtype=numpy.float64)
+	return ValueArray(stamps, values, sid)
+
+def to_datetime(stamp):
+	"""Convert a timestamp in microseconds since the Unix epoch to a
+	datetime
+	"""
+	return _EPOCH + datetime.timedelta(microseconds=int(stamp))
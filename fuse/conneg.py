@@ -26,8 +26,12 @@ returned.
 import logging
 import json
 import csv
+import io
+import itertools
 
 import fuse.muddleware as muddleware
+import fuse.trace as trace
+import fuse.arrays as arrays
 
 log = logging.getLogger()
 
@@ -71,7 +75,8 @@ class Conneg(object):
 		# data is an iterator of strings (plus, we hope, some binary
 		# data) that we can process further
 		if hasattr(data, "binary"):
-			data = state.transformer.transform(data.binary, environ)
+			with trace.span("encode"):
+				data = state.transformer.transform(data.binary, environ)
 		# If not, we simply pass the data straight through
 
 		# Render the result
@@ -165,6 +170,16 @@ class Transformer(object):
 	def transform(self, binary, environ):
 		pass
 
+class TextTransformer(Transformer):
+	"""Transformer for data which is already a string: it is simply
+	encoded as UTF-8
+	"""
+	def __init__(self, mime_type="text/plain; charset=utf-8"):
+		Transformer.__init__(self, mime_type)
+
+	def transform(self, binary, environ):
+		return [binary.encode("utf8")]
+
 class JSONTransformer(Transformer):
 	def __init__(self):
 		Transformer.__init__(self)
@@ -172,31 +187,66 @@ class JSONTransformer(Transformer):
 	def transform(self, binary, environ):
 		return [json.dumps(binary, cls=muddleware.JSONDateEncoder).encode("utf8")]
 
+class BinaryTransformer(Transformer):
+	"""Transformer producing packed binary data. A ValueArray is
+	rendered as little-endian (int64 microseconds since the Unix
+	epoch, float64 value) records, the same format accepted for
+	uploads; a Grid in the format described by Grid.to_bytes.
+	"""
+	def __init__(self, mime_type="application/octet-stream"):
+		Transformer.__init__(self, mime_type)
+
+	def transform(self, binary, environ):
+		if isinstance(binary, arrays.Grid):
+			return [binary.to_bytes()]
+		return [arrays.encode_records(binary.stamps, binary.values)]
+
+# CSV output is sent in chunks of about this many bytes
+CSV_CHUNK_SIZE = 64 * 1024
+
 class CSVDataTransformer(Transformer):
-	class _OutHandler(object):
-		"""Class implementing an iterator which uses a CSV writer
-		object to generate its output.
+	"""Transformer producing CSV, in the excel dialect, from a
+	ValueArray or from any sequence of rows. A ValueArray has its
+	timestamps formatted all at once, and may have several value
+	columns. The output is generated lazily, in chunks of about
+	chunk_size bytes.
+	"""
+	# Rows are formatted in batches of this many, between checks of
+	# the chunk size
+	BATCH = 256
 
-		This class also implements the write() method so that the CSV
-		writer can actually write a line to it.
-		"""
-		def __init__(self, data):
-			self.value = []
-			self.data = data
-
-		def write(self, x):
-			self.value.append(x)
-
-		def __iter__(self):
-			"""Return an iterator based on this object: actually a
-			generator function
-			"""
-			fmt = csv.writer(self, dialect="excel")
-			for line in self.data:
-				fmt.writerow(line)
-				yield "".join(self.value).encode("utf8")
-				self.value = []
+	def __init__(self, mime_type="text/csv; charset=utf-8",
+				 chunk_size=CSV_CHUNK_SIZE):
+		Transformer.__init__(self, mime_type)
+		self.chunk_size = chunk_size
 
 	def transform(self, binary, environ):
-		# Process just a time/value pair into a CSV output
-		return self._OutHandler(binary)
+		if isinstance(binary, arrays.ValueArray):
+			rows = self.value_rows(binary)
+		else:
+			rows = iter(binary)
+		return self._chunks(rows)
+
+	def value_rows(self, data):
+		"""Return an iterator of the rows of a ValueArray, formatting
+		the timestamps in the same way as str() does for a datetime,
+		and leaving NaN (NULL) values empty
+		"""
+		columns = data.value_columns(nulls=True)
+		stamps = arrays.format_stamps(data.stamps, iso=False)
+		return zip(stamps, *columns)
+
+	def _chunks(self, rows):
+		buf = io.StringIO()
+		fmt = csv.writer(buf, dialect="excel")
+		while True:
+			batch = list(itertools.islice(rows, self.BATCH))
+			if not batch:
+				break
+			fmt.writerows(batch)
+			if buf.tell() >= self.chunk_size:
+				yield buf.getvalue().encode("utf8")
+				buf.seek(0)
+				buf.truncate()
+		if buf.tell() > 0:
+			yield buf.getvalue().encode("utf8")
@@ -3,6 +3,8 @@
 
 import importlib
 
+import fuse.tailcache as tailcache
+
 _impl = None
 _DB = None
 
@@ -14,5 +16,9 @@ def get_database(config):
 	if _impl is None:
 		_impl = importlib.import_module("fuse.db_" + config.db_type)
 	if _DB is None:
-		_DB = _impl.Database(config)
+		cls = _impl.Database
+		if getattr(config, "tail_window_seconds", 0):
+			# Serve reads of recent data from memory
+			cls = tailcache.cached(cls)
+		_DB = cls(config)
 	return _DB
@@ -0,0 +1,414 @@
+"""In-memory database interface object. This implements the same
+interface as the PostgreSQL backend, but keeps everything in Python
+data structures, so it is only useful for testing and benchmarking.
+Nothing is persisted.
+"""
+
+import logging
+import datetime
+import bisect
+import threading
+
+import fuse.arrays as arrays
+import fuse.watermark as watermark
+import fuse.sketch as sketch
+
+_UTC = datetime.timezone.utc
+_NAN = float("nan")
+
+log = logging.getLogger("db_memory")
+
+class _Series(object):
+	"""The data for a single series: parallel lists of timestamps
+	(kept sorted), values and ingest times, the rolled-up expired
+	data, as a dict mapping bucket start times to [count, min, max,
+	mean], the quantile sketches, as a dict mapping bucket start
+	times to TDigests (or None, if the bucket has been written to
+	since its sketch was built), and the digests of the expired data
+	in each sketch bucket
+	"""
+	def __init__(self, info):
+		self.info = info
+		self.stamps = []
+		self.values = []
+		self.ingest = []
+		self.rollup = {}
+		self.sketches = {}
+		self.expired = {}
+
+class Database(object):
+	def __init__(self, conf):
+		self.lock = threading.Lock()
+		self.series = {}
+		self.next_id = 1
+		self.listeners = []
+
+	def create_series(self,
+					  name,
+					  period,
+					  epoch=datetime.datetime(1970, 1, 1, tzinfo=_UTC),
+					  ts_type="point",
+					  unit="",
+					  get_limit=1000,
+					  description="",
+					  retention=None):
+		"""Create a time-series. Return the ID of the series created.
+		"""
+		if ts_type not in ("point", "mean", "stdev", "count"):
+			log.error("Series creation failed: type \"%s\" not recognised", ts_type)
+			return None
+		if (not isinstance(period, datetime.timedelta)
+			or not isinstance(epoch, datetime.datetime)):
+			log.error("Series creation failed: name=%s, period=%s, epoch=%s",
+					  name, period, epoch)
+			return None
+
+		with self.lock:
+			sid = self.next_id
+			self.next_id += 1
+			self.series[sid] = _Series({ "id": sid,
+										 "name": name,
+										 "description": description,
+										 "period": period,
+										 "epoch": epoch,
+										 "type": ts_type,
+										 "limit": get_limit,
+										 "units": unit,
+										 "retention": retention,
+										 })
+		return sid
+
+	def drop_series(self, sid):
+		"""Drop a time-series with the given series ID.
+		"""
+		with self.lock:
+			self.series.pop(sid, None)
+
+	def list_series(self, sid=None, period=None, ts_type=None, name=None,
+					prefix=None, after=None, limit=None):
+		"""List the available time-series, in order of ID, filtered and
+		paged as by the PostgreSQL backend
+		"""
+		if period is not None:
+			try:
+				low, high = period[0:2]
+				match_period = lambda p: low <= p < high
+			except TypeError:
+				match_period = lambda p: p == period
+			except ValueError:
+				match_period = lambda p: p == period[0]
+
+		rv = {}
+		with self.lock:
+			# Series are created in order of ID
+			for s in self.series.values():
+				info = s.info
+				if limit is not None and len(rv) >= limit:
+					break
+				if after is not None and info["id"] <= after:
+					continue
+				if sid is not None and info["id"] != sid:
+					continue
+				if period is not None and not match_period(info["period"]):
+					continue
+				if ts_type is not None and info["type"] != ts_type:
+					continue
+				if name is not None and name.lower() not in info["name"].lower():
+					continue
+				if (prefix is not None
+					and not info["name"].lower().startswith(prefix.lower())):
+					continue
+				rv[info["id"]] = dict(info)
+		return rv
+
+	def is_series(self, sid):
+		"""Check whether sid is a series
+		"""
+		return sid in self.series
+
+	def set_retention(self, sid, retention):
+		"""Set how long a series' raw data is kept (a timedelta, or None
+		to keep it for ever). Returns False if there is no such series.
+		"""
+		with self.lock:
+			ser = self.series.get(sid)
+			if ser is None:
+				return False
+			ser.info["retention"] = retention
+		return True
+
+	def count_expired(self, sid, before):
+		"""Return the number of raw data points of a series older than
+		before
+		"""
+		with self.lock:
+			ser = self.series.get(sid)
+			if ser is None:
+				return 0
+			return bisect.bisect_left(ser.stamps, before)
+
+	def expire(self, sid, before, bucket, limit):
+		"""Roll up and delete the oldest (at most limit) raw data
+		points of a series older than before, as the PostgreSQL
+		backend does, keeping the digests of their values for the
+		quantile sketches. Returns the number of points deleted.
+		"""
+		size = bucket // datetime.timedelta(microseconds=1)
+		with self.lock:
+			ser = self.series.get(sid)
+			if ser is None:
+				return 0
+			n = min(bisect.bisect_left(ser.stamps, before), limit)
+			expired = {}
+			for ts, value in zip(ser.stamps[:n], ser.values[:n]):
+				if value != value:
+					continue
+				stamp = arrays.to_stamp(ts)
+				expired.setdefault(arrays.to_datetime(sketch.bucket_of(stamp)),
+								   []).append(value)
+				start = arrays.to_datetime(stamp - stamp % size)
+				r = ser.rollup.get(start)
+				if r is None:
+					ser.rollup[start] = [1, value, value, value]
+				else:
+					r[3] = (r[3] * r[0] + value) / (r[0] + 1)
+					r[0] += 1
+					r[1] = min(r[1], value)
+					r[2] = max(r[2], value)
+			for start, values in expired.items():
+				digest = sketch.TDigest.from_values(values)
+				if start in ser.expired:
+					digest = sketch.TDigest.merge([ser.expired[start], digest])
+				ser.expired[start] = digest
+				ser.sketches.setdefault(start, None)
+			del ser.stamps[:n]
+			del ser.values[:n]
+			del ser.ingest[:n]
+		return n
+
+	def get_rollup(self, sid, from_ts=None, to_ts=None):
+		"""Return a list of (bucket start, count, min, max, mean) for the
+		rolled-up (expired) data of a series, sorted by time
+		"""
+		with self.lock:
+			ser = self.series.get(sid)
+			if ser is None:
+				return []
+			return [(ts,) + tuple(r) for ts, r in sorted(ser.rollup.items())
+					if (from_ts is None or ts >= from_ts)
+					and (to_ts is None or ts < to_ts)]
+
+	def get_sketches(self, sid, from_ts=None, to_ts=None):
+		"""Return a list of (bucket start, TDigest) for the buckets of a
+		series' data starting in the given range (from_ts being taken
+		back to the start of its bucket), sorted by time, building any
+		which are stale (from the data, and the digest of any of it
+		which has expired)
+		"""
+		if from_ts is not None:
+			from_ts = arrays.to_datetime(sketch.bucket_of(arrays.to_stamp(from_ts)))
+		rv = []
+		with self.lock:
+			ser = self.series.get(sid)
+			if ser is None:
+				return []
+			for start in sorted(ser.sketches):
+				if ((from_ts is not None and start < from_ts)
+					or (to_ts is not None and start >= to_ts)):
+					continue
+				digest = ser.sketches[start]
+				if digest is None:
+					lo = bisect.bisect_left(ser.stamps, start)
+					hi = bisect.bisect_left(ser.stamps, start + sketch.BUCKET)
+					digest = sketch.TDigest.from_values(ser.values[lo:hi])
+					if start in ser.expired:
+						digest = sketch.TDigest.merge([ser.expired[start], digest])
+					ser.sketches[start] = digest
+				rv.append((start, digest))
+		return rv
+
+	def get_summaries(self, sids):
+		"""Return a dict mapping each of the series IDs in sids to a
+		summary of its data: the number of points, the min and max
+		values, the first and last timestamps, and the latest value.
+		Series which don't exist are left out.
+		"""
+		rv = {}
+		with self.lock:
+			for sid in sids:
+				ser = self.series.get(sid)
+				if ser is None:
+					continue
+				values = [v for v in ser.values if v == v]
+				rv[sid] = { "count": len(ser.stamps),
+							"min": min(values) if values else None,
+							"max": max(values) if values else None,
+							"first": ser.stamps[0] if ser.stamps else None,
+							"last": ser.stamps[-1] if ser.stamps else None,
+							"latest": ser.values[-1] if ser.values else None,
+							}
+		return rv
+
+	def add_value(self, sid, ts, value):
+		changed = self._store(sid, ts, value)
+		if changed is None:
+			return False
+		if changed:
+			self._notify(sid, [arrays.to_stamp(ts)], [value])
+		return True
+
+	def _store(self, sid, ts, value):
+		"""Store a point. Returns True if it was written, False if it
+		was already there with the same value, or None if it could not
+		be stored.
+		"""
+		try:
+			value = _NAN if value is None else float(value)
+			ser = self.series[sid]
+		except (ValueError, TypeError, KeyError):
+			log.error("Failed to insert/update data: id=%s, time=%s, value=%s",
+					  sid, ts, value)
+			return None
+
+		now = datetime.datetime.now(_UTC)
+		stamp = arrays.to_stamp(ts)
+		with self.lock:
+			i = bisect.bisect_left(ser.stamps, ts)
+			if i < len(ser.stamps) and ser.stamps[i] == ts:
+				old = ser.values[i]
+				if old == value or (old != old and value != value):
+					return False
+				ser.values[i] = value
+				ser.ingest[i] = now
+			else:
+				ser.stamps.insert(i, ts)
+				ser.values.insert(i, value)
+				ser.ingest.insert(i, now)
+			ser.sketches[arrays.to_datetime(sketch.bucket_of(stamp))] = None
+		return True
+
+	def add_values_array(self, sid, stamps, values):
+		"""Add or update many data points, from arrays of timestamps
+		(in microseconds since the Unix epoch) and values. Points
+		already stored with the same value are left alone. Returns a
+		list of the indexes of the points which could not be stored,
+		and the number of points actually written.
+		"""
+		bad = []
+		written = {}
+		for i, (ts, value) in enumerate(zip(stamps, values)):
+			changed = None
+			if arrays.MIN_STAMP <= ts <= arrays.MAX_STAMP:
+				changed = self._store(sid, arrays.to_datetime(ts), value)
+			if changed is None:
+				bad.append(i)
+			elif changed:
+				written[int(ts)] = float(value)
+		if written:
+			stamps = sorted(written)
+			self._notify(sid, stamps, [written[t] for t in stamps])
+		return bad, len(written)
+
+	def release(self):
+		"""Nothing to release: there are no connections
+		"""
+		pass
+
+	def listen(self, callback):
+		"""Call callback(sid, ValueArray) with the new data whenever
+		data is written
+		"""
+		self.listeners.append(callback)
+
+	def _notify(self, sid, stamps, values):
+		if self.listeners:
+			data = arrays.from_points(list(zip(stamps, values)), sid)
+			for callback in self.listeners:
+				callback(sid, data)
+
+	def get_values(self, sid, from_ts=None, to_ts=None):
+		"""Return a sorted iterator of (ts, value) pairs from the given series
+		"""
+		ser = self.series.get(sid)
+		if ser is None:
+			return iter(())
+		with self.lock:
+			lo = 0
+			hi = len(ser.stamps)
+			if from_ts is not None:
+				lo = bisect.bisect_left(ser.stamps, from_ts)
+			if to_ts is not None:
+				hi = bisect.bisect_left(ser.stamps, to_ts)
+			return iter(list(zip(ser.stamps[lo:hi], ser.values[lo:hi])))
+
+	def get_values_array(self, sid, from_ts=None, to_ts=None):
+		"""Return a ValueArray of the data from the given series,
+		sorted by time
+		"""
+		return arrays.from_points(
+			[(arrays.to_stamp(ts), v)
+			 for ts, v in self.get_values(sid, from_ts, to_ts)], sid)
+
+	def get_changes(self, sid=None, since=None, limit=None,
+					settle=datetime.timedelta(seconds=5)):
+		"""Return the points of a series (or of all series) written
+		after the Watermark since, and at least settle ago. Returns a
+		dict mapping series IDs to ValueArrays, and the Watermark to
+		pass in next time. At most limit points are returned.
+		"""
+		if since is None:
+			since = watermark.Watermark(0)
+		horizon = watermark.horizon(settle)
+		start = since.key()
+		rows = []
+		with self.lock:
+			if sid is None:
+				sids = sorted(self.series)
+			else:
+				sids = [sid] if sid in self.series else []
+			for s in sids:
+				ser = self.series[s]
+				rows += [(ingest, s, ts, v)
+						 for ts, v, ingest in zip(ser.stamps, ser.values, ser.ingest)
+						 if start < (ingest, s, ts) and ingest <= horizon]
+		rows.sort(key=lambda r: r[:3])
+		if limit is not None:
+			rows = rows[:limit]
+		return (watermark.group(rows),
+				watermark.next_watermark(since, rows, limit, horizon))
+
+	def export(self, sid=None, from_ts=None, to_ts=None, chunk_size=1 << 20):
+		"""Return an iterator of chunks of CSV text (as bytes), in the
+		same format as the PostgreSQL backend's export
+		"""
+		if sid is None:
+			with self.lock:
+				sids = sorted(self.series)
+		else:
+			sids = [sid]
+		rows = []
+		for s in sids:
+			rows += [(s, ts, v) for ts, v in self.get_values(s, from_ts, to_ts)]
+
+		def chunks():
+			buf = ["series,time,value\n"]
+			size = 0
+			for s, ts, v in rows:
+				line = "{0},{1},{2!r}\n".format(
+					s, ts.astimezone(_UTC).strftime("%Y-%m-%dT%H:%M:%S.%f+0000"), v)
+				buf.append(line)
+				size += len(line)
+				if size >= chunk_size:
+					yield "".join(buf).encode("ascii")
+					buf = []
+					size = 0
+			if buf:
+				yield "".join(buf).encode("ascii")
+		return chunks()
+
+	def _wipe(self):
+		"""Internal method used by test suite
+		"""
+		with self.lock:
+			self.series = {}
+			self.next_id = 1
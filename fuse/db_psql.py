@@ -3,22 +3,581 @@
 
 import logging
 import datetime
+import time
+import random
+import threading
+import queue
+import io
+import json
+import select
+import itertools
+import bisect
 
 import psycopg2
 
-CURRENT_VERSION = 1
+import fuse.metrics as metrics
+import fuse.arrays as arrays
+import fuse.watermark as watermark
+import fuse.trace as trace
+import fuse.sketch as sketch
+
+CURRENT_VERSION = 9
 _UTC = datetime.timezone.utc
 
 log = logging.getLogger("db_psql")
+slow_log = logging.getLogger("db_psql.slow")
+
+class QueryStats(object):
+	"""Call counts, latency and row counts for each SQL statement
+	template executed. The template is the SQL text with its
+	whitespace normalised; parameters are not part of it.
+
+	At most max_templates templates are kept: statements seen after
+	that are counted together, under OTHER.
+	"""
+	OTHER = "(other)"
+
+	def __init__(self, max_templates=1000):
+		self.lock = threading.Lock()
+		self.max_templates = max_templates
+		self.templates = {}
+		self.stats = {}
+
+	def template(self, sql):
+		"""Return the normalised form of the SQL text
+		"""
+		tmpl = self.templates.get(sql)
+		if tmpl is None:
+			tmpl = " ".join(sql.split())
+			if len(self.templates) >= self.max_templates:
+				self.templates.clear()
+			self.templates[sql] = tmpl
+		return tmpl
+
+	def record(self, sql, elapsed, rows):
+		tmpl = self.template(sql)
+		with self.lock:
+			st = self.stats.get(tmpl)
+			if st is None:
+				if len(self.stats) >= self.max_templates:
+					tmpl = self.OTHER
+					st = self.stats.get(tmpl)
+			if st is None:
+				st = [0, 0.0, 0.0, 0]
+				self.stats[tmpl] = st
+			st[0] += 1
+			st[1] += elapsed
+			if elapsed > st[2]:
+				st[2] = elapsed
+			if rows > 0:
+				st[3] += rows
+
+	def summary(self):
+		"""Return a list of per-statement summaries, most expensive
+		(by total time) first
+		"""
+		with self.lock:
+			items = [(k, list(v)) for k, v in self.stats.items()]
+		items.sort(key=lambda kv: kv[1][1], reverse=True)
+		return [{ "statement": k,
+				  "calls": v[0],
+				  "seconds": v[1],
+				  "max_seconds": v[2],
+				  "mean_seconds": v[1] / v[0],
+				  "rows": v[3],
+				  }
+				for k, v in items]
+
+	def collect(self):
+		"""Metrics collector: render the statistics as metrics
+		"""
+		reg = metrics.REGISTRY
+		lbl = ("statement",)
+		calls = reg.collected(metrics.Counter, "fuse_db_statement_calls_total",
+							  "Executions of each SQL statement template", lbl)
+		secs = reg.collected(metrics.Counter, "fuse_db_statement_seconds_total",
+							 "Total time spent executing each SQL statement template",
+							 lbl)
+		slowest = reg.collected(metrics.Gauge, "fuse_db_statement_max_seconds",
+								"Longest execution of each SQL statement template",
+								lbl)
+		rows = reg.collected(metrics.Counter, "fuse_db_statement_rows_total",
+							 "Rows returned or affected by each SQL statement template",
+							 lbl)
+		for st in self.summary():
+			key = (st["statement"][:STATEMENT_LABEL_LENGTH],)
+			calls.inc(key, st["calls"])
+			secs.inc(key, st["seconds"])
+			slowest.set(key, max(slowest.values.get(key, 0.0), st["max_seconds"]))
+			rows.inc(key, st["rows"])
+		return [calls, secs, slowest, rows]
+
+# Statement templates are truncated to this length for metric labels
+STATEMENT_LABEL_LENGTH = 120
+
+# Statistics are shared between all Database objects in the process
+STATS = QueryStats()
+metrics.REGISTRY.add_collector(STATS.collect)
+
+SERIES_COLUMNS = ("id, name, description, period, epoch, ts_type, get_limit,"
+				  " units, retention")
+
+# The hot statements. Each is prepared once on each connection (with
+# its %s placeholders numbered), and then run by name, so that it is
+# only parsed and planned once.
+PREPARED = {
+	"is_series": "select count(id) from series where id=%s",
+	"get_values": """select stamp, value from data where series_id = %s
+					 order by stamp""",
+	"get_values_from": """select stamp, value from data where series_id = %s
+						   and stamp >= %s order by stamp""",
+	"get_values_to": """select stamp, value from data where series_id = %s
+						 and stamp < %s order by stamp""",
+	"get_values_range": """select stamp, value from data where series_id = %s
+							and stamp >= %s and stamp < %s order by stamp""",
+	"upsert_data": "select upsert_data(%s, %s, clock_timestamp(), %s)",
+	"list_series_id": "select " + SERIES_COLUMNS + " from series where id=%s",
+	"list_series_page": ("select " + SERIES_COLUMNS + " from series where id > %s"
+						 " order by id limit %s"),
+	"get_summaries": """select s.id, coalesce(m.count, 0), m.min, m.max,
+							   m.first, m.last, m.latest
+						from series s left join summary m on m.series_id = s.id
+						where s.id = any(%s)""",
+	}
+
+def _numbered(sql):
+	"""Replace the %s placeholders in sql with $1, $2, ..., for PREPARE
+	"""
+	parts = sql.split("%s")
+	return "".join(p + "${0}".format(i + 1) for i, p in enumerate(parts[:-1])) + parts[-1]
+
+class _Connection(psycopg2.extensions.connection):
+	"""A connection which remembers which statements have been
+	prepared on it
+	"""
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.prepared = set()
+
+# How far behind the primary a replica is, in seconds. A replica which
+# has replayed everything it has received is up to date, however long
+# ago its last transaction was, but only while it is still receiving:
+# one whose WAL receiver isn't streaming (or has stopped) may be any
+# distance behind. (Without pg_read_all_stats the status is hidden, so
+# then a running receiver is taken to be streaming.)
+REPLICA_LAG_SQL = """
+	select case when not pg_is_in_recovery() then 0
+				when not exists (select 1 from pg_stat_wal_receiver
+								 where coalesce(status, 'streaming') = 'streaming')
+				then 'Infinity'
+				when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+				else coalesce(extract(epoch from
+						now() - pg_last_xact_replay_timestamp()), 0)
+		   end::float8
+	"""
+
+# The horizon for get_changes(): the settle lag before now, and before
+# the start of any other transaction which has written (and so has an
+# xid) but not yet committed
+HORIZON_SQL = """
+	select least(clock_timestamp() - %s,
+				 (select min(xact_start) - interval '1 microsecond'
+				  from pg_stat_activity
+				  where datname = current_database()
+					and backend_xid is not null
+					and pid <> pg_backend_pid()))
+	"""
+
+class _Replica(object):
+	"""A read replica: its connection parameters (a dict like
+	db_params, or a DSN string), its idle connections, and its health
+	"""
+	def __init__(self, params):
+		if isinstance(params, str):
+			params = psycopg2.extensions.parse_dsn(params)
+		self.params = params
+		self.name = "{0}:{1}".format(params.get("host", ""),
+									 params.get("port", 5432))
+		self.pool = []
+		self.lock = threading.Lock()
+		self.down_until = 0.0  # Not used before this time, after a failure
+		self.checked = 0.0     # When its lag was last checked
+
+	def take(self):
+		"""Return an idle connection to the replica, or a new one
+		"""
+		with self.lock:
+			if self.pool:
+				return self.pool.pop()
+		conn = psycopg2.connect(connection_factory=_Connection, **self.params)
+		conn.autocommit = True
+		return conn
+
+	def put(self, conn, pool_size):
+		"""Keep a connection for reuse, or close it if enough are kept
+		"""
+		if not conn.closed:
+			with self.lock:
+				if len(self.pool) < pool_size:
+					self.pool.append(conn)
+					return
+			conn.close()
+
+	def fail(self, retry):
+		"""Mark the replica as unusable for retry seconds, and close its
+		idle connections
+		"""
+		self.down_until = time.monotonic() + retry
+		with self.lock:
+			pool, self.pool = self.pool, []
+		for conn in pool:
+			conn.close()
+
+# New data is announced on this NOTIFY channel. Batches of up to
+# NOTIFY_MAX_POINTS are sent in full; larger ones as a time range.
+NOTIFY_CHANNEL = "fuse_data"
+NOTIFY_MAX_POINTS = 100
+# Listeners connect with this application_name, so that writers can
+# tell whether anyone is listening. Writers check at most every
+# LISTENER_CHECK seconds, so a new listener may miss notifications for
+# that long after it connects.
+LISTEN_APPLICATION = "fuse-listen"
+LISTENER_CHECK = 1.0
+
+# Stale quantile sketches are built from the data of at most this many
+# buckets (days) at a time, so that building a long run of them (as
+# the upgrade to version 8 leaves) doesn't read it all at once
+SKETCH_BUILD_BUCKETS = 7
+
+# Exports are sent in chunks of at least this many bytes, with at
+# most EXPORT_QUEUE_DEPTH chunks buffered ahead of the client
+EXPORT_CHUNK_SIZE = 1 << 20
+EXPORT_QUEUE_DEPTH = 4
+
+# Timestamps in exports are in the same format as the rest of the API
+EXPORT_SQL = """
+	copy (select series_id as series,
+				 to_char(stamp at time zone 'UTC',
+						 'YYYY-MM-DD"T"HH24:MI:SS.US"+0000"') as time,
+				 value
+		  from data where {0}
+		  order by series_id, stamp)
+	to stdout with (format csv, header)
+	"""
+
+def _like_escape(text):
+	"""Escape the LIKE pattern characters in text
+	"""
+	return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+class _CopyBuffer(object):
+	"""File-like object collecting the output of a COPY TO STDOUT
+	"""
+	def __init__(self):
+		self.chunks = []
+
+	def write(self, data):
+		self.chunks.append(data)
+
+	def getvalue(self):
+		return b"".join(self.chunks)
+
+class _Cancelled(Exception):
+	pass
+
+class _CopyStream(object):
+	"""Iterator over the output of a COPY ... TO STDOUT statement.
+	The COPY runs in a background thread on its own connection, and
+	its output is passed over as chunks of bytes. The queue between
+	the two is bounded, so a slow client slows down the database
+	rather than filling up memory. The connection is closed when the
+	COPY finishes or the iterator is closed.
+	"""
+	def __init__(self, conn, sql, template, chunk_size):
+		self.conn = conn
+		self.sql = sql
+		self.template = template
+		self.chunk_size = chunk_size
+		self.queue = queue.Queue(EXPORT_QUEUE_DEPTH)
+		self.buf = []
+		self.size = 0
+		self.cancelled = False
+		self.thread = threading.Thread(target=self.run, name="export",
+									   daemon=True)
+		self.thread.start()
+
+	def run(self):
+		start = time.perf_counter()
+		try:
+			cur = self.conn.cursor()
+			cur.copy_expert(self.sql, self)
+			self.flush()
+			STATS.record(self.template, time.perf_counter() - start,
+						 cur.rowcount)
+			self.put(None)
+		except _Cancelled:
+			pass
+		except Exception as ex:
+			if not self.cancelled:
+				log.error("Export failed: %s", self.template, exc_info=ex)
+				try:
+					self.put(ex)
+				except _Cancelled:
+					pass
+		finally:
+			self.conn.close()
+
+	def write(self, data):
+		"""Called by psycopg2 with each piece of COPY output
+		"""
+		if self.cancelled:
+			raise _Cancelled()
+		self.buf.append(data)
+		self.size += len(data)
+		if self.size >= self.chunk_size:
+			self.flush()
+
+	def flush(self):
+		if self.buf:
+			self.put(b"".join(self.buf))
+			self.buf = []
+			self.size = 0
+
+	def put(self, item):
+		# Give up waiting if the consumer goes away
+		while True:
+			if self.cancelled:
+				raise _Cancelled()
+			try:
+				self.queue.put(item, timeout=0.5)
+				return
+			except queue.Full:
+				pass
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		item = self.queue.get()
+		if item is None:
+			raise StopIteration()
+		if isinstance(item, Exception):
+			raise item
+		return item
+
+	def close(self):
+		if self.cancelled or not self.thread.is_alive():
+			return
+		self.cancelled = True
+		try:
+			self.conn.cancel()
+		except psycopg2.Error:
+			pass
 
 class Database(object):
 	def __init__(self, conf):
-		self.db = psycopg2.connect(**conf.db_params)
-		self.db.autocommit = True # Default to autocommit on
+		# Statements taking longer than slow_query_ms are logged to the
+		# db_psql.slow logger. A fraction slow_query_explain_rate of
+		# those are also re-run under EXPLAIN ANALYZE, and the plan
+		# logged with them.
+		self.slow_query = getattr(conf, "slow_query_ms", 500)
+		if self.slow_query is not None:
+			self.slow_query /= 1000.0
+		self.explain_rate = getattr(conf, "slow_query_explain_rate", 0.0)
+
+		# Hot statements are prepared on each connection
+		self.prepare = getattr(conf, "db_prepare", True)
+
+		# Writes are announced with NOTIFY, for live subscribers, if
+		# anyone is listening: when this process is, or (checked every
+		# LISTENER_CHECK seconds) another is
+		self.notify = getattr(conf, "live_notify", True)
+		self.listening = False
+		self.listeners_checked = -LISTENER_CHECK
+		self.listeners = True
+		# How long a new listener should wait for notifications to be
+		# reliable
+		self.notify_delay = LISTENER_CHECK
+
+		# Each thread uses its own connection. Connections released by
+		# threads which have finished with them are kept for reuse.
+		self.db_params = conf.db_params
+		self.local = threading.local()
+		self.pool = []
+		self.pool_lock = threading.Lock()
+		self.pool_size = getattr(conf, "db_pool_size", 8)
+
+		# Reads of the series list and of data may be sent to read
+		# replicas, in turn. A replica which fails, or falls more than
+		# replica_max_lag seconds behind, is not used for
+		# replica_retry_seconds. A series written through this server
+		# is read from the primary for read_your_writes_seconds after.
+		self.replicas = [_Replica(p) for p in getattr(conf, "db_replicas", [])]
+		self.replica_max_lag = getattr(conf, "replica_max_lag", 30.0)
+		self.replica_check = getattr(conf, "replica_check_seconds", 5.0)
+		self.replica_retry = getattr(conf, "replica_retry_seconds", 30.0)
+		self.read_your_writes = getattr(conf, "read_your_writes_seconds", 5)
+		self.written = {}      # Series ID -> when this server last wrote it
+		self.written_pruned = time.monotonic()
+		self.next_replica = itertools.count()
+		self.reads = metrics.REGISTRY.counter(
+			"fuse_db_reads_total",
+			"Database reads, by whether a replica or the primary served them",
+			("target",))
+		self.replica_failures = metrics.REGISTRY.counter(
+			"fuse_db_replica_failures_total",
+			"Read replicas taken out of use, by replica and reason",
+			("replica", "reason"))
+
 		ver = self._db_version()
 		if ver != CURRENT_VERSION:
 			self._upgrade(ver)
 
+	@property
+	def db(self):
+		"""The current thread's database connection
+		"""
+		conn = getattr(self.local, "conn", None)
+		if conn is None:
+			with self.pool_lock:
+				if self.pool:
+					conn = self.pool.pop()
+			if conn is None:
+				conn = psycopg2.connect(connection_factory=_Connection,
+										**self.db_params)
+				conn.autocommit = True # Default to autocommit on
+			self.local.conn = conn
+		return conn
+
+	def release(self):
+		"""Release the current thread's connection for reuse by other
+		threads. Called at the end of each request.
+		"""
+		self._release_reader()
+		conn = getattr(self.local, "conn", None)
+		if conn is None:
+			return
+		self.local.conn = None
+		if not conn.closed and conn.autocommit:
+			with self.pool_lock:
+				if len(self.pool) < self.pool_size:
+					self.pool.append(conn)
+					return
+		conn.close()
+
+	def _release_reader(self):
+		"""Release the current thread's replica connection, if any
+		"""
+		reader = getattr(self.local, "reader", None)
+		if reader is not None:
+			self.local.reader = None
+			replica, conn = reader
+			replica.put(conn, self.pool_size)
+
+	def _replica_failed(self, replica, reason, ex=None):
+		"""Take a replica out of use for a while
+		"""
+		log.warning("Read replica %s %s; not using it for %s seconds",
+					replica.name, reason, self.replica_retry, exc_info=ex)
+		self.replica_failures.inc((replica.name, reason))
+		reader = getattr(self.local, "reader", None)
+		if reader is not None and reader[0] is replica:
+			self.local.reader = None
+			reader[1].close()
+		replica.fail(self.replica_retry)
+
+	def _wrote(self, sid):
+		"""Note that series sid has just been written, so that it is
+		read from the primary for the next read_your_writes seconds.
+		Series which haven't been written for that long are forgotten
+		every read_your_writes seconds, so that series which are only
+		written don't accumulate.
+		"""
+		if self.replicas and self.read_your_writes:
+			now = time.monotonic()
+			self.written[sid] = now
+			if now - self.written_pruned >= self.read_your_writes:
+				self.written_pruned = now
+				for other, last in list(self.written.items()):
+					if now - last >= self.read_your_writes:
+						self.written.pop(other, None)
+
+	def _written(self, sids, now):
+		"""Return whether any of the series IDs in sids was written in
+		the last read_your_writes seconds
+		"""
+		for sid in sids:
+			last = self.written.get(sid)
+			if last is not None and now - last < self.read_your_writes:
+				return True
+		return False
+
+	def _reader(self, sid=None):
+		"""Return a replica connection for a read of series sid (or of
+		each of a list of series IDs, or of the series list), or None
+		if the primary should be used: when there is no healthy
+		replica, or a series was written too recently. A replica's lag
+		is checked every replica_check seconds, on whichever connection
+		is using it at the time.
+		"""
+		if not self.replicas:
+			return None
+		now = time.monotonic()
+		if sid is not None and self.read_your_writes:
+			if self._written(sid if isinstance(sid, list) else [sid], now):
+				return None
+
+		reader = getattr(self.local, "reader", None)
+		if reader is not None and (reader[0].down_until > now or reader[1].closed):
+			self._release_reader()
+			reader = None
+		if reader is None:
+			for _ in range(len(self.replicas)):
+				replica = self.replicas[next(self.next_replica) % len(self.replicas)]
+				if replica.down_until > now:
+					continue
+				try:
+					reader = (replica, replica.take())
+				except psycopg2.Error as ex:
+					self._replica_failed(replica, "unreachable", ex)
+					continue
+				self.local.reader = reader
+				break
+			else:
+				return None
+
+		replica, conn = reader
+		if now - replica.checked >= self.replica_check:
+			replica.checked = now
+			try:
+				cur = conn.cursor()
+				cur.execute(REPLICA_LAG_SQL)
+				lag = cur.fetchone()[0]
+			except psycopg2.Error as ex:
+				self._replica_failed(replica, "unreachable", ex)
+				return self._reader(sid)
+			if lag > self.replica_max_lag:
+				self._replica_failed(replica, "lagging")
+				return self._reader(sid)
+		return conn
+
+	def _read(self, sid, run):
+		"""Call run(conn) with a connection for a read of series sid
+		(or of a list of series, or of the series list): a replica's if
+		one can be used,
+		falling back to the primary's if it fails
+		"""
+		conn = self._reader(sid)
+		if conn is not None:
+			try:
+				rv = run(conn)
+				self.reads.inc(("replica",))
+				return rv
+			except (psycopg2.OperationalError, psycopg2.InterfaceError) as ex:
+				self._replica_failed(self.local.reader[0], "failed", ex)
+		self.reads.inc(("primary",))
+		return run(self.db)
+
 	def create_series(self,
 					  name,
 					  period,
@@ -26,7 +585,8 @@ class Database(object):
 					  ts_type="point",
 					  unit="",
 					  get_limit=1000,
-					  description=""):
+					  description="",
+					  retention=None):
 		"""Create a time-series. Return the ID of the series created.
 		"""
 		if ts_type not in ("point", "mean", "stdev", "count"):
@@ -39,12 +599,13 @@ class Database(object):
 			self._query(
 				"""
 				insert into series (name, description, units, period, epoch,
-									ts_type, get_limit)
-				values (%s, %s, %s, %s, %s, %s, %s)
+									ts_type, get_limit, retention)
+				values (%s, %s, %s, %s, %s, %s, %s, %s)
 				""", (name, description, unit, period, epoch,
-					  ts_type, get_limit))
+					  ts_type, get_limit, retention))
 			rv = self._query("select lastval()").fetchone()[0]
 			self.db.commit()
+			self._wrote(rv)
 		except psycopg2.DatabaseError as ex:
 			self.db.rollback()
 			log.error("Series creation failed: name=%s, units=%s, period=%s,"
@@ -60,12 +621,27 @@ class Database(object):
 		"""Drop a time-series with the given series ID.
 		"""
 		self._query("delete from series where id=%s", (sid,))
+		self._wrote(sid)
 
-	def list_series(self, sid=None, period=None, ts_type=None, name=None):
-		"""List the available time-series
+	def list_series(self, sid=None, period=None, ts_type=None, name=None,
+					prefix=None, after=None, limit=None):
+		"""List the available time-series, in order of ID. name matches
+		anywhere in the series name, prefix only at its start (both
+		ignoring case). For paging through the list, after is the last
+		ID of the previous page, and limit the page size.
 		"""
-		sql = "select id, name, description, period, epoch, ts_type, "
-		sql += " get_limit, units from series where 1=1"
+		if (period is None and ts_type is None and name is None
+			and prefix is None):
+			# The common cases
+			if sid is not None and after is None and limit is None:
+				return self._read(sid, lambda conn: self._series_dict(
+					self._execute("list_series_id", [sid], conn)))
+			if sid is None:
+				return self._read(None, lambda conn: self._series_dict(
+					self._execute("list_series_page",
+								  [0 if after is None else after, limit], conn)))
+
+		sql = "select " + SERIES_COLUMNS + " from series where 1=1"
 		params = []
 		if sid is not None:
 			sql += " and id=%s"
@@ -87,9 +663,24 @@ class Database(object):
 			params.append(ts_type)
 		if name is not None:
 			sql += " and name ilike %s"
-			params.append("%{0}%".format(name))
+			params.append("%{0}%".format(_like_escape(name)))
+		if prefix is not None:
+			sql += " and lower(name) like %s"
+			params.append("{0}%".format(_like_escape(prefix.lower())))
+		if after is not None:
+			sql += " and id > %s"
+			params.append(after)
+		sql += " order by id"
+		if limit is not None:
+			sql += " limit %s"
+			params.append(limit)
+
+		return self._read(sid, lambda conn: self._series_dict(
+			self._query(sql, params, conn)))
 
-		cur = self._query(sql, params)
+	def _series_dict(self, cur):
+		"""Return the rows of a series query as a dict, keyed by ID
+		"""
 		return { r[0]: { "id": r[0],
 						 "name": r[1],
 						 "description": r[2],
@@ -98,16 +689,219 @@ class Database(object):
 						 "type": r[5],
 						 "limit": r[6],
 						 "units": r[7],
+						 "retention": r[8],
 						 }
 				 for r in cur }
 
 	def is_series(self, sid):
 		"""Check whether sid is a series
 		"""
-		cur = self._query("select count(id) from series where id=%s", [sid])
+		cur = self._read(sid, lambda conn: self._execute("is_series", [sid], conn))
 		line = cur.fetchone()
 		return line[0] > 0
 
+	def set_retention(self, sid, retention):
+		"""Set how long a series' raw data is kept (a timedelta, or None
+		to keep it for ever). Returns False if there is no such series.
+		"""
+		cur = self._query("update series set retention=%s where id=%s",
+						  (retention, sid))
+		self._wrote(sid)
+		return cur.rowcount > 0
+
+	def try_lock(self, key):
+		"""Take the session advisory lock key (an integer) on the
+		current thread's connection, if no other session holds it.
+		Returns True if it was taken. It is held until unlock(key), or
+		until the connection closes.
+		"""
+		return self._query("select pg_try_advisory_lock(%s)", (key,)).fetchone()[0]
+
+	def unlock(self, key):
+		"""Release an advisory lock taken by try_lock()
+		"""
+		self._query("select pg_advisory_unlock(%s)", (key,))
+
+	def count_expired(self, sid, before):
+		"""Return the number of raw data points of a series older than
+		before
+		"""
+		return self._query(
+			"select count(*) from data where series_id=%s and stamp < %s",
+			(sid, before)).fetchone()[0]
+
+	def expire(self, sid, before, bucket, limit):
+		"""Roll up and delete the oldest (at most limit) raw data
+		points of a series older than before. The points are merged
+		into the series' rollup: the count, minimum, maximum and mean
+		of the values (other than NULLs and NaNs) in each bucket (a
+		timedelta; buckets are aligned to the Unix epoch). Their
+		values are also merged into the expired digest of their
+		quantile sketch bucket, so that the sketch still covers them
+		when it is built again. Returns the number of points deleted.
+		"""
+		self.db.autocommit = False
+		try:
+			purged = self._query(
+				"""
+				with doomed as (
+				  delete from data
+				  where series_id = %(sid)s and stamp in (
+				    select stamp from data
+				    where series_id = %(sid)s and stamp < %(before)s
+				    order by stamp
+				    limit %(limit)s)
+				  returning stamp, nullif(value, 'NaN') as value),
+				rolled as (
+				  insert into rollup (series_id, stamp, count, min, max, mean)
+				  select %(sid)s, to_timestamp(
+				           floor(extract(epoch from stamp) / %(bucket)s) * %(bucket)s),
+				         count(value), min(value), max(value), avg(value)
+				  from doomed
+				  group by 2
+				  having count(value) > 0
+				  on conflict (series_id, stamp)
+				  do update set
+				    count = rollup.count + excluded.count,
+				    min = least(rollup.min, excluded.min),
+				    max = greatest(rollup.max, excluded.max),
+				    mean = case when rollup.mean is null then excluded.mean
+				                else (rollup.mean * rollup.count
+				                      + excluded.mean * excluded.count)
+				                     / (rollup.count + excluded.count) end
+				  returning 1)
+				select stamp, value from doomed
+				""", { "sid": sid, "before": before, "limit": limit,
+					   "bucket": bucket.total_seconds() }).fetchall()
+			expired = {}
+			for stamp, value in purged:
+				if value is not None:
+					start = sketch.bucket_of(arrays.to_stamp(stamp))
+					expired.setdefault(start, []).append(value)
+			for start, values in expired.items():
+				self._expire_sketch(sid, arrays.to_datetime(start), values)
+			purged = len(purged)
+			self.db.commit()
+		except psycopg2.DatabaseError as ex:
+			log.error("Failed to expire data: id=%s, before=%s", sid, before,
+					  exc_info=ex)
+			self.db.rollback()
+			purged = 0
+
+		self.db.autocommit = True
+		return purged
+
+	def _expire_sketch(self, sid, stamp, values):
+		"""Merge values being expired into the expired digest of the
+		sketch bucket starting at stamp. The bucket's generation is
+		bumped, so that a sketch being built meanwhile from the data
+		they are deleted from isn't stored.
+		"""
+		row = self._query(
+			"""select expired from sketch
+			   where series_id = %s and stamp = %s for update""",
+			(sid, stamp)).fetchone()
+		digest = sketch.TDigest.from_values(values)
+		if row is not None and row[0] is not None:
+			digest = sketch.TDigest.merge([sketch.TDigest.from_bytes(row[0]), digest])
+		self._query(
+			"""insert into sketch (series_id, stamp, expired) values (%s, %s, %s)
+			   on conflict (series_id, stamp) do update set
+				 expired = excluded.expired,
+				 generation = sketch.generation + 1""",
+			(sid, stamp, psycopg2.Binary(digest.to_bytes())))
+
+	def get_rollup(self, sid, from_ts=None, to_ts=None):
+		"""Return a list of (bucket start, count, min, max, mean) for the
+		rolled-up (expired) data of a series, sorted by time
+		"""
+		qry = "select stamp, count, min, max, mean from rollup where series_id = %s"
+		params = [sid,]
+		if from_ts is not None:
+			qry += " and stamp >= %s"
+			params.append(from_ts)
+		if to_ts is not None:
+			qry += " and stamp < %s"
+			params.append(to_ts)
+		qry += " order by stamp"
+		return [tuple(r) for r in self._query(qry, params)]
+
+	def get_sketches(self, sid, from_ts=None, to_ts=None):
+		"""Return a list of (bucket start, TDigest) for the buckets (see
+		sketch.BUCKET) of a series' data starting in the given range
+		(from_ts being taken back to the start of its bucket), sorted
+		by time. The sketch of a bucket written to since it was last
+		built is built again from the data (and the digest of any of
+		its data which has expired), and stored. Stale buckets are
+		built SKETCH_BUILD_BUCKETS at a time.
+		"""
+		qry = "select stamp, generation, digest, expired from sketch where series_id = %s"
+		params = [sid,]
+		if from_ts is not None:
+			qry += " and stamp >= %s"
+			params.append(arrays.to_datetime(sketch.bucket_of(arrays.to_stamp(from_ts))))
+		if to_ts is not None:
+			qry += " and stamp < %s"
+			params.append(to_ts)
+		rows = self._query(qry + " order by stamp", params).fetchall()
+
+		# Runs of consecutive stale buckets are read together
+		stale = []
+		for i, (stamp, generation, digest, expired) in enumerate(rows):
+			if digest is not None:
+				continue
+			if (stale and stale[-1][-1] == i - 1
+				and len(stale[-1]) < SKETCH_BUILD_BUCKETS):
+				stale[-1].append(i)
+			else:
+				stale.append([i])
+		built = {}
+		for block in stale:
+			data = self._values_array(
+				sid, rows[block[0]][0], arrays.to_datetime(
+					arrays.to_stamp(rows[block[-1]][0]) + sketch.BUCKET_US),
+				lambda sid, run: run(self.db))
+			for i in block:
+				stamp, generation, digest, expired = rows[i]
+				start = arrays.to_stamp(stamp)
+				lo = bisect.bisect_left(data.stamps, start)
+				hi = bisect.bisect_left(data.stamps, start + sketch.BUCKET_US)
+				built[i] = sketch.TDigest.from_values(data.values[lo:hi])
+				if expired is not None:
+					built[i] = sketch.TDigest.merge(
+						[sketch.TDigest.from_bytes(expired), built[i]])
+				# Stored unless the bucket has been written to again
+				# meanwhile
+				self._query(
+					"""update sketch set digest = %s
+					   where series_id = %s and stamp = %s and generation = %s""",
+					(psycopg2.Binary(built[i].to_bytes()), sid, stamp, generation))
+
+		return [(stamp, built[i] if digest is None
+				 else sketch.TDigest.from_bytes(digest))
+				for i, (stamp, generation, digest, expired) in enumerate(rows)]
+
+	def get_summaries(self, sids):
+		"""Return a dict mapping each of the series IDs in sids to a
+		summary of its data: the number of points, the min and max
+		values, the first and last timestamps, and the latest value.
+		Series which don't exist are left out. The summaries are kept
+		up to date as the data is written, so this doesn't read the
+		data itself.
+		"""
+		sids = list(sids)
+		if not sids:
+			return {}
+		cur = self._read(sids, lambda conn: self._execute("get_summaries", [sids], conn))
+		return { r[0]: { "count": r[1],
+						 "min": r[2],
+						 "max": r[3],
+						 "first": r[4],
+						 "last": r[5],
+						 "latest": r[6],
+						 }
+				 for r in cur }
+
 	def add_value(self, sid, ts, value):
 		# FIXME: We should check for data points falling on
 		# appropriate times for the epoch/period for this data point
@@ -118,16 +912,18 @@ class Database(object):
 		# http://stackoverflow.com/questions/1109061/insert-on-duplicate-update-postgresql
 		# for bulk-upload solutions.
 
-		# Ideally, we should use MERGE here, but we can't because psql
-		# doesn't support it yet. So instead, we use a predefined SQL
-		# function as found in the manual: http://www.postgresql.org/docs/current/static/plpgsql-control-structures.html#PLPGSQL-UPSERT-EXAMPLE
-		now = datetime.datetime.now(_UTC)
+		# upsert_data leaves the row alone (and returns null) if it
+		# already holds this value
 		self.db.commit()
 		self.db.autocommit = False
 		try:
-			self._query("select upsert_data(%s, %s, %s, %s)",
-						(sid, ts, now, value))
+			changed = self._execute("upsert_data",
+									(sid, ts, value)).fetchone()[0]
+			if changed and self.notify:
+				self._notify(sid, [arrays.to_stamp(ts)], [value])
 			self.db.commit()
+			if changed:
+				self._wrote(sid)
 			rv = True
 		except psycopg2.DatabaseError as ex:
 			log.error("Failed to insert/update data: id=%s, time=%s, value=%s",
@@ -141,25 +937,235 @@ class Database(object):
 	def get_values(self, sid, from_ts=None, to_ts=None):
 		"""Return a sorted iterator of (ts, value) pairs from the given series
 		"""
-		qry = "select stamp, value from data where series_id = %s"
+		name = "get_values"
+		params = [sid,]
+		if from_ts is not None and to_ts is not None:
+			name = "get_values_range"
+			params += [from_ts, to_ts]
+		elif from_ts is not None:
+			name = "get_values_from"
+			params.append(from_ts)
+		elif to_ts is not None:
+			name = "get_values_to"
+			params.append(to_ts)
+
+		cur = self._read(sid, lambda conn: self._execute(name, params, conn))
+		return ((row[0], row[1]) for row in cur)
+
+	def get_values_array(self, sid, from_ts=None, to_ts=None):
+		"""Return a ValueArray of the data from the given series,
+		sorted by time. The data is fetched with a binary COPY and decoded directly
+		into the arrays, without creating any per-row objects. Null
+		values are returned as NaN.
+		"""
+		return self._values_array(sid, from_ts, to_ts, self._read)
+
+	def get_values_array_primary(self, sid, from_ts=None, to_ts=None):
+		"""As get_values_array(), but read from the primary, which is
+		sure to have every committed write
+		"""
+		return self._values_array(sid, from_ts, to_ts,
+								  lambda sid, run: run(self.db))
+
+	def _values_array(self, sid, from_ts, to_ts, read):
+		"""get_values_array(), reading with read(sid, run), as _read()
+		"""
+		cond = "series_id = %s"
 		params = [sid,]
 		if from_ts is not None:
-			qry += " and stamp >= %s"
+			cond += " and stamp >= %s"
 			params.append(from_ts)
 		if to_ts is not None:
-			qry += " and stamp < %s"
+			cond += " and stamp < %s"
 			params.append(to_ts)
-		qry += " order by stamp"
+		template = """
+			copy (select stamp, coalesce(value, 'NaN')
+				  from data where {0}
+				  order by stamp)
+			to stdout with (format binary)
+			""".format(cond)
 
-		cur = self._query(qry, params)
-		return ((row[0], row[1]) for row in cur)
+		def fetch(conn):
+			buf = _CopyBuffer()
+			self._copy(template, params, buf, conn)
+			return buf
+		buf = read(sid, fetch)
+		with trace.span("decode"):
+			stamps, values = arrays.decode_copy(buf.getvalue())
+		return arrays.ValueArray(stamps, values, sid)
+
+	def add_values_array(self, sid, stamps, values):
+		"""Add or update many data points in one transaction, from
+		arrays of timestamps (in microseconds since the Unix epoch) and
+		values. The data is loaded into a temporary table with a binary
+		COPY, and merged from there. If a timestamp appears more than
+		once, the last value given wins. NaN values are stored as NULL.
+		Points which are already stored with the same value are left
+		alone, so re-sent data costs no writes. Returns a list of the indexes of the points which could
+		not be stored, and the number of points actually written.
+		"""
+		bad, stamps, values = arrays.split_valid(stamps, values)
+		if len(stamps) == 0:
+			return bad, 0
+		with trace.span("encode"):
+			buf = io.BytesIO(arrays.encode_copy(stamps, values))
+
+		self.db.commit()
+		self.db.autocommit = False
+		try:
+			self._query(
+				"""
+				create temporary table if not exists ingest_buffer (
+				  seq bigserial,
+				  stamp timestamp with time zone,
+				  value double precision)
+				on commit delete rows
+				""")
+			self._copy("copy ingest_buffer (stamp, value) from stdin"
+					   " with (format binary)", [], buf)
+			written, first, last = self._query(
+				"""
+				with latest as (
+				  select distinct on (stamp) stamp, nullif(value, 'NaN') as value
+				  from ingest_buffer
+				  order by stamp, seq desc),
+				written as (
+				  insert into data (series_id, stamp, ingest, value)
+				  select %(sid)s, l.stamp, clock_timestamp(), l.value
+				  from latest l
+				  where not exists (
+				    select 1 from data d
+				    where d.series_id = %(sid)s and d.stamp = l.stamp
+				      and d.value is not distinct from l.value)
+				  on conflict (series_id, stamp)
+				  do update set ingest=excluded.ingest, value=excluded.value
+				  where data.value is distinct from excluded.value
+				  returning stamp)
+				select count(*), min(stamp), max(stamp) from written
+				""", { "sid": sid }).fetchone()
+			if written and self.notify:
+				if written == len(stamps):
+					self._notify(sid, stamps, values)
+				else:
+					# Only some points changed: announce their range
+					self._notify(sid, [arrays.to_stamp(first), arrays.to_stamp(last)],
+								 [None, None], force_range=True)
+			self.db.commit()
+			if written:
+				self._wrote(sid)
+		except psycopg2.DatabaseError as ex:
+			log.error("Failed to insert/update %d data points: id=%s",
+					  len(stamps), sid, exc_info=ex)
+			self.db.rollback()
+			bad = list(range(len(stamps) + len(bad)))
+			written = 0
+
+		self.db.autocommit = True
+		return bad, written
+
+	def get_changes(self, sid=None, since=None, limit=None,
+					settle=datetime.timedelta(seconds=5)):
+		"""Return the points of a series (or of all series) written
+		after the Watermark since, and at least settle ago. Returns a
+		dict mapping series IDs to ValueArrays, and the Watermark to
+		pass in next time. At most limit points are returned.
+		"""
+		if since is None:
+			since = watermark.Watermark(0)
+		horizon = self.horizon(settle)
+		rows = self.change_rows(sid, since, limit, horizon)
+		return (watermark.group(rows),
+				watermark.next_watermark(since, rows, limit, horizon))
+
+	def horizon(self, settle):
+		"""Return the latest ingest time which get_changes() may return,
+		given the settle lag as a timedelta. Ingest times are taken
+		from the database's clock as each point is written, so a
+		transaction still writing may yet commit points stamped as
+		early as its start: the horizon is held back to before the
+		oldest such transaction.
+		"""
+		return self._query(HORIZON_SQL, (settle,)).fetchone()[0]
+
+	def change_rows(self, sid, since, limit, horizon):
+		"""Return the (ingest, sid, stamp, value) rows for get_changes(),
+		in order, for points written up to the horizon
+		"""
+		params = list(since.key()) + [horizon]
+		cond = """(ingest, series_id, stamp) > (%s, %s, %s)
+				  and ingest <= %s"""
+		lim = ""
+		if limit is not None:
+			lim = " limit {0:d}".format(limit)
+
+		if sid is not None:
+			cur = self._query(
+				"""
+				select ingest, series_id, stamp, value from data
+				where series_id = %s and {0}
+				order by ingest, series_id, stamp{1}
+				""".format(cond, lim), [sid] + params)
+		else:
+			# Walk the (series_id, ingest) index for each series
+			cur = self._query(
+				"""
+				select d.* from series s cross join lateral (
+				  select ingest, series_id, stamp, value from data
+				  where series_id = s.id and {0}
+				  order by ingest, stamp{1}) d
+				order by d.ingest, d.series_id, d.stamp{1}
+				""".format(cond, lim), params)
+		return cur.fetchall()
+
+	def export(self, sid=None, from_ts=None, to_ts=None,
+			   chunk_size=EXPORT_CHUNK_SIZE, sids=None):
+		"""Return an iterator of chunks of CSV text (as bytes), with a
+		header line and one (series, time, value) line per data
+		point, for the given series (or all series, or those in the
+		list sids), sorted by series and time. The rows are never
+		turned into Python objects: the output of COPY TO STDOUT is
+		streamed straight through from a separate connection.
+		"""
+		cond = ["true"]
+		params = []
+		if sid is not None:
+			cond.append("series_id = %s")
+			params.append(sid)
+		if sids is not None:
+			cond.append("series_id = any(%s)")
+			params.append(list(sids))
+		if from_ts is not None:
+			cond.append("stamp >= %s")
+			params.append(from_ts)
+		if to_ts is not None:
+			cond.append("stamp < %s")
+			params.append(to_ts)
+		template = EXPORT_SQL.format(" and ".join(cond))
+
+		conn = psycopg2.connect(**self.db_params)
+		conn.autocommit = True
+		try:
+			sql = conn.cursor().mogrify(template, params).decode("utf8")
+		except:
+			conn.close()
+			raise
+		return _CopyStream(conn, sql, template, chunk_size)
 
 	def _wipe(self):
 		"""Internal method used by test suite
 		"""
 		self._query("drop table data")
+		self._query("drop table rollup")
+		self._query("drop table summary")
+		self._query("drop table sketch")
 		self._query("drop table series")
 		self._query("drop table version")
+		self._query("""drop function if exists upsert_data(
+						 integer, timestamp with time zone,
+						 timestamp with time zone, double precision)""")
+		for fn in ("summary_insert()", "summary_update()", "summary_delete()",
+				   "summary_recompute(integer)", "sketch_stale()"):
+			self._query("drop function if exists " + fn)
 		# For psql < 9.1
 		#self._query("drop language plpgsql cascade")
 		# For psql >= 9.1
@@ -182,13 +1188,162 @@ class Database(object):
 		row = res.fetchone()
 		return row[0]
 
-	def _query(self, sql, params=[]):
+	def _execute(self, name, params, conn=None):
+		"""Run one of the PREPARED statements, by name, preparing it on
+		the connection (by default, the current thread's) first if need
+		be
+		"""
+		if not self.prepare:
+			return self._query(PREPARED[name], params, conn)
+		if conn is None:
+			conn = self.db
+		if name not in conn.prepared:
+			self._query("prepare {0} as {1}".format(name, _numbered(PREPARED[name])),
+						conn=conn)
+			conn.prepared.add(name)
+		return self._query(
+			"execute {0} ({1})".format(name, ", ".join(["%s"] * len(params))),
+			params, conn)
+
+	def _query(self, sql, params=[], conn=None):
 		"""Perform a query, returning the cursor with results in it.
+		The query is run on conn, or by default the current thread's
+		connection.
 		"""
-		cur = self.db.cursor()
+		if conn is None:
+			conn = self.db
+		cur = conn.cursor()
+		start = time.perf_counter()
 		cur.execute(sql, params)
+		elapsed = time.perf_counter() - start
+		metrics.account_db(elapsed, cur.rowcount)
+		trace.add("db", start, elapsed)
+		STATS.record(sql, elapsed, cur.rowcount)
+		if self.slow_query is not None and elapsed >= self.slow_query:
+			self._log_slow(sql, params, elapsed, cur.rowcount)
+		return cur
+
+	def _notify(self, sid, stamps, values, force_range=False):
+		"""Announce new data on the NOTIFY channel. The notification is
+		sent when the transaction commits. A small batch is sent in
+		full; for a larger one (or if force_range is set), only its
+		time range is sent. NULL (None or NaN) values are sent as
+		nulls. Nothing is sent if no listener is connected.
+		"""
+		if len(stamps) <= NOTIFY_MAX_POINTS and not force_range:
+			payload = { "s": sid,
+						"p": [[int(t), None if v is None or v != v else float(v)]
+							  for t, v in zip(stamps, values)] }
+		else:
+			payload = { "s": sid, "r": [int(min(stamps)), int(max(stamps))] }
+		# A notification serialises the commits of all notifying
+		# transactions, so is only sent if someone will receive it
+		if self._heard():
+			self._query("select pg_notify(%s, %s)",
+						(NOTIFY_CHANNEL, json.dumps(payload, separators=(",", ":"))))
+
+	def _heard(self):
+		"""Return whether anyone is listening for notifications
+		"""
+		if self.listening:
+			return True
+		now = time.monotonic()
+		if now - self.listeners_checked >= LISTENER_CHECK:
+			self.listeners_checked = now
+			self.listeners = self._query(
+				"""
+				select exists (select 1 from pg_stat_activity
+							   where datname = current_database()
+								 and application_name = %s)
+				""", (LISTEN_APPLICATION,)).fetchone()[0]
+		return self.listeners
+
+	def listen(self, callback):
+		"""Start a thread which listens for notifications of new data,
+		and calls callback(sid, ValueArray) for each. The thread has
+		its own connection, and reconnects if it is lost.
+		"""
+		self.listening = True
+		thread = threading.Thread(target=self._listen, args=(callback,),
+								  name="listen", daemon=True)
+		thread.start()
+		return thread
+
+	def _listen(self, callback):
+		while True:
+			try:
+				conn = psycopg2.connect(
+					**dict(self.db_params, application_name=LISTEN_APPLICATION))
+				conn.autocommit = True
+				conn.cursor().execute("listen " + NOTIFY_CHANNEL)
+				log.info("Listening for new data")
+				while True:
+					if select.select([conn], [], [], 5.0)[0]:
+						conn.poll()
+						while conn.notifies:
+							self._dispatch(conn.notifies.pop(0).payload, callback)
+			except Exception as ex:
+				log.error("Listener failed; reconnecting", exc_info=ex)
+				time.sleep(1.0)
+
+	def _dispatch(self, payload, callback):
+		msg = json.loads(payload)
+		sid = msg["s"]
+		if "p" in msg:
+			data = arrays.from_points([(t, v) for t, v in msg["p"]], sid)
+		else:
+			first, last = msg["r"]
+			# Only the primary is sure to have the new data yet
+			data = self.get_values_array_primary(sid, arrays.to_datetime(first),
+												 arrays.to_datetime(last + 1))
+			self.release()
+		callback(sid, data)
+
+	def _copy(self, sql, params, f, conn=None):
+		"""Run a COPY statement, reading from or writing to the
+		file-like object f
+		"""
+		if conn is None:
+			conn = self.db
+		cur = conn.cursor()
+		start = time.perf_counter()
+		cur.copy_expert(cur.mogrify(sql, params).decode("utf8"), f)
+		elapsed = time.perf_counter() - start
+		metrics.account_db(elapsed, cur.rowcount)
+		trace.add("db", start, elapsed)
+		STATS.record(sql, elapsed, cur.rowcount)
 		return cur
 
+	def _log_slow(self, sql, params, elapsed, rows):
+		"""Log a slow statement, and (on a sampled basis) its query
+		plan.
+		"""
+		slow_log.warning("%.1f ms, %d rows: %s %s", elapsed * 1000, rows,
+						 STATS.template(sql), repr(params)[:200])
+		if self.explain_rate <= 0 or random.random() >= self.explain_rate:
+			return
+		# EXPLAIN ANALYZE executes the statement again, so we run it in
+		# a transaction which is rolled back afterwards. If we're
+		# already in a transaction, we can't do that safely.
+		if not self.db.autocommit:
+			return
+		self.db.autocommit = False
+		try:
+			cur = self.db.cursor()
+			cur.execute("explain (analyze, buffers) " + sql, params)
+			plan = "\n".join(row[0] for row in cur)
+			slow_log.warning("Plan for %s:\n%s", STATS.template(sql), plan)
+		except psycopg2.DatabaseError as ex:
+			slow_log.info("Could not explain %s: %s", STATS.template(sql), ex)
+		finally:
+			self.db.rollback()
+			self.db.autocommit = True
+
+	def query_stats(self):
+		"""Return the per-statement query statistics for this process
+		"""
+		return STATS.summary()
+
 	def _upgrade(self, from_ver):
 		"""Upgrade a database from an earlier version of the DB
 		structure. If from_ver is 0, create the structure from
@@ -263,16 +1418,442 @@ class Database(object):
 			except psycopg2.DatabaseError as ex:
 				log.error("Failed to create database structure", exc_info=ex)
 				self.db.rollback()
+				self.db.autocommit = True
+				return 0
 
 			self.db.autocommit = True
+			from_ver = 1
 
-			return 0
+		if from_ver <= 1:
+			"""Upgrade from version 1 tables to version 2: index the
+			ingest times, for incremental sync
+			"""
+			log.info("Upgrading database structure to version 2")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute(
+					"""
+					create index data_series_ingest
+					on data (series_id, ingest)
+					""")
+				cur.execute("update version set version = 2")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 1
+
+			self.db.autocommit = True
+			from_ver = 2
+
+		if from_ver <= 2:
+			"""Upgrade from version 2 tables to version 3: don't
+			rewrite rows whose value hasn't changed
+			"""
+			log.info("Upgrading database structure to version 3")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute(
+					"""
+					drop function upsert_data(
+						integer, timestamp with time zone,
+						timestamp with time zone, double precision)
+					""")
+				cur.execute(
+					"""
+					create function upsert_data(
+						sid integer,
+						datatime timestamp with time zone,
+						ingesttime timestamp with time zone,
+						datavalue double precision)
+					returns boolean as
+					$$
+						insert into data (series_id, stamp, ingest, value)
+						values (sid, datatime, ingesttime, datavalue)
+						on conflict (series_id, stamp)
+						do update set ingest=excluded.ingest,
+									  value=excluded.value
+						where data.value is distinct from excluded.value
+						returning true
+					$$
+					language sql;
+					""")
+				cur.execute("update version set version = 3")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 2
+
+			self.db.autocommit = True
+			from_ver = 3
+
+		if from_ver <= 3:
+			"""Upgrade from version 3 tables to version 4: per-series
+			retention of raw data, and rolled-up summaries of the
+			data past it
+			"""
+			log.info("Upgrading database structure to version 4")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute("alter table series add column retention interval")
+				cur.execute(
+					"""
+					create table rollup (
+					  series_id integer references series (id)
+					    on delete cascade,
+					  stamp timestamp with time zone,
+					  count integer,
+					  min double precision,
+					  max double precision,
+					  mean double precision,
+					  primary key (series_id, stamp))
+					""")
+				cur.execute("update version set version = 4")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 3
+
+			self.db.autocommit = True
+			from_ver = 4
+
+		if from_ver <= 4:
+			"""Upgrade from version 4 tables to version 5: index the
+			series catalogue for searching. The trigram index (for
+			substring matches on names) needs the pg_trgm extension;
+			without it, only prefix matches are indexed.
+			"""
+			log.info("Upgrading database structure to version 5")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute("savepoint trgm")
+				try:
+					cur.execute("create extension if not exists pg_trgm")
+					cur.execute(
+						"""
+						create index series_name_trgm
+						on series using gin (name gin_trgm_ops)
+						""")
+				except psycopg2.DatabaseError as ex:
+					log.warning("pg_trgm is not available, so series name"
+								" searches will not be indexed: %s", ex)
+					cur.execute("rollback to savepoint trgm")
+				cur.execute(
+					"""
+					create index series_name_prefix
+					on series (lower(name) text_pattern_ops, id)
+					""")
+				cur.execute("create index series_period on series (period, id)")
+				cur.execute("create index series_type on series (ts_type, id)")
+				cur.execute("update version set version = 5")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 4
+
+			self.db.autocommit = True
+			from_ver = 5
+
+		if from_ver <= 5:
+			"""Upgrade from version 5 tables to version 6: record which
+			shard holds each series, for the sharded backend (whose
+			catalogue database is the only one to use it)
+			"""
+			log.info("Upgrading database structure to version 6")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute("alter table series add column shard integer")
+				cur.execute("update version set version = 6")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 5
+
+			self.db.autocommit = True
+			from_ver = 6
 
-		#if from_ver <= 1:
-		#	"""Upgrade from version 1 tables to (current|next) version
+		if from_ver <= 6:
+			"""Upgrade from version 6 tables to version 7: keep a summary
+			of each series (count, min, max, first and last times, and
+			latest value), maintained by statement-level triggers on
+			the data table, so that every way of writing or deleting
+			data keeps it up to date. An overwrite or delete of a
+			series' current min or max (or first or last point) has
+			them worked out again from the data.
+			"""
+			log.info("Upgrading database structure to version 7")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute(
+					"""
+					create table summary (
+					  series_id integer primary key
+								references series (id)
+								on delete cascade
+								on update cascade,
+					  count bigint not null,
+					  min double precision,
+					  max double precision,
+					  first timestamp with time zone,
+					  last timestamp with time zone,
+					  latest double precision)
+					""")
+				cur.execute(
+					"""
+					create function summary_recompute(sid integer)
+					returns void as
+					$$
+					  update summary set
+						min = (select min(value) from data
+							   where series_id = sid and value <> 'NaN'),
+						max = (select max(value) from data
+							   where series_id = sid and value <> 'NaN')
+					  where series_id = sid;
+					$$
+					language sql
+					""")
+				cur.execute(
+					"""
+					create function summary_insert() returns trigger as
+					$$
+					begin
+					  insert into summary (series_id, count, min, max,
+										   first, last, latest)
+					  select series_id, count(*),
+							 min(value) filter (where value <> 'NaN'),
+							 max(value) filter (where value <> 'NaN'),
+							 min(stamp), max(stamp),
+							 (array_agg(value order by stamp desc))[1]
+					  from new_rows group by series_id
+					  on conflict (series_id) do update set
+						count = summary.count + excluded.count,
+						min = least(summary.min, excluded.min),
+						max = greatest(summary.max, excluded.max),
+						first = least(summary.first, excluded.first),
+						last = greatest(summary.last, excluded.last),
+						latest = case when summary.last is null
+										   or excluded.last >= summary.last
+									  then excluded.latest
+									  else summary.latest end;
+					  return null;
+					end;
+					$$
+					language plpgsql
+					""")
+				cur.execute(
+					"""
+					create function summary_update() returns trigger as
+					$$
+					begin
+					  update summary m set latest = n.value
+					  from new_rows n
+					  where n.series_id = m.series_id and n.stamp = m.last;
+					  perform summary_recompute(c.series_id) from (
+						select distinct o.series_id
+						from old_rows o
+						join new_rows n using (series_id, stamp)
+						join summary m using (series_id)
+						where o.value is distinct from n.value
+						  and (o.value = m.min or o.value = m.max)) c;
+					  update summary m set min = least(m.min, u.min),
+										   max = greatest(m.max, u.max)
+					  from (select series_id,
+								   min(value) filter (where value <> 'NaN') as min,
+								   max(value) filter (where value <> 'NaN') as max
+							from new_rows group by series_id) u
+					  where u.series_id = m.series_id;
+					  return null;
+					end;
+					$$
+					language plpgsql
+					""")
+				cur.execute(
+					"""
+					create function summary_delete() returns trigger as
+					$$
+					begin
+					  update summary m set count = m.count - d.count
+					  from (select series_id, count(*) as count
+							from old_rows group by series_id) d
+					  where d.series_id = m.series_id;
+					  update summary m set
+						first = (select min(stamp) from data
+								 where series_id = m.series_id),
+						last = l.stamp,
+						latest = l.value
+					  from (select c.series_id, d.stamp, d.value
+							from (select distinct o.series_id
+								  from old_rows o join summary m2 using (series_id)
+								  where o.stamp = m2.first or o.stamp = m2.last) c
+							left join lateral (
+							  select stamp, value from data
+							  where series_id = c.series_id
+							  order by stamp desc limit 1) d on true) l
+					  where l.series_id = m.series_id;
+					  perform summary_recompute(c.series_id) from (
+						select distinct o.series_id
+						from old_rows o join summary m using (series_id)
+						where o.value = m.min or o.value = m.max) c;
+					  return null;
+					end;
+					$$
+					language plpgsql
+					""")
+				cur.execute(
+					"""
+					create trigger data_summary_insert after insert on data
+					referencing new table as new_rows
+					for each statement execute procedure summary_insert()
+					""")
+				cur.execute(
+					"""
+					create trigger data_summary_update after update on data
+					referencing old table as old_rows new table as new_rows
+					for each statement execute procedure summary_update()
+					""")
+				cur.execute(
+					"""
+					create trigger data_summary_delete after delete on data
+					referencing old table as old_rows
+					for each statement execute procedure summary_delete()
+					""")
+				cur.execute(
+					"""
+					insert into summary (series_id, count, min, max,
+										 first, last, latest)
+					select a.series_id, a.count, a.min, a.max,
+						   a.first, a.last, l.value
+					from (select series_id, count(*) as count,
+								 min(value) filter (where value <> 'NaN') as min,
+								 max(value) filter (where value <> 'NaN') as max,
+								 min(stamp) as first, max(stamp) as last
+						  from data group by series_id) a
+					join (select distinct on (series_id) series_id, value
+						  from data order by series_id, stamp desc) l
+					  using (series_id)
+					""")
+				cur.execute("update version set version = 7")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 6
+
+			self.db.autocommit = True
+			from_ver = 7
+
+		if from_ver <= 7:
+			"""Upgrade from version 7 tables to version 8: keep a
+			quantile sketch of each day (sketch.BUCKET) of each series'
+			data. A trigger marks a day's sketch stale (clearing it and
+			bumping its generation) whenever data in it is written;
+			get_sketches() builds the stale ones again from the data.
+			Deleting data leaves the sketches alone, so that they
+			outlive expired data.
+			"""
+			log.info("Upgrading database structure to version 8")
+			self.db.autocommit = False
+			bucket = "to_timestamp(floor(extract(epoch from stamp) / {0}) * {0})".format(
+				int(sketch.BUCKET.total_seconds()))
+			try:
+				cur = self.db.cursor()
+				cur.execute(
+					"""
+					create table sketch (
+					  series_id integer not null
+								references series (id)
+								on delete cascade
+								on update cascade,
+					  stamp timestamp with time zone not null,
+					  generation integer not null default 0,
+					  digest bytea,
+					  primary key (series_id, stamp))
+					""")
+				cur.execute(
+					"""
+					create function sketch_stale() returns trigger as
+					$$
+					begin
+					  insert into sketch (series_id, stamp)
+					  select distinct series_id, {0} from new_rows
+					  on conflict (series_id, stamp) do update set
+						digest = null,
+						generation = sketch.generation + 1;
+					  return null;
+					end;
+					$$
+					language plpgsql
+					""".format(bucket))
+				cur.execute(
+					"""
+					create trigger data_sketch_insert after insert on data
+					referencing new table as new_rows
+					for each statement execute procedure sketch_stale()
+					""")
+				cur.execute(
+					"""
+					create trigger data_sketch_update after update on data
+					referencing new table as new_rows
+					for each statement execute procedure sketch_stale()
+					""")
+				cur.execute(
+					"""
+					insert into sketch (series_id, stamp)
+					select distinct series_id, {0} from data
+					""".format(bucket))
+				cur.execute("update version set version = 8")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 7
+
+			self.db.autocommit = True
+			from_ver = 8
+
+		if from_ver <= 8:
+			"""Upgrade from version 8 tables to version 9: keep, with
+			each sketch, the digest of the data in its bucket which has
+			been expired, so that a sketch built again (after a late
+			write) still covers it
+			"""
+			log.info("Upgrading database structure to version 9")
+			self.db.autocommit = False
+			try:
+				cur = self.db.cursor()
+				cur.execute("alter table sketch add column expired bytea")
+				cur.execute("update version set version = 9")
+				self.db.commit()
+			except psycopg2.DatabaseError as ex:
+				log.error("Failed to upgrade database structure", exc_info=ex)
+				self.db.rollback()
+				self.db.autocommit = True
+				return 8
+
+			self.db.autocommit = True
+			from_ver = 9
+
+		#if from_ver <= 9:
+		#	"""Upgrade from version 9 tables to (current|next) version
 		#	"""
 		#	from_ver += 1
-		#
-		#if from_ver <= 2:
-		#	pass
 		# etc...
+
+		return from_ver
@@ -0,0 +1,516 @@
+"""Sharded database interface object. Each series is stored on one of
+several PostgreSQL databases (the shards); the list of series, and
+which shard each one is on, is kept in a catalogue database. Work on a
+single series goes to its shard. Queries across all series are run
+on every shard in parallel, and their results merged.
+
+A new series is placed by rendezvous hashing of its ID over the
+shards, so that adding a shard only draws new series to it. Existing
+series stay where the catalogue says they are until they are moved
+with move_series() (see fuse.rebalance), which can be done while the
+servers are running. Series created before sharding was enabled have
+no shard in the catalogue, and stay on the catalogue database (which
+is used as an extra shard if it isn't one of the configured ones)
+until they are moved.
+"""
+
+import logging
+import datetime
+import time
+import struct
+import zlib
+import heapq
+import concurrent.futures
+
+import psycopg2
+import psycopg2.extras
+
+import fuse.arrays as arrays
+import fuse.db_psql as db_psql
+import fuse.watermark as watermark
+
+_UTC = datetime.timezone.utc
+
+log = logging.getLogger("db_sharded")
+
+# A series not in the cached shard map causes the map to be reloaded,
+# but no more often than every MAP_RELOAD_MIN seconds
+MAP_RELOAD_MIN = 1.0
+
+# When a series is moved, writes to the old shard are looked for back
+# to this long before the copy started, since a write takes its
+# ingest time before it commits
+MOVE_MARGIN = datetime.timedelta(seconds=60)
+
+EXPORT_HEADER = b"series,time,value\n"
+
+# Points copied to a shard keep their ingest times; where the point is
+# there already, the later write wins
+COPY_POINTS_SQL = """
+	insert into data (series_id, stamp, ingest, value) values %s
+	on conflict (series_id, stamp)
+	do update set ingest=excluded.ingest, value=excluded.value
+	where data.ingest is null or data.ingest < excluded.ingest
+	"""
+
+def place(sid, nshards):
+	"""Return the shard on which a new series is placed: the one giving
+	the highest hash of (series, shard)
+	"""
+	return max(range(nshards),
+			   key=lambda i: zlib.crc32(struct.pack("<ii", sid, i)))
+
+class _ShardConf(object):
+	"""The configuration, with a shard's connection parameters in
+	place of db_params. Shards have no read replicas.
+	"""
+	def __init__(self, conf, params):
+		self.conf = conf
+		self.db_params = params
+		self.db_replicas = []
+
+	def __getattr__(self, name):
+		return getattr(self.conf, name)
+
+def _lines(stream):
+	"""Yield the lines of a CSV export, after its header
+	"""
+	rest = b""
+	header = True
+	for chunk in stream:
+		lines = (rest + chunk).split(b"\n")
+		rest = lines.pop()
+		for line in lines:
+			if header:
+				header = False
+				continue
+			yield line + b"\n"
+
+def _series_of(line):
+	return int(line[:line.index(b",")])
+
+class _MergedExport(object):
+	"""Iterator merging the CSV exports of several shards into one,
+	sorted by series. Each series is on one shard, so its points stay
+	in time order.
+	"""
+	def __init__(self, streams, chunk_size):
+		self.streams = streams
+		self.chunk_size = chunk_size
+		self.chunks = self._merge()
+
+	def _merge(self):
+		buf = [EXPORT_HEADER]
+		size = len(EXPORT_HEADER)
+		for line in heapq.merge(*[_lines(s) for s in self.streams],
+								key=_series_of):
+			buf.append(line)
+			size += len(line)
+			if size >= self.chunk_size:
+				yield b"".join(buf)
+				buf = []
+				size = 0
+		if buf:
+			yield b"".join(buf)
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return next(self.chunks)
+
+	def close(self):
+		for stream in self.streams:
+			stream.close()
+
+class Database(object):
+	def __init__(self, conf):
+		# db_params is the catalogue; it may also be one of the shards
+		self.catalogue = db_psql.Database(conf)
+		self.shards = []
+		for params in getattr(conf, "db_shards", []):
+			if params == conf.db_params:
+				self.shards.append(self.catalogue)
+			else:
+				self.shards.append(db_psql.Database(_ShardConf(conf, params)))
+		if not self.shards:
+			self.shards.append(self.catalogue)
+		# New series are placed over the configured shards only
+		self.placed = len(self.shards)
+		if self.catalogue not in self.shards:
+			self.shards.append(self.catalogue)
+		self.home = self.shards.index(self.catalogue)
+
+		# The shard map (series ID -> shard index) is cached for
+		# shard_map_seconds, so a series moved by another process is
+		# found on its new shard within that time
+		self.map_ttl = getattr(conf, "shard_map_seconds", 10)
+		self.placement = {}
+		self.loaded = None
+		self.workers = concurrent.futures.ThreadPoolExecutor(
+			max_workers=len(self.shards), thread_name_prefix="shard")
+		# Notifications can be relied on once every shard's can
+		self.notify_delay = max(shard.notify_delay for shard in self.shards)
+
+	def _load_map(self):
+		# A series without a shard predates sharding: it's on the
+		# catalogue
+		rows = self.catalogue._query(
+			"select id, coalesce(shard, %s) from series", (self.home,)).fetchall()
+		self.placement = dict(rows)
+		self.loaded = time.monotonic()
+
+	def _fresh_map(self):
+		"""Return the shard map, reloading it if it has expired
+		"""
+		if self.loaded is None or time.monotonic() - self.loaded >= self.map_ttl:
+			self._load_map()
+		return self.placement
+
+	def shard_of(self, sid):
+		"""Return the index of the shard holding series sid, or None if
+		there is no such series
+		"""
+		shard = self._fresh_map().get(sid)
+		if shard is None and time.monotonic() - self.loaded >= MAP_RELOAD_MIN:
+			# Perhaps a series created by another process
+			self._load_map()
+			shard = self.placement.get(sid)
+		return shard
+
+	def _shard(self, sid):
+		idx = self.shard_of(sid)
+		if idx is None:
+			return None
+		return self.shards[idx]
+
+	def _scatter(self, run):
+		"""Call run(shard) for every shard in parallel, and return the
+		list of results
+		"""
+		def task(shard):
+			try:
+				return run(shard)
+			finally:
+				shard.release()
+		return list(self.workers.map(task, self.shards))
+
+	def release(self):
+		"""Release the current thread's connections for reuse
+		"""
+		self.catalogue.release()
+		for shard in self.shards:
+			if shard is not self.catalogue:
+				shard.release()
+
+	def create_series(self,
+					  name,
+					  period,
+					  epoch=datetime.datetime(1970, 1, 1, tzinfo=_UTC),
+					  ts_type="point",
+					  unit="",
+					  get_limit=1000,
+					  description="",
+					  retention=None):
+		"""Create a time-series in the catalogue, and on the shard it is
+		placed on. Return the ID of the series created.
+		"""
+		sid = self.catalogue.create_series(name, period, epoch, ts_type, unit,
+										   get_limit, description, retention)
+		if sid is None:
+			return None
+		idx = place(sid, self.placed)
+		try:
+			self._copy_series(sid, self.shards[idx])
+			self.catalogue._query("update series set shard=%s where id=%s",
+								  (idx, sid))
+		except psycopg2.DatabaseError as ex:
+			log.error("Series creation on shard %d failed: id=%s", idx, sid,
+					  exc_info=ex)
+			self.catalogue.drop_series(sid)
+			return None
+		self.placement[sid] = idx
+		return sid
+
+	def _copy_series(self, sid, shard):
+		"""Copy a series' catalogue entry to a shard
+		"""
+		if shard is self.catalogue:
+			return
+		row = self.catalogue._query(
+			"select " + db_psql.SERIES_COLUMNS + " from series where id=%s",
+			(sid,)).fetchone()
+		shard._query(
+			"insert into series (" + db_psql.SERIES_COLUMNS + ") values %s"
+			" on conflict (id) do nothing", (tuple(row),))
+
+	def drop_series(self, sid):
+		"""Drop a time-series with the given series ID.
+		"""
+		shard = self._shard(sid)
+		if shard is not None and shard is not self.catalogue:
+			shard.drop_series(sid)
+		self.catalogue.drop_series(sid)
+		self.placement.pop(sid, None)
+
+	def list_series(self, sid=None, period=None, ts_type=None, name=None,
+					prefix=None, after=None, limit=None):
+		"""List the available time-series, from the catalogue
+		"""
+		return self.catalogue.list_series(sid, period, ts_type, name,
+										  prefix, after, limit)
+
+	def is_series(self, sid):
+		"""Check whether sid is a series
+		"""
+		return self.catalogue.is_series(sid)
+
+	def set_retention(self, sid, retention):
+		"""Set how long a series' raw data is kept. Returns False if
+		there is no such series.
+		"""
+		if not self.catalogue.set_retention(sid, retention):
+			return False
+		shard = self._shard(sid)
+		if shard is not None and shard is not self.catalogue:
+			shard.set_retention(sid, retention)
+		return True
+
+	def try_lock(self, key):
+		return self.catalogue.try_lock(key)
+
+	def unlock(self, key):
+		self.catalogue.unlock(key)
+
+	def count_expired(self, sid, before):
+		shard = self._shard(sid)
+		if shard is None:
+			return 0
+		return shard.count_expired(sid, before)
+
+	def expire(self, sid, before, bucket, limit):
+		shard = self._shard(sid)
+		if shard is None:
+			return 0
+		return shard.expire(sid, before, bucket, limit)
+
+	def get_rollup(self, sid, from_ts=None, to_ts=None):
+		shard = self._shard(sid)
+		if shard is None:
+			return []
+		return shard.get_rollup(sid, from_ts, to_ts)
+
+	def get_sketches(self, sid, from_ts=None, to_ts=None):
+		shard = self._shard(sid)
+		if shard is None:
+			return []
+		return shard.get_sketches(sid, from_ts, to_ts)
+
+	def get_summaries(self, sids):
+		"""Return the summaries of the given series, fetched from their
+		shards in parallel
+		"""
+		owned = [[] for shard in self.shards]
+		for sid in sids:
+			idx = self.shard_of(sid)
+			if idx is not None:
+				owned[idx].append(sid)
+		rv = {}
+		for part in self._scatter(
+				lambda shard: shard.get_summaries(owned[self.shards.index(shard)])):
+			rv.update(part)
+		return rv
+
+	def add_value(self, sid, ts, value):
+		shard = self._shard(sid)
+		if shard is None:
+			log.error("Failed to insert/update data: no such series: id=%s", sid)
+			return False
+		return shard.add_value(sid, ts, value)
+
+	def add_values_array(self, sid, stamps, values):
+		shard = self._shard(sid)
+		if shard is None:
+			log.error("Failed to insert/update %d data points: no such series:"
+					  " id=%s", len(stamps), sid)
+			return list(range(len(stamps))), 0
+		return shard.add_values_array(sid, stamps, values)
+
+	def get_values(self, sid, from_ts=None, to_ts=None):
+		shard = self._shard(sid)
+		if shard is None:
+			return iter(())
+		return shard.get_values(sid, from_ts, to_ts)
+
+	def get_values_array(self, sid, from_ts=None, to_ts=None):
+		shard = self._shard(sid)
+		if shard is None:
+			return arrays.from_points([], sid)
+		return shard.get_values_array(sid, from_ts, to_ts)
+
+	def get_values_array_primary(self, sid, from_ts=None, to_ts=None):
+		shard = self._shard(sid)
+		if shard is None:
+			return arrays.from_points([], sid)
+		return shard.get_values_array_primary(sid, from_ts, to_ts)
+
+	def get_changes(self, sid=None, since=None, limit=None,
+					settle=datetime.timedelta(seconds=5)):
+		"""As db_psql.Database.get_changes(). Changes to all series are
+		fetched from every shard in parallel, and merged.
+		"""
+		if since is None:
+			since = watermark.Watermark(0)
+		# The earliest of the shards' horizons holds for all of them
+		horizon = min(self._scatter(lambda shard: shard.horizon(settle)))
+		if sid is not None:
+			shard = self._shard(sid)
+			rows = []
+			if shard is not None:
+				rows = shard.change_rows(sid, since, limit, horizon)
+		else:
+			parts = self._scatter(
+				lambda shard: shard.change_rows(None, since, limit, horizon))
+			rows = []
+			last = None
+			for row in heapq.merge(*parts, key=lambda r: r[:3]):
+				# A series being moved has its points on two shards
+				if row[:3] == last:
+					continue
+				last = row[:3]
+				rows.append(row)
+				if limit is not None and len(rows) >= limit:
+					break
+		return (watermark.group(rows),
+				watermark.next_watermark(since, rows, limit, horizon))
+
+	def export(self, sid=None, from_ts=None, to_ts=None,
+			   chunk_size=db_psql.EXPORT_CHUNK_SIZE):
+		"""As db_psql.Database.export(). An export of all series is
+		streamed from every shard at once (each shard exporting only
+		the series the catalogue places on it), and merged.
+		"""
+		if sid is not None:
+			shard = self._shard(sid)
+			if shard is None:
+				shard = self.catalogue
+			return shard.export(sid, from_ts, to_ts, chunk_size)
+		owned = [[] for shard in self.shards]
+		for s, idx in self._fresh_map().items():
+			owned[idx].append(s)
+		streams = []
+		try:
+			for shard, sids in zip(self.shards, owned):
+				streams.append(shard.export(None, from_ts, to_ts, chunk_size,
+											sids=sids))
+		except:
+			for stream in streams:
+				stream.close()
+			raise
+		return _MergedExport(streams, chunk_size)
+
+	def listen(self, callback):
+		"""Listen for new data on every shard
+		"""
+		return [shard.listen(callback) for shard in self.shards]
+
+	def query_stats(self):
+		return self.catalogue.query_stats()
+
+	def move_series(self, sid, target, batch_size=10000, wait=None):
+		"""Move a series to another shard, while it is in use. Its
+		points are copied across in batches, and the catalogue switched
+		to the new shard. Then, once every process's cached shard map
+		has expired (after wait seconds, by default the cache
+		lifetime), anything written to the old shard meanwhile is
+		copied too, and the old copy deleted. Returns the number of
+		points copied.
+		"""
+		self._load_map()
+		src = self.placement.get(sid)
+		if src is None:
+			raise KeyError("No such series: {0}".format(sid))
+		if src == target:
+			return 0
+		old, new = self.shards[src], self.shards[target]
+		if wait is None:
+			wait = self.map_ttl
+
+		log.info("Moving series %s from shard %d to shard %d", sid, src, target)
+		start = datetime.datetime.now(_UTC) - MOVE_MARGIN
+		self._copy_series(sid, new)
+		copied = self._copy_points(sid, old, new, batch_size)
+		rollup = old._query(
+			"""select series_id, stamp, count, min, max, mean from rollup
+			   where series_id = %s""", (sid,)).fetchall()
+		if rollup:
+			psycopg2.extras.execute_values(
+				new.db.cursor(),
+				"""insert into rollup (series_id, stamp, count, min, max, mean)
+				   values %s on conflict (series_id, stamp) do nothing""", rollup)
+		# Current sketches, and the digests of expired data, replace
+		# the stale ones the copy has left
+		sketches = old._query(
+			"""select series_id, stamp, digest, expired from sketch
+			   where series_id = %s
+				 and (digest is not null or expired is not null)""",
+			(sid,)).fetchall()
+		if sketches:
+			psycopg2.extras.execute_values(
+				new.db.cursor(),
+				"""insert into sketch (series_id, stamp, digest, expired)
+				   values %s on conflict (series_id, stamp) do update set
+					 digest = excluded.digest,
+					 expired = excluded.expired,
+					 generation = sketch.generation + 1""", sketches)
+
+		self.catalogue._query("update series set shard=%s where id=%s",
+							  (target, sid))
+		self.placement[sid] = target
+		time.sleep(wait)
+
+		copied += self._copy_points(sid, old, new, batch_size, since=start)
+		while old._query(
+			"""delete from data where (series_id, stamp) in (
+				 select series_id, stamp from data
+				 where series_id = %s limit %s)""", (sid, batch_size)).rowcount:
+			pass
+		old._query("delete from rollup where series_id = %s", (sid,))
+		old._query("delete from sketch where series_id = %s", (sid,))
+		if old is not self.catalogue:
+			old._query("delete from series where id = %s", (sid,))
+		log.info("Moved series %s: %d points copied", sid, copied)
+		return copied
+
+	def _copy_points(self, sid, old, new, batch_size, since=None):
+		"""Copy a series' points (or those written since a time) from
+		one shard to another, in batches in time order. Returns the
+		number of points written (those already copied, with the same
+		ingest time, are not written again).
+		"""
+		sql = "select stamp, ingest, value from data where series_id = %s and stamp > %s"
+		if since is not None:
+			sql += " and ingest >= %s"
+		sql += " order by stamp limit %s"
+		last = "-infinity"
+		total = 0
+		while True:
+			params = [sid, last] + ([since] if since is not None else []) + [batch_size]
+			rows = old._query(sql, params).fetchall()
+			if not rows:
+				return total
+			cur = new.db.cursor()
+			psycopg2.extras.execute_values(
+				cur, COPY_POINTS_SQL,
+				[(sid, stamp, ingest, value) for stamp, ingest, value in rows],
+				page_size=len(rows))
+			total += cur.rowcount
+			last = rows[-1][0]
+
+	def _wipe(self):
+		"""Internal method used by test suite
+		"""
+		for shard in self.shards:
+			if shard is not self.catalogue:
+				shard._wipe()
+		self.catalogue._wipe()
@@ -0,0 +1,248 @@
+"""Decimation of series data for plotting: reducing a range of points
+to about as many as a chart has pixels across, while keeping its
+visual shape.
+
+Two methods are provided, both dividing the time range into equal
+buckets:
+
+lttb    (largest triangle three buckets) keeps the first and last
+        points, and from each of points - 2 buckets between them the
+        point making the largest triangle with the point kept from
+        the bucket before and the mean of the bucket after
+minmax  keeps the lowest and highest points of each of points / 2
+        buckets, so that no peak or trough is lost
+
+A Decimator takes the data in time order, a chunk at a time, and only
+holds the points of the buckets it hasn't yet decided on (at most the
+extremes of one bucket for minmax, and two buckets' points for lttb),
+so a long range can be decimated without reading it all into memory.
+NaN values are skipped. With NumPy, each bucket is processed with
+vector operations; without it, with plain Python loops.
+"""
+
+import array
+
+import fuse.arrays as arrays
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+METHODS = ("lttb", "minmax")
+MIN_POINTS = 3
+
+def check(method, points):
+	"""Raise ValueError unless method and points describe a decimation
+	"""
+	if method not in METHODS:
+		raise ValueError("Unknown decimation method: {0}".format(method))
+	if points < MIN_POINTS:
+		raise ValueError("At least {0} points are needed, not {1}".format(
+			MIN_POINTS, points))
+
+def decimate(data, points, method="lttb", use_numpy=True):
+	"""Decimate a ValueArray to at most points points. Data with no
+	more points than that is returned unchanged.
+	"""
+	check(method, points)
+	if len(data) <= points:
+		return data
+	dec = Decimator(method, points, int(data.stamps[0]), int(data.stamps[-1]),
+					use_numpy)
+	dec.feed(data.stamps, data.values)
+	return dec.result(data.sid)
+
+class Decimator(object):
+	"""Decimates data between the timestamps first and last
+	(inclusive, in microseconds since the Unix epoch) to at most
+	points points. Call feed() with each chunk of the data, in time
+	order, then result(). Points outside the range are counted in the
+	first or last bucket.
+	"""
+	def __init__(self, method, points, first, last, use_numpy=True):
+		check(method, points)
+		self.method = method
+		self.numpy = numpy is not None and use_numpy
+		if method == "lttb":
+			self.nbuckets = points - 2
+		else:
+			self.nbuckets = points // 2
+		self.first = first
+		self.width = max(-(-(last - first + 1) // self.nbuckets), 1)
+		# The points not yet decided on
+		self.stamps, self.values = self._valid([], [])
+		# The points kept
+		self.kept_stamps = []
+		self.kept_values = []
+		# For lttb, the last point kept, relative to first
+		self.prev = None
+		self.done = False
+
+	def feed(self, stamps, values):
+		"""Decimate a chunk of data, following on from the last
+		"""
+		stamps, values = self._valid(stamps, values)
+		if not len(stamps):
+			return
+		if self.method == "lttb" and self.prev is None:
+			self._keep_point(stamps[0], values[0])
+			stamps, values = stamps[1:], values[1:]
+		if self.numpy:
+			self.stamps = numpy.concatenate((self.stamps, stamps))
+			self.values = numpy.concatenate((self.values, values))
+		else:
+			self.stamps += stamps
+			self.values += values
+		if len(self.stamps):
+			self._decide(False)
+
+	def result(self, sid=None):
+		"""Return the decimated data, as a ValueArray
+		"""
+		if not self.done:
+			self._decide(True)
+			self.done = True
+		if self.numpy:
+			return arrays.ValueArray(
+				numpy.array(self.kept_stamps, dtype=numpy.int64),
+				numpy.array(self.kept_values, dtype=numpy.float64), sid)
+		return arrays.ValueArray(array.array("q", self.kept_stamps),
+								 array.array("d", self.kept_values), sid)
+
+	def _valid(self, stamps, values):
+		"""Return the points whose values aren't NaN, as arrays (with
+		NumPy) or lists
+		"""
+		if self.numpy:
+			stamps = numpy.asarray(stamps, dtype=numpy.int64)
+			values = numpy.asarray(values, dtype=numpy.float64)
+			ok = ~numpy.isnan(values)
+			if not ok.all():
+				stamps, values = stamps[ok], values[ok]
+			return stamps, values
+		pairs = [(int(s), float(v)) for s, v in zip(stamps, values) if v == v]
+		return [s for s, v in pairs], [v for s, v in pairs]
+
+	def _runs(self):
+		"""Return the (start, end) indexes of the runs of undecided
+		points falling in the same bucket
+		"""
+		if self.numpy:
+			ids = numpy.clip((self.stamps - self.first) // self.width,
+							 0, self.nbuckets - 1)
+			starts = (numpy.flatnonzero(numpy.diff(ids)) + 1).tolist()
+		else:
+			ids = [min(max((s - self.first) // self.width, 0), self.nbuckets - 1)
+				   for s in self.stamps]
+			starts = [i for i in range(1, len(ids)) if ids[i] != ids[i - 1]]
+		bounds = [0] + starts + [len(self.stamps)]
+		return list(zip(bounds[:-1], bounds[1:]))
+
+	def _keep_point(self, stamp, value):
+		self.kept_stamps.append(int(stamp))
+		self.kept_values.append(float(value))
+		self.prev = (float(stamp - self.first), float(value))
+
+	def _keep(self, i):
+		self._keep_point(self.stamps[i], self.values[i])
+
+	def _take(self, indexes):
+		"""Keep only the given undecided points
+		"""
+		if self.numpy:
+			self.stamps = self.stamps[indexes]
+			self.values = self.values[indexes]
+		else:
+			self.stamps = [self.stamps[i] for i in indexes]
+			self.values = [self.values[i] for i in indexes]
+
+	def _decide(self, final):
+		if self.method == "lttb":
+			self._decide_lttb(final)
+		else:
+			self._decide_minmax(final)
+
+	def _decide_minmax(self, final):
+		if not len(self.stamps):
+			return
+		runs = self._runs()
+		# The last bucket may continue in the next chunk: only its
+		# extremes need to be held on to
+		last = None if final else runs.pop()
+		for start, end in runs:
+			for i in self._extremes(start, end):
+				self._keep(i)
+		if last is not None:
+			self._take(self._extremes(*last))
+		else:
+			self._take([])
+
+	def _extremes(self, start, end):
+		"""Return the indexes of the lowest and highest points in a
+		run, in time order
+		"""
+		if self.numpy:
+			seg = self.values[start:end]
+			lo = start + int(numpy.argmin(seg))
+			hi = start + int(numpy.argmax(seg))
+		else:
+			idx = range(start, end)
+			lo = min(idx, key=self.values.__getitem__)
+			hi = max(idx, key=self.values.__getitem__)
+		return sorted({lo, hi})
+
+	def _decide_lttb(self, final):
+		tail = None
+		if final:
+			if not len(self.stamps):
+				return
+			tail = (self.stamps[-1], self.values[-1])
+			self._take(range(len(self.stamps) - 1))
+		runs = self._runs() if len(self.stamps) else []
+		# A bucket is decided once the one after it is complete, which
+		# it is only known to be once a point after it has been seen
+		ready = len(runs) if final else len(runs) - 2
+		if ready > 0:
+			centroids = self._centroids(runs[1:ready + 1])
+			if final:
+				centroids.append((float(tail[0] - self.first), float(tail[1])))
+			for (start, end), following in zip(runs, centroids):
+				self._keep(self._largest(start, end, following))
+		if final:
+			self._keep_point(*tail)
+			self._take([])
+		elif ready > 0:
+			self._take(range(runs[ready][0], len(self.stamps)))
+
+	def _centroids(self, runs):
+		"""Return a list of the mean (time, value) of each run, with the
+		times relative to first
+		"""
+		if not runs:
+			return []
+		if self.numpy:
+			starts = numpy.array([start for start, end in runs])
+			counts = numpy.array([end - start for start, end in runs])
+			end = runs[-1][1]
+			x = numpy.add.reduceat(self.stamps[:end] - self.first, starts) / counts
+			y = numpy.add.reduceat(self.values[:end], starts) / counts
+			return list(zip(x.tolist(), y.tolist()))
+		return [(sum(self.stamps[start:end]) / (end - start) - self.first,
+				 sum(self.values[start:end]) / (end - start))
+				for start, end in runs]
+
+	def _largest(self, start, end, following):
+		"""Return the index of the point in a run making the largest
+		triangle with the last point kept and the following point
+		"""
+		ax, ay = self.prev
+		cx, cy = following
+		if self.numpy:
+			x = (self.stamps[start:end] - self.first).astype(numpy.float64)
+			y = self.values[start:end]
+			area = numpy.abs((ax - cx) * (y - ay) - (ax - x) * (cy - ay))
+			return start + int(numpy.argmax(area))
+		return max(range(start, end), key=lambda i: abs(
+			(ax - cx) * (self.values[i] - ay)
+			- (ax - (self.stamps[i] - self.first)) * (cy - ay)))
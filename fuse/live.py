@@ -0,0 +1,174 @@
+"""Live updates: new data points pushed to subscribers as they are
+written, as a stream of Server-Sent Events.
+
+The database announces each write (PostgreSQL does this with
+NOTIFY), and a single listener per process passes the new points to
+the Hub, which encodes each batch once and hands it to every
+subscriber to that series. Each subscriber has a bounded queue of
+events; one which falls too far behind is disconnected rather than
+being allowed to hold up the others or use unbounded memory. The
+client's EventSource will reconnect, and can catch up with a normal
+data request.
+"""
+
+import logging
+import threading
+import queue
+import json
+
+import fuse.metrics as metrics
+import fuse.muddleware as muddleware
+
+log = logging.getLogger("live")
+
+# Sent at the start of a stream: tells the client how long to wait
+# before reconnecting, and gets the response headers sent
+RETRY = b"retry: 3000\n\n"
+# Sent on idle streams, to keep proxies from timing them out
+KEEPALIVE = b": keepalive\n\n"
+
+def encode_event(sid, data):
+	"""Encode a ValueArray of new points from a series as an SSE event
+	"""
+	body = json.dumps({ "series": sid, "data": data },
+					  cls=muddleware.JSONDateEncoder, separators=(",", ":"))
+	return "event: data\ndata: {0}\n\n".format(body).encode("utf-8")
+
+class Subscription(object):
+	"""A subscriber's queue of encoded events. sids is the set of
+	series subscribed to, or None for all series.
+	"""
+	def __init__(self, sids, depth):
+		self.sids = sids
+		self.queue = queue.Queue(depth)
+		self.closed = False
+
+	def put(self, event):
+		"""Queue an event. If the queue is full, the subscription is
+		closed, and False returned.
+		"""
+		if self.closed:
+			return False
+		try:
+			self.queue.put_nowait(event)
+			return True
+		except queue.Full:
+			self.close()
+			return False
+
+	def get(self, timeout=None):
+		"""Return the next event, or None if the subscription has been
+		closed. Raises queue.Empty if there is nothing within timeout
+		seconds.
+		"""
+		if self.closed:
+			return None
+		return self.queue.get(timeout=timeout)
+
+	def close(self):
+		"""Close the subscription, discarding any queued events, and
+		waking up the reader
+		"""
+		self.closed = True
+		try:
+			while True:
+				self.queue.get_nowait()
+		except queue.Empty:
+			pass
+		try:
+			self.queue.put_nowait(None)
+		except queue.Full:
+			pass
+
+class Hub(object):
+	"""Fan new data out to subscribers. The database listener is
+	started when the first subscription is made.
+	"""
+	def __init__(self, db, depth=100, registry=metrics.REGISTRY):
+		self.db = db
+		self.depth = depth
+		self.lock = threading.Lock()
+		self.subscribers = {}
+		self.listening = False
+		self.count = registry.gauge(
+			"fuse_live_subscribers", "Live update subscriptions open")
+		self.events = registry.counter(
+			"fuse_live_events_total", "Live update events sent to subscribers")
+		self.dropped = registry.counter(
+			"fuse_live_dropped_total",
+			"Live update subscriptions closed for falling behind")
+
+	def subscribe(self, sids=None):
+		"""Subscribe to new data from the given series IDs, or from all
+		series if sids is None. Returns a Subscription.
+		"""
+		sub = Subscription(None if sids is None else set(sids), self.depth)
+		with self.lock:
+			for sid in (sub.sids or [None]):
+				self.subscribers.setdefault(sid, set()).add(sub)
+			self._update_count()
+			start = not self.listening
+			self.listening = True
+		if start:
+			self.db.listen(self.publish)
+		return sub
+
+	def unsubscribe(self, sub):
+		"""Remove a subscription, and close it
+		"""
+		sub.close()
+		with self.lock:
+			for sid in (sub.sids or [None]):
+				subs = self.subscribers.get(sid)
+				if subs is None:
+					continue
+				subs.discard(sub)
+				if not subs:
+					del self.subscribers[sid]
+			self._update_count()
+
+	def _update_count(self):
+		self.count.set((), len(set().union(*self.subscribers.values())))
+
+	def publish(self, sid, data):
+		"""Send a ValueArray of new points from series sid to its
+		subscribers
+		"""
+		with self.lock:
+			subs = (self.subscribers.get(sid, set())
+					| self.subscribers.get(None, set()))
+		if not subs or not len(data):
+			return
+		event = encode_event(sid, data)
+		for sub in subs:
+			if sub.put(event):
+				self.events.inc()
+			else:
+				log.warning("Live subscriber fell behind; disconnecting")
+				self.dropped.inc()
+				self.unsubscribe(sub)
+
+class EventStream(object):
+	"""The response body of a live update request: the subscription's
+	events, with keepalives while it is idle. Closing the response
+	closes the subscription.
+	"""
+	def __init__(self, hub, sub, heartbeat=15):
+		self.hub = hub
+		self.sub = sub
+		self.heartbeat = heartbeat
+
+	def __iter__(self):
+		yield RETRY
+		while True:
+			try:
+				event = self.sub.get(timeout=self.heartbeat)
+			except queue.Empty:
+				yield KEEPALIVE
+				continue
+			if event is None:
+				return
+			yield event
+
+	def close(self):
+		self.hub.unsubscribe(self.sub)
@@ -0,0 +1,211 @@
+"""Lightweight in-process metrics: counters and histograms, rendered
+in the Prometheus text exposition format.
+
+The metric objects are deliberately simple: each keeps a dict mapping
+a tuple of label values to its current state, so recording an
+observation is a dict lookup, a bisect and a couple of additions. A
+single lock per registry protects the updates.
+
+Database time and row counts are attributed to the request currently
+being served by the thread that issued the query; the request-level
+middleware calls begin_request() and end_request() around each
+request, and the database layer calls account_db() for each
+statement.
+"""
+
+import threading
+import bisect
+
+# Latency buckets (in seconds) used for histograms by default
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+				   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_local = threading.local()
+
+def begin_request():
+	"""Start accumulating database time and rows for the current
+	thread's request. Returns the accumulator, a list of [seconds,
+	rows].
+	"""
+	acc = [0.0, 0]
+	_local.acc = acc
+	return acc
+
+def end_request():
+	"""Stop accumulating database statistics for the current thread
+	"""
+	_local.acc = None
+
+def account_db(seconds, rows):
+	"""Add a database statement's time and row count to the current
+	request, if there is one.
+	"""
+	acc = getattr(_local, "acc", None)
+	if acc is not None:
+		acc[0] += seconds
+		if rows > 0:
+			acc[1] += rows
+
+def _escape(value):
+	return (str(value).replace("\\", "\\\\")
+			.replace("\n", "\\n").replace('"', '\\"'))
+
+def _labels(names, values, extra=""):
+	"""Render a set of label names and values as a Prometheus label
+	string (including the braces)
+	"""
+	parts = ['{0}="{1}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+	if extra:
+		parts.append(extra)
+	if not parts:
+		return ""
+	return "{" + ",".join(parts) + "}"
+
+def _number(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(value)
+
+class Metric(object):
+	"""Base class for a named metric with a fixed set of label names
+	"""
+	kind = "untyped"
+
+	def __init__(self, lock, name, doc, labelnames=()):
+		self.lock = lock
+		self.name = name
+		self.doc = doc
+		self.labelnames = tuple(labelnames)
+		self.values = {}
+
+	def render(self, out):
+		out.append("# HELP {0} {1}".format(self.name, self.doc))
+		out.append("# TYPE {0} {1}".format(self.name, self.kind))
+		with self.lock:
+			items = sorted((k, v[:] if isinstance(v, list) else v)
+						   for k, v in self.values.items())
+		for labels, value in items:
+			self.render_value(out, labels, value)
+
+	def render_value(self, out, labels, value):
+		out.append("{0}{1} {2}".format(
+			self.name, _labels(self.labelnames, labels), _number(value)))
+
+class Counter(Metric):
+	"""A monotonically increasing count, per label set
+	"""
+	kind = "counter"
+
+	def inc(self, labels=(), amount=1):
+		with self.lock:
+			self.values[labels] = self.values.get(labels, 0) + amount
+
+	def inc_held(self, labels=(), amount=1):
+		"""As inc(), for callers which already hold the registry lock
+		(to batch several updates under one acquisition)
+		"""
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+	"""A value which may go up and down, per label set
+	"""
+	kind = "gauge"
+
+	def set(self, labels=(), value=0):
+		with self.lock:
+			self.values[labels] = value
+
+class Histogram(Metric):
+	"""A distribution of observations, counted into fixed buckets. The
+	state for each label set is a list of per-bucket counts (with a
+	final overflow bucket), followed by the sum and the count of all
+	observations.
+	"""
+	kind = "histogram"
+
+	def __init__(self, lock, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+		Metric.__init__(self, lock, name, doc, labelnames)
+		self.buckets = tuple(sorted(buckets))
+
+	def observe(self, labels, value):
+		with self.lock:
+			self.observe_held(labels, value)
+
+	def observe_held(self, labels, value):
+		"""As observe(), for callers which already hold the registry
+		lock
+		"""
+		state = self.values.get(labels)
+		if state is None:
+			state = [0] * (len(self.buckets) + 3)
+			self.values[labels] = state
+		state[bisect.bisect_left(self.buckets, value)] += 1
+		state[-2] += value
+		state[-1] += 1
+
+	def render_value(self, out, labels, state):
+		total = 0
+		for le, count in zip(self.buckets + (float("inf"),), state):
+			total += count
+			out.append("{0}_bucket{1} {2}".format(
+				self.name,
+				_labels(self.labelnames, labels, 'le="{0}"'.format(_number(le))),
+				total))
+		lbl = _labels(self.labelnames, labels)
+		out.append("{0}_sum{1} {2}".format(self.name, lbl, _number(state[-2])))
+		out.append("{0}_count{1} {2}".format(self.name, lbl, state[-1]))
+
+class Registry(object):
+	"""A collection of metrics, which can be rendered as a whole.
+
+	Metrics are created on first request, and the same object is
+	returned for subsequent requests for the same name, so that
+	several middleware instances can share them. Collectors are
+	callables which are invoked at render time, and which should
+	return an iterable of Metric objects generated on the fly.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics = {}
+		self.collectors = []
+
+	def _get(self, cls, name, *args, **kwargs):
+		with self.lock:
+			if name not in self.metrics:
+				self.metrics[name] = cls(self.lock, name, *args, **kwargs)
+			return self.metrics[name]
+
+	def counter(self, name, doc, labelnames=()):
+		return self._get(Counter, name, doc, labelnames)
+
+	def gauge(self, name, doc, labelnames=()):
+		return self._get(Gauge, name, doc, labelnames)
+
+	def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+		return self._get(Histogram, name, doc, labelnames, buckets=buckets)
+
+	def add_collector(self, fn):
+		self.collectors.append(fn)
+
+	def render(self):
+		"""Return the text exposition of all metrics in the registry
+		"""
+		out = []
+		with self.lock:
+			metrics = [self.metrics[k] for k in sorted(self.metrics)]
+		for m in metrics:
+			m.render(out)
+		for fn in list(self.collectors):
+			for m in fn():
+				m.render(out)
+		out.append("")
+		return "\n".join(out)
+
+	def collected(self, cls, name, doc, labelnames=()):
+		"""Create a free-standing metric for use by a collector. It is
+		not stored in the registry.
+		"""
+		return cls(threading.Lock(), name, doc, labelnames)
+
+# The process-wide default registry
+REGISTRY = Registry()
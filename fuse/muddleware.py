@@ -1,15 +1,24 @@
 """WSGI middleware
 """
 
-import sys
 import logging
 import traceback
 import time
 import calendar
 import json
+import random
+import threading
+import os
+import cProfile
+import tracemalloc
+import zlib
 
 from wsgiref.headers import Headers
 
+import fuse.metrics as metrics
+import fuse.arrays as arrays
+import fuse.trace as trace
+
 log = logging.getLogger("muddleware")
 RFC_2822_DATE = "%a, %d %b %Y %H:%M:%S +0000"
 ISO_8601_DATE = "%Y-%m-%dT%H:%M:%S.%f%z"
@@ -30,8 +39,15 @@ class JSONDateEncoder(json.JSONEncoder):
 	fields, and so the D field is not normalised. However, dealing
 	with months is a nasty thing, and I'm not going to do it here
 	(because it's not supported by datetime.timedelta).
+
+	A ValueArray is rendered as a list of (timestamp, value) pairs,
+	without creating a datetime for each point, and a Grid as a dict
+	of start, period, values and off-grid points.
 	"""
 	def default(self, obj):
+		if isinstance(obj, (arrays.ValueArray, arrays.Grid)):
+			return obj.as_json()
+
 		try:
 			return obj.strftime(ISO_8601_DATE)
 		except AttributeError:
@@ -61,6 +77,28 @@ class BinaryJSONIterator(object):
 	def __iter__(self):
 		return iter([json.dumps(self.binary, cls=JSONDateEncoder).encode("utf8")])
 
+class GzipIterator(object):
+	"""Response iterator which gzips the chunks of another response
+	iterator as they are sent. Closing it closes the underlying
+	iterator, so that (e.g.) a database export can be abandoned when
+	the client goes away.
+	"""
+	def __init__(self, data, level=6):
+		self.data = data
+		self.level = level
+
+	def __iter__(self):
+		comp = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+		for chunk in self.data:
+			out = comp.compress(chunk)
+			if out:
+				yield out
+		yield comp.flush()
+
+	def close(self):
+		if hasattr(self.data, "close"):
+			self.data.close()
+
 class AccessFunctionWrapper(object):
 	"""This wrapper is the innermost object: It takes a function that
 	takes (request, response) parameters, and turns it into a WSGI
@@ -74,7 +112,8 @@ class AccessFunctionWrapper(object):
 		headers_list = []
 		resp = StructuredResponse(headers_list)
 		# Call the function
-		self.fn(environ, resp)
+		with trace.span("handler"):
+			self.fn(environ, resp)
 		# Send the headers
 		start_response(resp.result, headers_list)
 		# Render it
@@ -102,6 +141,155 @@ class ExceptionHandler(object):
 
 			return [traceback.format_exc().encode("utf8")]
 
+# Held while a request is being profiled
+_PROFILE_LOCK = threading.Lock()
+
+class Profiler(object):
+	"""Run selected requests under cProfile (and optionally
+	tracemalloc), and write the results to a directory.
+
+	A request is profiled if its X-Fuse-Profile header matches the
+	configured token, or at random with probability sample_rate. The
+	profile covers both the call to the application and the iteration
+	over its response. The name of the profile is returned in the
+	X-Fuse-Profile response header. Only the newest keep files in the
+	directory are retained.
+
+	A profiler is process-wide (and cProfile refuses to start while
+	another is active), so only one request at a time is profiled:
+	a request which would be profiled while another is being runs
+	unprofiled.
+	"""
+	def __init__(self, fn, directory, token=None, sample_rate=0.0,
+				 memory=False, keep=50):
+		self.fn = fn
+		self.directory = directory
+		self.token = token
+		self.sample_rate = sample_rate
+		self.memory = memory
+		self.keep = keep
+		self.counter = 0
+		self.lock = threading.Lock()
+		os.makedirs(directory, exist_ok=True)
+
+	def wanted(self, environ):
+		"""Decide whether to profile this request
+		"""
+		if self.token is not None:
+			if environ.get("HTTP_X_FUSE_PROFILE") == self.token:
+				return True
+		return self.sample_rate > 0 and random.random() < self.sample_rate
+
+	class ProfileIterator(object):
+		"""Response iterator which runs the profiler while the
+		response is generated, and saves the profile when it is
+		closed.
+		"""
+		def __init__(self, mw, data, prof, name, memory):
+			self.mw = mw
+			self.data = data
+			self.prof = prof
+			self.name = name
+			self.memory = memory
+			self.done = False
+
+		def __iter__(self):
+			it = iter(self.data)
+			while True:
+				self.prof.enable()
+				try:
+					chunk = next(it)
+				except StopIteration:
+					break
+				finally:
+					self.prof.disable()
+				yield chunk
+			self.close()
+
+		def close(self):
+			if self.done:
+				return
+			self.done = True
+			try:
+				if hasattr(self.data, "close"):
+					self.data.close()
+			finally:
+				self.mw.save(self.prof, self.name, self.memory)
+
+	def save(self, prof, name, memory):
+		"""Write out the profile (and memory snapshot), and prune old
+		files from the directory
+		"""
+		path = os.path.join(self.directory, name)
+		try:
+			prof.dump_stats(path + ".pstats")
+			if memory:
+				tracemalloc.take_snapshot().dump(path + ".tracemalloc")
+		finally:
+			if memory:
+				tracemalloc.stop()
+			_PROFILE_LOCK.release()
+		self.prune()
+
+	def prune(self):
+		"""Delete all but the newest keep profiles. A profile and its
+		memory snapshot count as one.
+		"""
+		newest = {}
+		for fname in os.listdir(self.directory):
+			stem, ext = os.path.splitext(fname)
+			if ext not in (".pstats", ".tracemalloc"):
+				continue
+			try:
+				mtime = os.path.getmtime(os.path.join(self.directory, fname))
+			except OSError:
+				continue
+			newest[stem] = max(mtime, newest.get(stem, mtime))
+		profiles = sorted(newest, key=lambda stem: (newest[stem], stem),
+						  reverse=True)
+		for stem in profiles[self.keep:]:
+			for ext in (".pstats", ".tracemalloc"):
+				try:
+					os.unlink(os.path.join(self.directory, stem + ext))
+				except OSError:
+					pass
+
+	def __call__(self, environ, start_response):
+		if not self.wanted(environ):
+			return self.fn(environ, start_response)
+		if not _PROFILE_LOCK.acquire(blocking=False):
+			log.debug("Not profiling %s: another request is being profiled",
+					  environ.get("PATH_INFO", ""))
+			return self.fn(environ, start_response)
+
+		with self.lock:
+			self.counter += 1
+			name = "{0}-{1}-{2}-{3}".format(
+				time.strftime("%Y%m%dT%H%M%S", time.gmtime()),
+				os.getpid(), self.counter,
+				"".join(c if c.isalnum() else "_"
+						for c in environ.get("PATH_INFO", ""))[:60])
+
+		# If someone else is using tracemalloc, leave it alone
+		memory = self.memory and not tracemalloc.is_tracing()
+		if memory:
+			tracemalloc.start()
+
+		def my_start(result, headers, *args):
+			headers.append(("X-Fuse-Profile", name))
+			return start_response(result, headers, *args)
+
+		prof = cProfile.Profile()
+		try:
+			prof.enable()
+			data = self.fn(environ, my_start)
+		except:
+			prof.disable()
+			self.save(prof, name, memory)
+			raise
+		prof.disable()
+		return self.ProfileIterator(self, data, prof, name, memory)
+
 class ParameterisedMiddleware(object):
 	"""Class decorator which allows us to write middlewares which bind
 	additional parameters to the middleware creation. e.g.:
@@ -171,6 +359,298 @@ class DebugLogger(object):
 		return self.LogIterator(
 			self, self.app(environ, start_response), self.tag)
 
+@ParameterisedMiddleware
+class Metrics(object):
+	"""Record request counts, latency, response size, and the database
+	time and rows used, for each route, method and response status.
+
+	The latency covers the whole of the response, including iterating
+	over the returned data, so it is only recorded when the response
+	iterator is exhausted or closed. A request whose app raises an
+	exception (which ExceptionHandler turns into a 500) is recorded
+	as a 500 straight away.
+	"""
+	LABELS = ("route", "method", "status")
+
+	def __init__(self, app, registry, route="unknown"):
+		self.app = app
+		self.route = route
+		self.lock = registry.lock
+		self.requests = registry.counter(
+			"fuse_http_requests_total",
+			"Total HTTP requests served", self.LABELS)
+		self.latency = registry.histogram(
+			"fuse_http_request_duration_seconds",
+			"Time taken to serve HTTP requests", self.LABELS)
+		self.sent = registry.counter(
+			"fuse_http_response_bytes_total",
+			"Total bytes sent in HTTP response bodies", self.LABELS)
+		self.db_time = registry.counter(
+			"fuse_http_db_seconds_total",
+			"Total database time spent serving HTTP requests", self.LABELS)
+		self.db_rows = registry.counter(
+			"fuse_http_db_rows_total",
+			"Total database rows returned while serving HTTP requests",
+			self.LABELS)
+
+	class CountingIterator(object):
+		"""Wrapper around a response iterator which counts the bytes
+		passing through it, and records the request's metrics when
+		it is finished with.
+		"""
+		def __init__(self, mw, data, status, method, start, acc):
+			self.mw = mw
+			self.data = data
+			self.status = status
+			self.method = method
+			self.start = start
+			self.acc = acc
+			self.size = 0
+			self.done = False
+
+		def __iter__(self):
+			for chunk in self.data:
+				self.size += len(chunk)
+				yield chunk
+			self.close()
+
+		def close(self):
+			if self.done:
+				return
+			self.done = True
+			try:
+				if hasattr(self.data, "close"):
+					self.data.close()
+			finally:
+				metrics.end_request()
+				self.mw.record(self.status[0], self.method,
+							   time.perf_counter() - self.start,
+							   self.size, self.acc)
+
+	def record(self, status, method, elapsed, size, acc):
+		labels = (self.route, method, status)
+		with self.lock:
+			self.requests.inc_held(labels)
+			self.latency.observe_held(labels, elapsed)
+			self.sent.inc_held(labels, size)
+			self.db_time.inc_held(labels, acc[0])
+			self.db_rows.inc_held(labels, acc[1])
+
+	def __call__(self, environ, start_response):
+		start = time.perf_counter()
+		acc = metrics.begin_request()
+		status = ["000"]
+
+		def my_start(result, headers, *args):
+			status[0] = result[:3]
+			return start_response(result, headers, *args)
+
+		method = environ.get("REQUEST_METHOD", "")
+		try:
+			data = self.app(environ, my_start)
+		except:
+			metrics.end_request()
+			self.record("500", method, time.perf_counter() - start, 0, acc)
+			raise
+		return self.CountingIterator(self, data, status, method, start, acc)
+
+@ParameterisedMiddleware
+class Tracing(object):
+	"""Trace each request, and report the time spent in each traced
+	span in a Server-Timing response header.
+
+	So that the header can include the work done while the response
+	body is generated (e.g. encoding in Conneg), the call to the
+	upstream start_response is held back until the first chunk of the
+	body is ready. Work done after that, including the time spent by
+	the server writing the body to the network ("send"), only appears
+	in the trace file.
+
+	A sample of requests (sample_rate, between 0 and 1) are written to
+	trace_file as one JSON object per line. Requests whose app raises
+	an exception are always written, with the error, as 500s.
+	"""
+	def __init__(self, app, route="unknown", sample_rate=0.0,
+				 trace_file=None, header=True):
+		self.app = app
+		self.route = route
+		self.sample_rate = sample_rate
+		self.trace_file = trace_file
+		self.header = header
+
+	class DeferredResponse(object):
+		"""Holds the arguments to start_response until they can be
+		sent with the Server-Timing header added
+		"""
+		def __init__(self, mw, start_response, trc):
+			self.mw = mw
+			self.start_response = start_response
+			self.trace = trc
+			self.args = None
+			self.write = None
+			self.ttfb = None
+
+		def __call__(self, result, headers, *args):
+			if args and args[0] is not None:
+				# Errors are sent straight away
+				self.write = self.start_response(result, headers, *args)
+				return self.write
+			self.args = (result, headers)
+			return self.deferred_write
+
+		def deferred_write(self, data):
+			self.send()
+			self.write(data)
+
+		def send(self):
+			if self.ttfb is not None:
+				return
+			self.ttfb = time.perf_counter() - self.trace.start
+			if self.write is not None or self.args is None:
+				return
+			result, headers = self.args
+			if self.mw.header:
+				headers.append(
+					("Server-Timing", self.trace.server_timing(self.ttfb)))
+			self.write = self.start_response(result, headers)
+
+	class TraceIterator(object):
+		"""Response iterator which sends the deferred headers before
+		the first chunk, and records the trace when it is closed
+		"""
+		def __init__(self, mw, environ, data, response, sampled):
+			self.mw = mw
+			self.environ = environ
+			self.data = data
+			self.response = response
+			self.sampled = sampled
+			self.done = False
+
+		def __iter__(self):
+			send = 0.0
+			first = None
+			for chunk in self.data:
+				self.response.send()
+				t = time.perf_counter()
+				if first is None:
+					first = t
+				yield chunk
+				send += time.perf_counter() - t
+			self.response.send()
+			if first is not None:
+				self.response.trace.add("send", first, send)
+			self.close()
+
+		def close(self):
+			if self.done:
+				return
+			self.done = True
+			try:
+				if hasattr(self.data, "close"):
+					self.data.close()
+			finally:
+				trace.end()
+				if self.sampled:
+					self.mw.record(self.environ, self.response)
+
+	def record(self, environ, response):
+		"""Write a trace to the trace file
+		"""
+		trc = response.trace
+		status = ""
+		if trc.error is not None:
+			status = "500"
+		elif response.args is not None:
+			status = response.args[0][:3]
+		line = json.dumps({
+			"time": trc.wall,
+			"route": self.route,
+			"method": environ.get("REQUEST_METHOD", ""),
+			"path": environ.get("SCRIPT_NAME", "") + environ.get("PATH_INFO", ""),
+			"query": environ.get("QUERY_STRING", ""),
+			"status": status,
+			"ttfb_ms": round((response.ttfb or 0.0) * 1000, 3),
+			"total_ms": round((time.perf_counter() - trc.start) * 1000, 3),
+			"spans": trc.as_dict(),
+			"overflow": { name: round(duration * 1000, 3)
+						  for name, duration in trc.overflow.items() },
+			"error": trc.error,
+			})
+		with _trace_lock:
+			with open(self.trace_file, "a") as f:
+				f.write(line + "\n")
+
+	def __call__(self, environ, start_response):
+		sampled = (self.trace_file is not None
+				   and random.random() < self.sample_rate)
+		response = self.DeferredResponse(self, start_response, trace.begin())
+		data = None
+		try:
+			data = self.app(environ, response)
+		except Exception as ex:
+			response.trace.error = "{0}: {1}".format(type(ex).__name__, ex)
+			if self.trace_file is not None:
+				self.record(environ, response)
+			raise
+		finally:
+			if data is None:
+				# No TraceIterator to end it
+				trace.end()
+		return self.TraceIterator(self, environ, data, response, sampled)
+
+_trace_lock = threading.Lock()
+
+class Environ(object):
+	"""Add fixed entries to each request's environ, where the server
+	hasn't set them itself
+	"""
+	def __init__(self, app, entries):
+		self.app = app
+		self.entries = entries
+
+	def __call__(self, environ, start_response):
+		for key, value in self.entries.items():
+			environ.setdefault(key, value)
+		return self.app(environ, start_response)
+
+class Release(object):
+	"""Call release() once the response has been sent (or abandoned),
+	to hand back per-request resources such as the thread's database
+	connection
+	"""
+	def __init__(self, app, release):
+		self.app = app
+		self.release = release
+
+	class ReleasingIterator(object):
+		def __init__(self, data, release):
+			self.data = data
+			self.release = release
+			self.done = False
+
+		def __iter__(self):
+			for chunk in self.data:
+				yield chunk
+			self.close()
+
+		def close(self):
+			if self.done:
+				return
+			self.done = True
+			try:
+				if hasattr(self.data, "close"):
+					self.data.close()
+			finally:
+				self.release()
+
+	def __call__(self, environ, start_response):
+		try:
+			data = self.app(environ, start_response)
+		except:
+			self.release()
+			raise
+		return self.ReleasingIterator(data, self.release)
+
 def compose(mwares):
 	"""This function takes a list of middlewares, and returns a
 	middleware that acts as the composition of them all.
@@ -0,0 +1,71 @@
+"""Rebalancing tool for the sharded database: moves series between
+shards while the servers keep running.
+
+With no options, shows how many series each shard holds. --plan lists
+the moves which would put every series on the shard that hashing now
+places it on (for example, after a shard has been added), and --apply
+makes them. --move moves a single series to a given shard.
+"""
+
+import sys
+import argparse
+import logging
+
+import fuse.db_sharded as db_sharded
+
+log = logging.getLogger("rebalance")
+
+def plan(db):
+	"""Return a list of (sid, from shard, to shard) moves, for every
+	series not on the shard that hashing places it on (including those
+	left on the catalogue from before sharding was enabled)
+	"""
+	db._load_map()
+	moves = []
+	for sid, shard in sorted(db.placement.items()):
+		target = db_sharded.place(sid, db.placed)
+		if target != shard:
+			moves.append((sid, shard, target))
+	return moves
+
+def main(conf, argv=None):
+	parser = argparse.ArgumentParser(
+		description="Move series between the shards of a sharded database")
+	parser.add_argument("--plan", action="store_true",
+						help="list the moves needed to balance the shards")
+	parser.add_argument("--apply", action="store_true",
+						help="make the moves needed to balance the shards")
+	parser.add_argument("--move", nargs=2, type=int, metavar=("SERIES", "SHARD"),
+						help="move one series to the given shard")
+	parser.add_argument("--batch", type=int, default=10000,
+						help="points copied or deleted in each transaction")
+	parser.add_argument("--wait", type=float, default=None,
+						help="seconds to wait for servers to see each move "
+						"(default: shard_map_seconds)")
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO)
+
+	db = db_sharded.Database(conf)
+	if args.move is not None:
+		sid, target = args.move
+		if not 0 <= target < len(db.shards):
+			parser.error("no such shard: {0}".format(target))
+		db.move_series(sid, target, args.batch, args.wait)
+		return 0
+
+	if args.plan or args.apply:
+		moves = plan(db)
+		for sid, src, target in moves:
+			print("series {0}: shard {1} -> {2}".format(sid, src, target))
+			if args.apply:
+				db.move_series(sid, target, args.batch, args.wait)
+		print("{0} series to move".format(len(moves)), file=sys.stderr)
+		return 0
+
+	db._load_map()
+	counts = [0] * len(db.shards)
+	for shard in db.placement.values():
+		counts[shard] += 1
+	for i, count in enumerate(counts):
+		print("shard {0}: {1} series".format(i, count))
+	return 0
@@ -0,0 +1,128 @@
+"""Retention: raw data older than a series' retention period is rolled
+up into coarse summaries (count, min, max and mean per bucket), and
+deleted.
+
+The work is done by a background thread, a little at a time: each
+batch rolls up and deletes at most batch_size points in its own short
+transaction, and the worker pauses between batches, so that the
+deletes don't hold locks or saturate the disk for long enough to
+disturb live traffic. A series with a large backlog is worked through
+over many batches (and, if need be, many cycles).
+
+Every server process runs a worker. Where the database can take an
+advisory lock (PostgreSQL), only the worker holding it runs a cycle;
+the others skip theirs, so the same data isn't expired twice over.
+"""
+
+import logging
+import datetime
+import threading
+
+import fuse.arrays as arrays
+import fuse.metrics as metrics
+
+log = logging.getLogger("retention")
+
+_UTC = datetime.timezone.utc
+_USEC = datetime.timedelta(microseconds=1)
+
+# The advisory lock held by the worker running a retention cycle
+LOCK_KEY = 0x66757365
+
+def cutoff(now, retention, bucket):
+	"""Return the time before which data past its retention period is
+	expired: now - retention, rounded down to a bucket boundary, so
+	that each bucket is rolled up in one go
+	"""
+	stamp = arrays.to_stamp(now - retention)
+	size = bucket // _USEC
+	return arrays.to_datetime(stamp - stamp % size)
+
+class RetentionWorker(object):
+	def __init__(self, db, bucket=datetime.timedelta(hours=1),
+				 batch_size=5000, pause=0.5, interval=600,
+				 registry=metrics.REGISTRY):
+		self.db = db
+		self.bucket = bucket
+		self.batch_size = batch_size
+		self.pause = pause
+		self.interval = interval
+		self.stopping = threading.Event()
+		self.thread = None
+
+		self.purged = registry.counter(
+			"fuse_retention_purged_points_total",
+			"Raw data points rolled up and deleted")
+		self.backlog = registry.gauge(
+			"fuse_retention_backlog_points",
+			"Raw data points past their retention period, awaiting deletion")
+		self.last_run = registry.gauge(
+			"fuse_retention_last_run_timestamp_seconds",
+			"When the last retention cycle finished")
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run, name="retention",
+									   daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.stopping.set()
+		if self.thread is not None:
+			self.thread.join()
+
+	def _run(self):
+		while not self.stopping.is_set():
+			try:
+				self.run_once()
+			except Exception as ex:
+				log.error("Retention cycle failed", exc_info=ex)
+			finally:
+				release = getattr(self.db, "release", None)
+				if release is not None:
+					release()
+			self.stopping.wait(self.interval)
+
+	def run_once(self, now=None):
+		"""Expire the data of every series with a retention period,
+		unless another worker is doing so. Returns the number of
+		points deleted.
+		"""
+		try_lock = getattr(self.db, "try_lock", None)
+		if try_lock is not None:
+			if not try_lock(LOCK_KEY):
+				log.debug("Another worker is running a retention cycle")
+				return 0
+			try:
+				return self._expire_all(now)
+			finally:
+				self.db.unlock(LOCK_KEY)
+		return self._expire_all(now)
+
+	def _expire_all(self, now):
+		if now is None:
+			now = datetime.datetime.now(_UTC)
+		work = []
+		for sid, info in self.db.list_series().items():
+			if info.get("retention") is not None:
+				before = cutoff(now, info["retention"], self.bucket)
+				work.append((sid, before, self.db.count_expired(sid, before)))
+		backlog = sum(w[2] for w in work)
+		self.backlog.set((), backlog)
+
+		total = 0
+		for sid, before, count in work:
+			while count > 0 and not self.stopping.is_set():
+				n = self.db.expire(sid, before, self.bucket, self.batch_size)
+				if n == 0:
+					break
+				count -= n
+				total += n
+				backlog -= n
+				self.purged.inc((), n)
+				self.backlog.set((), backlog)
+				if count > 0:
+					self.stopping.wait(self.pause)
+		if total:
+			log.info("Expired %d data points", total)
+		self.last_run.set((), now.timestamp())
+		return total
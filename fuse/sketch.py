@@ -0,0 +1,251 @@
+"""Quantile sketches: t-digests of the data in each day of a series,
+so that percentiles over long ranges can be estimated by merging a
+few stored sketches rather than sorting every raw value.
+
+A t-digest summarises a set of values as a sorted list of centroids
+(mean, weight), kept small where the quantile is near 0 or 1 and
+larger around the median, so that its size is bounded by the
+compression (here at most about COMPRESSION / 2 centroids) whatever
+the number of values. Digests merge by pooling their centroids and
+compressing again. Quantiles are estimated by interpolating between
+the centroids, and between the extremes (which are kept exactly) and
+the outermost centroids.
+
+Accuracy: the rank error of an estimate is the difference between
+the quantile asked for and the fraction of the values actually below
+the estimate. With the default compression of 100, for data from a
+continuous distribution, it is at most 0.5% (and at most 0.2% for
+quantiles below 0.01 or above 0.99), whether the digest was built
+from all of the data or merged from the digests of parts of it
+(test/test_sketch.py checks these bounds on several distributions).
+Data with few distinct values can be estimated as lying between two
+of them, so with (say) 50 distinct values an estimate may be out by
+up to half a value's share (1%) of the ranks. The error in the value
+itself depends on how densely the data lies around it.
+
+With NumPy, digests are built and merged with vector operations;
+without it, with plain Python loops.
+"""
+
+import math
+import struct
+import array
+import sys
+import bisect
+import datetime
+
+import fuse.arrays as arrays
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+COMPRESSION = 100
+# Sketches are kept for each BUCKET of each series, aligned to the
+# Unix epoch (i.e. for each UTC day)
+BUCKET = datetime.timedelta(days=1)
+BUCKET_US = BUCKET // datetime.timedelta(microseconds=1)
+
+# Serialised form: centroid count, compression, min and max, then the
+# means and the weights, all little-endian
+_HEADER = struct.Struct("<IIdd")
+
+def bucket_of(stamp):
+	"""Return the start of the bucket holding a timestamp (in
+	microseconds since the Unix epoch)
+	"""
+	return stamp - stamp % BUCKET_US
+
+class TDigest(object):
+	"""A t-digest: centroid means (in order) and weights, and the
+	minimum and maximum of the values summarised
+	"""
+	__slots__ = ("means", "weights", "min", "max", "compression")
+
+	def __init__(self, means=(), weights=(), min=float("nan"), max=float("nan"),
+				 compression=COMPRESSION):
+		self.means = list(means)
+		self.weights = list(weights)
+		self.min = min
+		self.max = max
+		self.compression = compression
+
+	@classmethod
+	def from_values(cls, values, compression=COMPRESSION, use_numpy=True):
+		"""Return the digest of a sequence of values. NaNs are ignored.
+		"""
+		if numpy is not None and use_numpy:
+			values = numpy.asarray(values, dtype=numpy.float64)
+			values = numpy.sort(values[~numpy.isnan(values)])
+			weights = numpy.ones(len(values))
+		else:
+			values = sorted(v for v in values if v == v)
+			weights = [1.0] * len(values)
+		return cls._compress(values, weights, compression, use_numpy)
+
+	@classmethod
+	def merge(cls, digests, compression=COMPRESSION, use_numpy=True):
+		"""Return the digest of the values summarised by all of digests
+		"""
+		digests = [d for d in digests if d.means]
+		means = [m for d in digests for m in d.means]
+		weights = [w for d in digests for w in d.weights]
+		if numpy is not None and use_numpy:
+			means = numpy.array(means, dtype=numpy.float64)
+			weights = numpy.array(weights, dtype=numpy.float64)
+			order = numpy.argsort(means, kind="stable")
+			means, weights = means[order], weights[order]
+		else:
+			pairs = sorted(zip(means, weights), key=lambda p: p[0])
+			means = [m for m, w in pairs]
+			weights = [w for m, w in pairs]
+		rv = cls._compress(means, weights, compression, use_numpy)
+		if digests:
+			rv.min = min(d.min for d in digests)
+			rv.max = max(d.max for d in digests)
+		return rv
+
+	@classmethod
+	def _compress(cls, means, weights, compression, use_numpy):
+		"""Return a digest made from sorted centroids, merging
+		neighbours whose combined span of the scale function
+		k(q) = compression / 2pi * asin(2q - 1) is less than 1
+		"""
+		if not len(means):
+			return cls(compression=compression)
+		lo, hi = float(means[0]), float(means[-1])
+		scale = compression / (2 * math.pi)
+		if numpy is not None and use_numpy:
+			total = weights.sum()
+			# The quantile at the left edge of each centroid
+			q = (numpy.cumsum(weights) - weights) / total
+			group = numpy.floor(scale * numpy.arcsin(2 * q - 1) + compression / 4)
+			starts = numpy.flatnonzero(numpy.diff(group, prepend=-1))
+			w = numpy.add.reduceat(weights, starts)
+			m = numpy.add.reduceat(means * weights, starts) / w
+			return cls(m.tolist(), w.tolist(), lo, hi, compression)
+
+		total = float(sum(weights))
+		out_means, out_weights = [], []
+		last = None
+		left = 0.0
+		for mean, weight in zip(means, weights):
+			group = math.floor(scale * math.asin(2 * left / total - 1)
+							   + compression / 4)
+			left += weight
+			if group != last:
+				out_means.append(mean * weight)
+				out_weights.append(weight)
+				last = group
+			else:
+				out_means[-1] += mean * weight
+				out_weights[-1] += weight
+		return cls([m / w for m, w in zip(out_means, out_weights)], out_weights,
+				   lo, hi, compression)
+
+	@property
+	def count(self):
+		return sum(self.weights)
+
+	def quantiles(self, qs):
+		"""Return estimates of the values at each of the quantiles qs
+		(each between 0 and 1), or NaNs if the digest is empty
+		"""
+		if not self.means:
+			return [float("nan")] * len(qs)
+		# Each centroid is taken to be centred on the middle of its
+		# share of the ranks, with the extremes at either end
+		positions = [0.0]
+		means = [self.min]
+		rank = 0.0
+		for mean, weight in zip(self.means, self.weights):
+			positions.append(rank + weight / 2)
+			means.append(mean)
+			rank += weight
+		positions.append(rank)
+		means.append(self.max)
+
+		rv = []
+		for q in qs:
+			target = q * rank
+			i = bisect.bisect_right(positions, target)
+			if i >= len(positions):
+				rv.append(self.max)
+				continue
+			x0, x1 = positions[i - 1], positions[i]
+			y0, y1 = means[i - 1], means[i]
+			rv.append(y0 if x1 == x0 else y0 + (y1 - y0) * (target - x0) / (x1 - x0))
+		return rv
+
+	def to_bytes(self):
+		"""Return the digest serialised as bytes
+		"""
+		body = array.array("d", self.means)
+		body.extend(self.weights)
+		if sys.byteorder != "little":
+			body.byteswap()
+		return (_HEADER.pack(len(self.means), self.compression, self.min, self.max)
+				+ body.tobytes())
+
+	@classmethod
+	def from_bytes(cls, buf):
+		"""Return a digest serialised by to_bytes()
+		"""
+		n, compression, lo, hi = _HEADER.unpack_from(buf)
+		body = array.array("d")
+		body.frombytes(bytes(buf[_HEADER.size:_HEADER.size + 16 * n]))
+		if sys.byteorder != "little":
+			body.byteswap()
+		return cls(body[:n].tolist(), body[n:].tolist(), lo, hi, compression)
+
+def parse_percentiles(text):
+	"""Parse a comma-separated list of percentiles, such as
+	"p50,p95,p99.9", into a list of quantiles (0.5, 0.95, 0.999).
+	Raises ValueError if any isn't pN with 0 <= N <= 100.
+	"""
+	rv = []
+	for item in text.split(","):
+		item = item.strip().lower()
+		if not item.startswith("p"):
+			raise ValueError("Not a percentile: {0}".format(item))
+		pc = float(item[1:])
+		if not 0 <= pc <= 100:
+			raise ValueError("Percentile out of range: {0}".format(item))
+		rv.append(pc / 100)
+	return rv
+
+def percentiles(sketches, qs, interval, origin=0, sid=None):
+	"""Merge a list of (bucket start, TDigest), sorted by time, into
+	intervals of interval microseconds (aligned to the timestamp
+	origin), and return a ValueArray of the start of each interval
+	with any data, and its estimates of the values at the quantiles
+	qs. With NumPy, the values are a two-dimensional array; otherwise
+	a list of tuples.
+	"""
+	stamps = []
+	rows = []
+	group = []
+	for start, digest in sketches:
+		slot = (arrays.to_stamp(start) - origin) // interval
+		if group and slot != group[0]:
+			_add_interval(stamps, rows, group, qs, interval, origin)
+			group = []
+		if not group:
+			group.append(slot)
+		group.append(digest)
+	if group:
+		_add_interval(stamps, rows, group, qs, interval, origin)
+
+	if numpy is not None:
+		return arrays.ValueArray(
+			numpy.array(stamps, dtype=numpy.int64),
+			numpy.array(rows, dtype=numpy.float64).reshape(len(rows), len(qs)), sid)
+	return arrays.ValueArray(array.array("q", stamps), rows, sid)
+
+def _add_interval(stamps, rows, group, qs, interval, origin):
+	slot, digests = group[0], group[1:]
+	digest = digests[0] if len(digests) == 1 else TDigest.merge(digests)
+	if digest.means:
+		stamps.append(origin + slot * interval)
+		rows.append(tuple(digest.quantiles(qs)))
@@ -0,0 +1,255 @@
+"""Write-behind ingest: data points are appended to a local spool, and
+written to the database later, in batches, by a background thread.
+
+The spool is a directory of append-only segment files. Each record in
+a segment is a header (CRC-32, number of points, series ID) followed
+by the points as packed (int64 microseconds since the Unix epoch,
+float64 value) records, as used for binary uploads. A write is only
+acknowledged once it has been fsynced; concurrent writers share an
+fsync, so a burst of requests costs far fewer than one each.
+
+The flusher seals the active segment, opens a new one, and writes the
+sealed segments' points to the database, coalesced into one batch per
+series, before deleting them. Segments left over from a previous run
+(or from a failed flush) are written the same way at start-up, so
+acknowledged data survives a restart. A torn record at the end of a
+segment (from a crash mid-write) is never acknowledged, and is
+dropped.
+
+Spooled data is not visible to readers until it has been flushed.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import fuse.arrays as arrays
+import fuse.metrics as metrics
+
+log = logging.getLogger("spool")
+
+HEADER = struct.Struct("<IIi")
+SUFFIX = ".spool"
+
+class SpoolFull(Exception):
+	"""The spool has reached its size limit: the database is not
+	keeping up, and the client should retry later
+	"""
+	pass
+
+def encode_record(sid, stamps, values):
+	"""Encode a series' points as a spool record
+	"""
+	body = HEADER.pack(0, len(stamps), sid)[4:] + arrays.encode_records(stamps, values)
+	return struct.pack("<I", zlib.crc32(body)) + body
+
+def read_records(f):
+	"""Yield (sid, payload) for each intact record in a segment file,
+	where payload is the packed points
+	"""
+	while True:
+		header = f.read(HEADER.size)
+		if len(header) < HEADER.size:
+			return
+		crc, count, sid = HEADER.unpack(header)
+		payload = f.read(count * arrays.RECORD_SIZE)
+		if (len(payload) < count * arrays.RECORD_SIZE
+			or zlib.crc32(payload, zlib.crc32(header[4:])) != crc):
+			log.warning("Dropping torn record at end of spool %s", f.name)
+			return
+		yield sid, payload
+
+class Spool(object):
+	def __init__(self, db, path, flush_points=50000, flush_seconds=1.0,
+				 max_bytes=1 << 28, registry=metrics.REGISTRY):
+		self.db = db
+		self.path = path
+		self.flush_points = flush_points
+		self.flush_seconds = flush_seconds
+		self.max_bytes = max_bytes
+
+		# lock protects the active segment and the counters. Holders
+		# of sync_lock may take lock, but not the other way round.
+		self.lock = threading.Lock()
+		self.sync_lock = threading.Lock()
+		self.wake = threading.Condition(self.lock)
+		self.file = None
+		self.seq = 0
+		self.written = 0     # Bytes appended, ever
+		self.synced = 0      # Bytes known to be on disk
+		self.pending = 0     # Bytes not yet flushed to the database
+		self.pending_points = 0
+		self.stopping = False
+		self.thread = None
+
+		self.size = registry.gauge(
+			"fuse_spool_bytes", "Bytes of spooled data awaiting the database")
+		self.flushed = registry.counter(
+			"fuse_spool_flushed_points_total",
+			"Spooled data points written to the database")
+		self.unchanged = registry.counter(
+			"fuse_spool_unchanged_points_total",
+			"Spooled data points which were already stored with the same value")
+		self.rejected = registry.counter(
+			"fuse_spool_rejected_points_total",
+			"Spooled data points which the database would not store")
+		self.refused = registry.counter(
+			"fuse_spool_refused_total",
+			"Writes refused because the spool was full")
+
+	def start(self):
+		"""Replay any segments left from a previous run, and start the
+		flusher thread
+		"""
+		os.makedirs(self.path, exist_ok=True)
+		segments = self._segments()
+		if segments:
+			self.seq = int(segments[-1][:-len(SUFFIX)])
+			log.info("Replaying %d spool segments", len(segments))
+			for name in segments:
+				self.pending += os.path.getsize(os.path.join(self.path, name))
+			try:
+				self._flush_segments(segments)
+			except Exception as ex:
+				log.error("Spool replay failed; will retry", exc_info=ex)
+		self._open()
+		self.thread = threading.Thread(target=self._run, name="spool",
+									   daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""Stop the flusher, after flushing everything spooled so far
+		"""
+		with self.lock:
+			self.stopping = True
+			self.wake.notify()
+		if self.thread is not None:
+			self.thread.join()
+		self.flush()
+
+	def append(self, sid, stamps, values):
+		"""Spool points for a series, returning once they are on disk.
+		Raises SpoolFull if the spool is over its size limit.
+		"""
+		if not len(stamps):
+			return
+		record = encode_record(sid, stamps, values)
+		with self.lock:
+			if self.pending >= self.max_bytes:
+				self.refused.inc()
+				raise SpoolFull()
+			self.file.write(record)
+			self.written += len(record)
+			self.pending += len(record)
+			self.pending_points += len(stamps)
+			ticket = self.written
+			if self.pending_points >= self.flush_points:
+				self.wake.notify()
+		self._sync(ticket)
+		self.size.set((), self.pending)
+
+	def _sync(self, ticket):
+		"""Make sure the first ticket bytes written are on disk. Whoever
+		gets the sync lock syncs everything written so far, so writers
+		queued behind it usually find their data already synced.
+		"""
+		with self.sync_lock:
+			if self.synced >= ticket:
+				return
+			with self.lock:
+				f = self.file
+				upto = self.written
+				f.flush()
+			os.fsync(f.fileno())
+			self.synced = upto
+
+	def _segments(self):
+		return sorted(n for n in os.listdir(self.path) if n.endswith(SUFFIX))
+
+	def _open(self):
+		self.seq += 1
+		self.file = open(os.path.join(self.path, "{0:012d}{1}".format(
+			self.seq, SUFFIX)), "ab")
+
+	def _seal(self):
+		"""Close the active segment and start a new one. Returns the
+		names of the segments awaiting the database.
+		"""
+		with self.sync_lock:
+			with self.lock:
+				self.file.flush()
+				os.fsync(self.file.fileno())
+				self.synced = self.written
+				self.file.close()
+				self._open()
+				self.pending_points = 0
+		return self._segments()[:-1]
+
+	def _run(self):
+		while True:
+			with self.lock:
+				if (not self.stopping
+					and self.pending_points < self.flush_points):
+					self.wake.wait(self.flush_seconds)
+				if self.stopping:
+					return
+				if not self.pending:
+					continue
+			try:
+				self.flush()
+			except Exception as ex:
+				log.error("Spool flush failed; will retry", exc_info=ex)
+				time.sleep(self.flush_seconds)
+			finally:
+				release = getattr(self.db, "release", None)
+				if release is not None:
+					release()
+
+	def flush(self):
+		"""Write everything spooled so far to the database
+		"""
+		self._flush_segments(self._seal())
+
+	def _flush_segments(self, segments):
+		"""Write the points in the given segments to the database, one
+		batch per series (later points overriding earlier ones with
+		the same timestamp), and delete the segments
+		"""
+		if not segments:
+			return
+		batches = {}
+		size = 0
+		for name in segments:
+			fname = os.path.join(self.path, name)
+			size += os.path.getsize(fname)
+			with open(fname, "rb") as f:
+				for sid, payload in read_records(f):
+					batches.setdefault(sid, []).append(payload)
+
+		for sid, payloads in batches.items():
+			stamps, values = arrays.decode_records(b"".join(payloads))
+			if not self.db.is_series(sid):
+				log.error("Spooled data for missing series dropped: series=%s, %d points",
+						  sid, len(stamps))
+				self.rejected.inc((), len(stamps))
+				continue
+			bad, written = self.db.add_values_array(sid, stamps, values)
+			if bad and len(bad) == len(stamps):
+				# The whole batch failed: most likely the database
+				# is unavailable. Keep the segments and try again.
+				raise IOError("Database write of series {0} failed".format(sid))
+			if bad:
+				log.error("Spooled data rejected by database: series=%s, %d points",
+						  sid, len(bad))
+				self.rejected.inc((), len(bad))
+			self.flushed.inc((), len(stamps) - len(bad))
+			self.unchanged.inc((), len(stamps) - len(bad) - written)
+
+		for name in segments:
+			os.unlink(os.path.join(self.path, name))
+		with self.lock:
+			self.pending -= size
+		self.size.set((), self.pending)
@@ -0,0 +1,317 @@
+"""Recent-data cache: the most recent window of each series being read
+is kept in memory, so that reads asking only for recent data (which
+most do) don't need the database.
+
+A series' tail holds every stored point from its start time onwards,
+as parallel arrays of timestamps and values in time order. It is
+loaded from the database on the first read inside the window, and
+kept up to date as data is written through this process, late points
+and overwrites included. Writes made by other processes arrive as
+database notifications (see live_notify), so with several server
+processes a tail may lag another's write by the notification delay.
+The start time follows the window forward, and older points are
+dropped in batches.
+
+The cache's listener is the process's only one: anything else asking
+the database to listen (such as the live update hub) is passed the
+notifications it receives.
+
+The cache holds at most tail_max_points points in all; beyond that,
+the tails of the least recently used series are dropped whole.
+"""
+
+import logging
+import datetime
+import time
+import threading
+import bisect
+import array
+import collections
+
+import fuse.arrays as arrays
+import fuse.metrics as metrics
+
+log = logging.getLogger("tailcache")
+
+_UTC = datetime.timezone.utc
+_USEC = datetime.timedelta(microseconds=1)
+
+# Points before a tail's start are only deleted once they make up at
+# least 1/TRIM_FRACTION of the tail, so that the arrays are shifted
+# down at most once for each such share of them dropped, rather than
+# on every write
+TRIM_FRACTION = 8
+
+def _to_array(typecode, seq):
+	"""Copy a sequence of numbers into an array.array
+	"""
+	rv = array.array(typecode)
+	if getattr(seq, "itemsize", None) == rv.itemsize and hasattr(seq, "tobytes"):
+		rv.frombytes(seq.tobytes())
+	else:
+		rv.extend(seq)
+	return rv
+
+class _Tail(object):
+	"""The recent points of a series: every point stored at or after
+	start (in microseconds since the Unix epoch), in time order
+	"""
+	__slots__ = ("start", "stamps", "values")
+
+	def __init__(self, start, stamps, values):
+		self.start = start
+		self.stamps = stamps
+		self.values = values
+
+	def store(self, stamps, values):
+		"""Store points, overwriting any already held for the same
+		times (the last of a batch for the same time winning). Points
+		before the start are ignored. The batch is sorted, and merged
+		in one pass with the points held from its first time onwards.
+		"""
+		batch = {}
+		for ts, value in zip(stamps, values):
+			ts = int(ts)
+			if ts >= self.start:
+				batch[ts] = value
+		if not batch:
+			return
+		new = sorted(batch)
+		i = bisect.bisect_left(self.stamps, new[0])
+		old_stamps = self.stamps[i:]
+		old_values = self.values[i:]
+		del self.stamps[i:]
+		del self.values[i:]
+		j = 0
+		for ts in new:
+			k = bisect.bisect_left(old_stamps, ts, j)
+			self.stamps.extend(old_stamps[j:k])
+			self.values.extend(old_values[j:k])
+			self.stamps.append(ts)
+			self.values.append(batch[ts])
+			j = k + 1 if k < len(old_stamps) and old_stamps[k] == ts else k
+		self.stamps.extend(old_stamps[j:])
+		self.values.extend(old_values[j:])
+
+	def trim(self, start):
+		"""Move the start forward, and delete the points before it if
+		there are enough of them. Returns the number deleted.
+		"""
+		if start <= self.start:
+			return 0
+		self.start = start
+		n = bisect.bisect_left(self.stamps, start)
+		if not n or n < len(self.stamps) // TRIM_FRACTION:
+			return 0
+		del self.stamps[:n]
+		del self.values[:n]
+		return n
+
+	def slice(self, first, last=None):
+		"""Return copies of the stamps and values from first up to (but
+		not including) last
+		"""
+		i = bisect.bisect_left(self.stamps, first)
+		j = len(self.stamps) if last is None else bisect.bisect_left(self.stamps, last)
+		return self.stamps[i:j], self.values[i:j]
+
+class TailCache(object):
+	"""Mixin for a Database class, serving reads of recent data from
+	memory. Use cached() to make the combined class.
+	"""
+	def __init__(self, conf):
+		super().__init__(conf)
+		self.tail_window = (datetime.timedelta(
+			seconds=getattr(conf, "tail_window_seconds", 86400)) // _USEC)
+		self.tail_max_points = getattr(conf, "tail_max_points", 1 << 22)
+		self.tail_lock = threading.Lock()
+		self.tails = collections.OrderedDict()
+		self.tail_points = 0
+		# Points written to series whose tails are being loaded, to be
+		# applied once they have been
+		self.tail_warming = {}
+		# Callbacks passed to listen(), called for each notification
+		# the cache's listener receives
+		self.tail_listeners = []
+		self.tail_listening = False
+
+		reg = metrics.REGISTRY
+		self.tail_reads = reg.counter(
+			"fuse_tail_reads_total",
+			"Reads of recent data, by whether they were served from the "
+			"cache, loaded it, or went to the database", ("result",))
+		self.tail_size = reg.gauge(
+			"fuse_tail_points", "Data points held in the recent-data cache")
+		self.tail_evictions = reg.counter(
+			"fuse_tail_evictions_total",
+			"Series dropped from the recent-data cache to keep it within "
+			"its size limit")
+
+		# Tails aren't loaded until notifications of other processes'
+		# writes can be relied on
+		self.tail_ready = time.monotonic()
+		if getattr(conf, "live_notify", True):
+			super().listen(self._tail_notified)
+			self.tail_listening = True
+			self.tail_ready += getattr(self, "notify_delay", 0.0)
+
+	def listen(self, callback):
+		"""Call callback(sid, ValueArray) with new data, as the database
+		class does, but from the cache's own listener where it has one,
+		rather than opening another
+		"""
+		if not self.tail_listening:
+			return super().listen(callback)
+		with self.tail_lock:
+			self.tail_listeners.append(callback)
+
+	def _tail_cutoff(self):
+		return arrays.to_stamp(datetime.datetime.now(_UTC)) - self.tail_window
+
+	def get_values(self, sid, from_ts=None, to_ts=None):
+		data = self._tail_read(sid, from_ts, to_ts)
+		if data is None:
+			return super().get_values(sid, from_ts, to_ts)
+		return iter(data)
+
+	def get_values_array(self, sid, from_ts=None, to_ts=None):
+		data = self._tail_read(sid, from_ts, to_ts)
+		if data is None:
+			return super().get_values_array(sid, from_ts, to_ts)
+		return data
+
+	def _tail_read(self, sid, from_ts, to_ts):
+		"""Return a ValueArray of the points in the given range from the
+		series' tail (loading it if need be), or None if the range
+		isn't within the window
+		"""
+		start = self._tail_cutoff()
+		if (from_ts is None or arrays.to_stamp(from_ts) < start
+			or time.monotonic() < self.tail_ready):
+			self.tail_reads.inc(("database",))
+			return None
+		first = arrays.to_stamp(from_ts)
+		last = None if to_ts is None else arrays.to_stamp(to_ts)
+
+		with self.tail_lock:
+			tail = self.tails.get(sid)
+			if tail is not None:
+				self.tails.move_to_end(sid)
+				self.tail_points -= tail.trim(start)
+				stamps, values = tail.slice(first, last)
+				result = "hit"
+			elif sid in self.tail_warming:
+				# Another thread is loading it
+				result = "database"
+			else:
+				self.tail_warming[sid] = []
+				result = "load"
+		self.tail_reads.inc((result,))
+		if result == "database":
+			return None
+		if result == "load":
+			tail = self._tail_load(sid, start)
+			with self.tail_lock:
+				stamps, values = tail.slice(first, last)
+		return arrays.ValueArray(stamps, values, sid)
+
+	def _tail_load(self, sid, start):
+		"""Load the tail of a series, from start onwards, from the
+		database (its primary, where it has read replicas, so that the
+		tail has every write the notifications won't repeat), and add
+		it to the cache
+		"""
+		read = getattr(super(), "get_values_array_primary",
+					   super().get_values_array)
+		try:
+			data = read(sid, arrays.to_datetime(start))
+		except:
+			with self.tail_lock:
+				del self.tail_warming[sid]
+			raise
+		tail = _Tail(start, _to_array("q", data.stamps), _to_array("d", data.values))
+		with self.tail_lock:
+			for stamps, values in self.tail_warming.pop(sid):
+				tail.store(stamps, values)
+			self.tails[sid] = tail
+			self.tail_points += len(tail.stamps)
+			self._tail_evict()
+		return tail
+
+	def _tail_store(self, sid, stamps, values):
+		"""Apply written points to the series' tail, if it is cached
+		"""
+		with self.tail_lock:
+			pending = self.tail_warming.get(sid)
+			if pending is not None:
+				pending.append((list(stamps), list(values)))
+			tail = self.tails.get(sid)
+			if tail is None:
+				return
+			self.tails.move_to_end(sid)
+			size = len(tail.stamps)
+			tail.trim(self._tail_cutoff())
+			tail.store(stamps, values)
+			self.tail_points += len(tail.stamps) - size
+			self._tail_evict()
+
+	def _tail_evict(self):
+		"""Drop the least recently used tails until the cache is within
+		its size limit. Called with the lock held.
+		"""
+		while self.tail_points > self.tail_max_points and self.tails:
+			sid, tail = self.tails.popitem(last=False)
+			self.tail_points -= len(tail.stamps)
+			self.tail_evictions.inc()
+		self.tail_size.set((), self.tail_points)
+
+	def _tail_drop(self, sid):
+		with self.tail_lock:
+			tail = self.tails.pop(sid, None)
+			if tail is not None:
+				self.tail_points -= len(tail.stamps)
+				self.tail_size.set((), self.tail_points)
+
+	def _tail_notified(self, sid, data):
+		self._tail_store(sid, data.stamps, data.value_list())
+		for callback in list(self.tail_listeners):
+			callback(sid, data)
+
+	def add_value(self, sid, ts, value):
+		rv = super().add_value(sid, ts, value)
+		if rv:
+			self._tail_store(sid, [arrays.to_stamp(ts)],
+							 [float("nan") if value is None else float(value)])
+		return rv
+
+	def add_values_array(self, sid, stamps, values):
+		bad, written = super().add_values_array(sid, stamps, values)
+		if written:
+			if bad:
+				failed = set(bad)
+				keep = [i for i in range(len(stamps)) if i not in failed]
+				stamps = [stamps[i] for i in keep]
+				values = [values[i] for i in keep]
+			self._tail_store(sid, stamps, values)
+		return bad, written
+
+	def expire(self, sid, before, bucket, limit):
+		n = super().expire(sid, before, bucket, limit)
+		if n:
+			# Points before this may have gone: leave them to the
+			# database
+			with self.tail_lock:
+				tail = self.tails.get(sid)
+				if tail is not None:
+					self.tail_points -= tail.trim(arrays.to_stamp(before))
+		return n
+
+	def drop_series(self, sid):
+		super().drop_series(sid)
+		self._tail_drop(sid)
+
+def cached(cls):
+	"""Return a subclass of the Database class cls which serves reads of
+	recent data from memory
+	"""
+	return type(cls.__name__, (TailCache, cls), {})
@@ -0,0 +1,120 @@
+"""Lightweight per-request tracing.
+
+A Trace is a list of named spans, each recorded as (name, start,
+duration) with times taken from time.perf_counter(). The trace for
+the request being served is held in a thread-local, so code at any
+level (API handlers, content negotiation, the database layer) can
+record spans without having the trace passed down to it:
+
+	with trace.span("is_series"):
+		...
+
+When no trace is active, a span costs a thread-local lookup and
+nothing else.
+"""
+
+import threading
+import time
+
+# Spans beyond this many in one trace are only kept as totals
+MAX_SPANS = 500
+
+_local = threading.local()
+
+class Trace(object):
+	"""The spans recorded for a single request. A request which
+	records very many spans (e.g. parsing every timestamp of a large
+	upload) keeps only the first MAX_SPANS individually; the rest are
+	summed by name in overflow. A request which failed with an
+	exception has it (as a string) in error.
+	"""
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.wall = time.time()
+		self.spans = []
+		self.overflow = {}
+		self.error = None
+
+	def add(self, name, start, duration):
+		if len(self.spans) < MAX_SPANS:
+			self.spans.append((name, start, duration))
+		else:
+			self.overflow[name] = self.overflow.get(name, 0.0) + duration
+
+	def totals(self):
+		"""Return a list of (name, total duration) pairs, summing the
+		spans with the same name, in the order each name was first
+		seen.
+		"""
+		totals = {}
+		order = []
+		spans = [(name, duration) for name, start, duration in self.spans]
+		for name, duration in spans + list(self.overflow.items()):
+			if name not in totals:
+				order.append(name)
+				totals[name] = 0.0
+			totals[name] += duration
+		return [(name, totals[name]) for name in order]
+
+	def server_timing(self, total):
+		"""Render the spans as the value of a Server-Timing header.
+		Durations are in milliseconds.
+		"""
+		parts = ["{0};dur={1:.3f}".format(name, duration * 1000)
+				 for name, duration in self.totals()]
+		parts.append("total;dur={0:.3f}".format(total * 1000))
+		return ", ".join(parts)
+
+	def as_dict(self):
+		"""Return the spans as a serialisable structure, with offsets
+		relative to the start of the trace. Times are in milliseconds.
+		"""
+		return [[name,
+				 round((start - self.start) * 1000, 3),
+				 round(duration * 1000, 3)]
+				for name, start, duration in self.spans]
+
+def begin():
+	"""Start a new trace for the current thread, and return it
+	"""
+	t = Trace()
+	_local.trace = t
+	return t
+
+def end():
+	"""Stop tracing on the current thread
+	"""
+	_local.trace = None
+
+def current():
+	"""Return the current thread's trace, or None
+	"""
+	return getattr(_local, "trace", None)
+
+def add(name, start, duration):
+	"""Record a span which has already been timed by the caller
+	"""
+	t = getattr(_local, "trace", None)
+	if t is not None:
+		t.add(name, start, duration)
+
+class span(object):
+	"""Context manager which records the time spent inside it as a
+	named span of the current trace
+	"""
+	__slots__ = ("name", "trace", "start")
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.trace = getattr(_local, "trace", None)
+		if self.trace is not None:
+			self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, typ, value, tb):
+		if self.trace is not None:
+			self.trace.add(self.name, self.start,
+						   time.perf_counter() - self.start)
+		return False
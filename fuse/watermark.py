@@ -0,0 +1,108 @@
+"""Watermarks for incremental sync by ingest time.
+
+Every data point records when it was written (its ingest time). A
+watermark marks a position in the order (ingest, series, stamp): a
+client which has fetched everything up to a watermark only needs the
+points after it. A watermark is passed around as an opaque token,
+either just an ingest time ("everything written up to and including
+this time"), or an ingest time, series and stamp (the last point of a
+page of results, when there were more to come). Times are in
+microseconds since the Unix epoch.
+
+Points are only returned once they are older than a settle lag, so
+that a write which took its ingest time before a sync but committed
+after it is not missed. The PostgreSQL backend also holds the horizon
+back to before the start of any transaction still writing, however
+long it takes to commit.
+"""
+
+import datetime
+
+import fuse.arrays as arrays
+
+_UTC = datetime.timezone.utc
+_MAX_SID = 2 ** 31 - 1
+_MAX_STAMP = datetime.datetime.max.replace(tzinfo=_UTC)
+
+class Watermark(object):
+	__slots__ = ("ingest", "sid", "stamp")
+
+	def __init__(self, ingest, sid=None, stamp=None):
+		self.ingest = ingest
+		self.sid = sid
+		self.stamp = stamp
+
+	@classmethod
+	def parse(cls, token):
+		"""Parse a token, raising ValueError if it is malformed or out
+		of range
+		"""
+		parts = [int(p) for p in token.split(".")]
+		if len(parts) == 1:
+			rv = cls(parts[0])
+		elif len(parts) == 3:
+			rv = cls(*parts)
+		else:
+			raise ValueError("Malformed watermark '{0}'".format(token))
+		if rv.sid is not None and not -_MAX_SID - 1 <= rv.sid <= _MAX_SID:
+			raise ValueError("Watermark out of range '{0}'".format(token))
+		try:
+			rv.key()
+		except OverflowError:
+			raise ValueError("Watermark out of range '{0}'".format(token))
+		return rv
+
+	def __str__(self):
+		if self.sid is None:
+			return str(self.ingest)
+		return "{0}.{1}.{2}".format(self.ingest, self.sid, self.stamp)
+
+	def __repr__(self):
+		return "Watermark({0})".format(self)
+
+	def __eq__(self, other):
+		return (isinstance(other, Watermark)
+				and (self.ingest, self.sid, self.stamp)
+				== (other.ingest, other.sid, other.stamp))
+
+	def key(self):
+		"""Return the (ingest, series, stamp) position as a tuple of
+		datetime, int and datetime, for comparison with rows of the
+		data table
+		"""
+		if self.sid is None:
+			return (arrays.to_datetime(self.ingest), _MAX_SID, _MAX_STAMP)
+		return (arrays.to_datetime(self.ingest), self.sid,
+				arrays.to_datetime(self.stamp))
+
+def horizon(settle):
+	"""Return the latest ingest time (as a datetime) which a sync may
+	return, given the settle lag as a timedelta
+	"""
+	return datetime.datetime.now(_UTC) - settle
+
+def next_watermark(since, rows, limit, horizon):
+	"""Work out the watermark following a page of changes. rows is the
+	list of (ingest, sid, stamp, value) returned, in order, with times
+	as datetimes. If the page was full, there may be more to come, so
+	the watermark is the last row's position; otherwise the client
+	has everything up to the horizon.
+	"""
+	if limit is not None and len(rows) >= limit:
+		ingest, sid, stamp, value = rows[-1]
+		return Watermark(arrays.to_stamp(ingest), sid, arrays.to_stamp(stamp))
+	return Watermark(max(since.ingest, arrays.to_stamp(horizon)))
+
+def group(rows):
+	"""Group a list of (ingest, sid, stamp, value) rows into a dict
+	mapping each series ID to a ValueArray of its points, sorted by
+	time
+	"""
+	series = {}
+	for ingest, sid, stamp, value in rows:
+		series.setdefault(sid, []).append((arrays.to_stamp(stamp), value))
+	rv = {}
+	for sid, points in series.items():
+		points.sort()
+		rv[sid] = arrays.from_points(points, sid)
+	return rv
@@ -5,14 +5,28 @@
 import unittest
 import datetime
 import json
+import struct
+import io
+import wsgiref.util
+import wsgiref.simple_server
 
 from mock import Mock, ANY, call
+from selector import Selector
 
 import test.test_config as config
 import fuse.api
+import fuse.muddleware
+import fuse.arrays
+import fuse.watermark
+import fuse.live
+import fuse.spool
+import fuse.sketch
+import fuse.metrics
 
 _UTC = datetime.timezone.utc
 _P15 = datetime.timezone(datetime.timedelta(0, 900))
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+USEC = datetime.timedelta(microseconds=1)
 
 class TestAPI(unittest.TestCase):
 	def setUp(self):
@@ -24,6 +38,7 @@ class TestAPI(unittest.TestCase):
 					 "CONTENT_LENGTH": len(self.input.read()),
 					 "wsgi.input": self.input, }
 		self.res = Mock()
+		self.res.headers = {}
 		fuse.api.log = Mock()
 		self.api = fuse.api.APIWrapper(config, self.db, mapper)
 
@@ -46,6 +61,37 @@ class TestAPI_NoSeries(TestAPI):
 			 b'"epoch": "2012-08-28T16:30:00.000000+0015", "type": "period", '
 			 b'"id": 150, "period": 900}}'])
 
+	def test_SeriesList_Query(self):
+		self.db.list_series.return_value = {}
+		self.req["QUERY_STRING"] = "name=meter&type=mean&period=600-1800&after=7&limit=20"
+		self.api.get_series_list(self.req, self.res)
+		self.db.list_series.assert_called_once_with(
+			name="meter", ts_type="mean", after=7, limit=20,
+			period=[datetime.timedelta(seconds=600), datetime.timedelta(seconds=1800)])
+		self.assertNotIn("Link", self.res.headers)
+
+	def test_SeriesList_Page(self):
+		self.db.list_series.return_value = { 8: {}, 9: {} }
+		self.req["PATH_INFO"] = "/api/series/"
+		self.req["QUERY_STRING"] = "prefix=site&limit=2&after=7&period=900"
+		self.api.get_series_list(self.req, self.res)
+		self.db.list_series.assert_called_once_with(
+			prefix="site", after=7, limit=2, period=datetime.timedelta(seconds=900))
+		self.assertEqual(self.res.headers["Link"],
+						 '</api/series/?prefix=site&limit=2&period=900&after=9>; rel="next"')
+
+	def test_SeriesList_Default(self):
+		self.db.list_series.return_value = {}
+		self.req["QUERY_STRING"] = "limit=1000000"
+		self.api.get_series_list(self.req, self.res)
+		self.db.list_series.assert_called_once_with(limit=config.series_page_max)
+
+	def test_SeriesList_Bad(self):
+		self.req["QUERY_STRING"] = "limit=0"
+		self.api.get_series_list(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+		self.assertFalse(self.db.list_series.called)
+
 	def test_CreateSeries(self):
 		self.db.create_series = Mock(return_value=130)
 		self.api.add_series(self.req, self.res)
@@ -141,23 +187,111 @@ class TestAPI_AddData(TestAPI_WithSeries):
 		fuse.api.log.warn.assert_called_once_with(ANY, ANY, "Ceci n'est pas un string", "")
 		self.assertEqual(self.res.result, "400 Not readable JSON")
 
+	def _stamp(self, *args):
+		return (datetime.datetime(*args, tzinfo=_P15) - EPOCH) // USEC
+
 	def test_AddData_Single(self):
+		self.db.add_values_array.return_value = ([], 1)
 		self._set_input(b'[["2012-08-28T12:00:00+0015", 42]]')
 		self.api.add_data(self.req, self.res)
-		self.db.add_value.assert_called_once_with(
-			19, datetime.datetime(2012, 8, 28, 12, 0, 0, 0, _P15), 42)
+		self.db.add_values_array.assert_called_once_with(
+			19, [self._stamp(2012, 8, 28, 12, 0, 0)], [42.0])
 		self.assertEqual(self.res.data.binary, [])
 
 	def test_AddData_Multiple(self):
+		self.db.add_values_array.return_value = ([], 1)
 		self._set_input(b'[["2012-08-28T13:00:00+0015", 42],'
 						b'["2012-08-28T13:30:00+0015", 28]]')
 		self.api.add_data(self.req, self.res)
-		self.db.add_value.assert_has_calls(
-			[call(19, datetime.datetime(2012, 8, 28, 13, 0, 0, 0, _P15), 42),
-			 call(19, datetime.datetime(2012, 8, 28, 13, 30, 0, 0, _P15), 28)],
-			any_order=True)
+		self.db.add_values_array.assert_called_once_with(
+			19, [self._stamp(2012, 8, 28, 13, 0, 0),
+				 self._stamp(2012, 8, 28, 13, 30, 0)], [42.0, 28.0])
+		self.assertEqual(self.res.data.binary, [])
+		self.assertEqual(self.res.headers["X-Fuse-Written"], "1")
+		self.assertEqual(self.res.headers["X-Fuse-Unchanged"], "1")
+
+	def test_AddData_Null(self):
+		self.db.add_values_array.return_value = ([], 1)
+		self._set_input(b'[["2012-08-28T12:00:00+0015", null]]')
+		self.api.add_data(self.req, self.res)
+		sid, stamps, values = self.db.add_values_array.call_args[0]
+		self.assertEqual(len(values), 1)
+		self.assertNotEqual(values[0], values[0])
 		self.assertEqual(self.res.data.binary, [])
 
+	def test_AddData_Partial(self):
+		self.db.add_values_array.return_value = ([1], 1)
+		self._set_input(b'[["2012-08-28T13:00:00+0015", 42],'
+						b'["2012-08-28T13:30:00+0015", 28], ["never", 3]]')
+		self.api.add_data(self.req, self.res)
+		self.assertEqual(self.res.result, "206 Partial update")
+		self.assertEqual(self.res.data.binary,
+						 [["never", 3], ["2012-08-28T13:30:00+0015", 28]])
+
+
+class TestAPI_AddDataPacked(TestAPI_WithSeries):
+	def setUp(self):
+		TestAPI_WithSeries.setUp(self)
+		self.req["CONTENT_TYPE"] = "application/octet-stream"
+		self.db.add_values_array.return_value = ([], 2)
+
+	def test_AddData_Packed(self):
+		self._set_input(struct.pack("<qdqd", 5, 1.5, -7, 2.0))
+		self.api.add_data(self.req, self.res)
+		sid, stamps, values = self.db.add_values_array.call_args[0]
+		self.assertEqual(sid, 19)
+		self.assertEqual((list(stamps), list(values)), ([5, -7], [1.5, 2.0]))
+		self.assertEqual(self.res.data.binary, [])
+
+	def test_AddData_PackedPartial(self):
+		self.db.add_values_array.return_value = ([1], 1)
+		self._set_input(struct.pack("<qdqd", 5, 1.5, -7, 2.0))
+		self.api.add_data(self.req, self.res)
+		self.assertEqual(self.res.result, "206 Partial update")
+		self.assertEqual(self.res.data.binary, [[-7, 2.0]])
+
+	def test_AddData_PackedBadLength(self):
+		self._set_input(b"\0" * 17)
+		self.api.add_data(self.req, self.res)
+		self.assertEqual(self.res.result, "400 Bad request")
+		self.assertFalse(self.db.add_values_array.called)
+
+
+class TestAPI_AddDataSpooled(TestAPI_WithSeries):
+	def setUp(self):
+		TestAPI_WithSeries.setUp(self)
+		self.res.headers = {}
+		self.api.spool = Mock()
+
+	def test_AddData_Spooled(self):
+		self._set_input(b'[["2012-08-28T12:00:00+0000", 42], ["never", 1], [1]]')
+		self.api.add_data(self.req, self.res)
+		self.api.spool.append.assert_called_once_with(
+			19, [1346155200000000], [42.0])
+		self.assertFalse(self.db.add_value.called)
+		self.assertEqual(self.res.result, "206 Partial update")
+		self.assertEqual(self.res.data.binary, [["never", 1], [1]])
+
+	def test_AddData_SpooledPacked(self):
+		self.req["CONTENT_TYPE"] = "application/octet-stream"
+		self._set_input(struct.pack("<qdqd", 5, 1.5, 2**62, 2.0))
+		self.api.add_data(self.req, self.res)
+		sid, stamps, values = self.api.spool.append.call_args[0]
+		self.assertEqual((list(stamps), list(values)), ([5], [1.5]))
+		self.assertEqual(self.res.data.binary, [[2**62, 2.0]])
+
+	def test_AddData_SpoolAccepted(self):
+		self._set_input(b'[["2012-08-28T12:00:00+0000", 42]]')
+		self.api.add_data(self.req, self.res)
+		self.assertEqual(self.res.result, "202 Accepted")
+
+	def test_AddData_SpoolFull(self):
+		self.api.spool.append.side_effect = fuse.spool.SpoolFull
+		self._set_input(b'[["2012-08-28T12:00:00+0000", 42]]')
+		self.api.add_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "503")
+		self.assertEqual(self.res.headers["Retry-After"], "1")
+
 
 class TestAPI_WithSeriesAndData(TestAPI_WithSeries):
 	def setUp(self):
@@ -168,11 +302,13 @@ class TestAPI_WithSeriesAndData(TestAPI_WithSeries):
 			(bd, 33), (bd+d, 35.5), (bd+d*2, 34.0), (bd+d*3, 31.9),
 			(bd+d*4, 33), (bd+d*5, 35.5), (bd+d*6, 34.0), (bd+d*7, 31.9),
 			]
-		self.db.get_values.return_value = iter(self.dataset)
+		self.db.get_values_array.return_value = fuse.arrays.ValueArray(
+			[(ts - EPOCH) // USEC for ts, v in self.dataset],
+			[v for ts, v in self.dataset], 19)
 
 	def testAPI_GetSeriesData_NoFilter(self):
 		self.api.get_data(self.req, self.res)
-		self.db.get_values.assert_called_once_with(19)
+		self.db.get_values_array.assert_called_once_with(19)
 		self.assertCountEqual(list(self.res.data.binary), self.dataset)
 
 	def testAPI_GetSeriesData_BadSeries(self):
@@ -184,7 +320,7 @@ class TestAPI_WithSeriesAndData(TestAPI_WithSeries):
 		self.req["QUERY_STRING"] = "captain=Nemo"
 		self.api.get_data(self.req, self.res)
 		# We should ignore the string and return the original data set
-		self.db.get_values.assert_called_once_with(19)
+		self.db.get_values_array.assert_called_once_with(19)
 		self.assertCountEqual(list(self.res.data.binary), self.dataset)
 
 	def testAPI_GetSeriesData_BadParam1(self):
@@ -200,7 +336,7 @@ class TestAPI_WithSeriesAndData(TestAPI_WithSeries):
 	def testAPI_GetSeriesData_StartOnly(self):
 		self.req["QUERY_STRING"] = "STARTDATE=2012-08-28T13:30:00%2b0000"
 		self.api.get_data(self.req, self.res)
-		self.db.get_values.assert_called_once_with(
+		self.db.get_values_array.assert_called_once_with(
 			19,
 			from_ts=datetime.datetime(2012, 8, 28, 13, 30, 0, 0, datetime.timezone.utc))
 		self.assertCountEqual(list(self.res.data.binary), self.dataset)
@@ -208,7 +344,7 @@ class TestAPI_WithSeriesAndData(TestAPI_WithSeries):
 	def testAPI_GetSeriesData_EndOnly(self):
 		self.req["QUERY_STRING"] = "eNdDaTe=2012-08-28T13:30:00%2b0000"
 		self.api.get_data(self.req, self.res)
-		self.db.get_values.assert_called_once_with(
+		self.db.get_values_array.assert_called_once_with(
 			19,
 			to_ts=datetime.datetime(2012, 8, 28, 13, 30, 0, 0, datetime.timezone.utc))
 		self.assertCountEqual(list(self.res.data.binary), self.dataset)
@@ -216,12 +352,139 @@ class TestAPI_WithSeriesAndData(TestAPI_WithSeries):
 	def testAPI_GetSeriesData_StartEnd(self):
 		self.req["QUERY_STRING"] = "STARTDATE=2012-08-28T13:30:00%2b0000&enddate=2012-08-28T14:30:00%2b0000"
 		self.api.get_data(self.req, self.res)
-		self.db.get_values.assert_called_once_with(
+		self.db.get_values_array.assert_called_once_with(
 			19,
 			from_ts=datetime.datetime(2012, 8, 28, 13, 30, 0, 0, datetime.timezone.utc),
 			to_ts=datetime.datetime(2012, 8, 28, 14, 30, 0, 0, datetime.timezone.utc))
 		self.assertCountEqual(list(self.res.data.binary), self.dataset)
 
+	def testAPI_GetSeriesData_Grid(self):
+		self.req["QUERY_STRING"] = "layout=grid"
+		self.db.list_series.return_value = { 19: {
+			"epoch": datetime.datetime(1970, 1, 1, 0, 15, tzinfo=_UTC),
+			"period": datetime.timedelta(0, 1800) } }
+		self.api.get_data(self.req, self.res)
+		self.db.get_values_array.assert_called_once_with(19)
+		grid = self.res.data.binary.as_json()
+		self.assertEqual(grid["start"], "2012-08-28T11:45:00.000000+0000")
+		self.assertEqual(grid["period"], 1800)
+		self.assertEqual(grid["values"], [v for ts, v in self.dataset])
+		self.assertEqual(grid["offgrid"], [])
+
+	def testAPI_GetSeriesData_GridCSV(self):
+		self.req["QUERY_STRING"] = "layout=grid&type=csv"
+		self.api.get_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+		self.assertFalse(self.db.get_values_array.called)
+
+	def testAPI_GetSeriesData_BadLayout(self):
+		self.req["QUERY_STRING"] = "layout=sideways"
+		self.api.get_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+
+	def testAPI_GetSeriesData_SinceIngest(self):
+		self.req["QUERY_STRING"] = "since_ingest=1000.19.5"
+		self.res.headers = {}
+		self.db.get_changes.return_value = (
+			{ 19: self.db.get_values_array.return_value },
+			fuse.watermark.Watermark(2000))
+		self.api.get_data(self.req, self.res)
+		self.db.get_changes.assert_called_once_with(
+			19, fuse.watermark.Watermark(1000, 19, 5), ANY, ANY)
+		self.assertFalse(self.db.get_values_array.called)
+		self.assertCountEqual(list(self.res.data.binary), self.dataset)
+		self.assertEqual(self.res.headers["X-Fuse-Watermark"], "2000")
+		self.assertEqual(self.res.headers["X-Fuse-Complete"], "true")
+
+	def testAPI_GetSeriesData_SinceIngestBad(self):
+		self.req["QUERY_STRING"] = "since_ingest=yesterday"
+		self.api.get_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+
+	def testAPI_GetSeriesData_SinceIngestOutOfRange(self):
+		self.req["QUERY_STRING"] = "since_ingest=999999999999999999999999999999"
+		self.api.get_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+
+	def decimated(self, query):
+		self.db.get_summaries.return_value = { 19: {
+			"count": len(self.dataset), "first": self.dataset[0][0],
+			"last": self.dataset[-1][0] } }
+		full = self.db.get_values_array.return_value
+		def read(sid, from_ts=None, to_ts=None):
+			keep = [(s, v) for s, v in zip(full.stamps, full.values)
+					if (from_ts is None or s >= fuse.arrays.to_stamp(from_ts))
+					and (to_ts is None or s < fuse.arrays.to_stamp(to_ts))]
+			return fuse.arrays.ValueArray([s for s, v in keep], [v for s, v in keep], sid)
+		self.db.get_values_array.side_effect = read
+		self.req["QUERY_STRING"] = query
+		self.api.get_data(self.req, self.res)
+		return list(self.res.data.binary)
+
+	def testAPI_GetSeriesData_Decimated(self):
+		data = self.decimated("points=4&decimate=minmax")
+		self.assertEqual(data, [self.dataset[i] for i in (1, 3, 5, 7)])
+		self.db.get_values_array.assert_called_once_with(19, from_ts=None, to_ts=None)
+
+	def testAPI_GetSeriesData_DecimatedSlices(self):
+		self.api.decimate_chunk_points = 3
+		data = self.decimated("points=4")
+		self.assertEqual(self.db.get_values_array.call_count, 3)
+		self.assertEqual(len(data), 4)
+		self.assertEqual(data[0], self.dataset[0])
+		self.assertEqual(data[-1], self.dataset[-1])
+
+	def testAPI_GetSeriesData_DecimatedEmpty(self):
+		self.decimated("points=4&startDate=2013-01-01T00:00:00%2b0000")
+		self.assertEqual(len(self.res.data.binary), 0)
+		self.assertFalse(self.db.get_values_array.called)
+
+	def testAPI_GetSeriesData_Percentiles(self):
+		day = datetime.timedelta(days=1)
+		base = datetime.datetime(2012, 8, 27, tzinfo=_UTC)
+		self.db.get_sketches.return_value = [
+			(base + i * day, fuse.sketch.TDigest.from_values([float(i), i + 1.0]))
+			for i in range(3)]
+		self.req["QUERY_STRING"] = "agg=p0,p100&interval=172800&startDate=2012-08-27T12:00:00%2b0000"
+		self.api.get_data(self.req, self.res)
+		self.db.get_sketches.assert_called_once_with(
+			19, from_ts=datetime.datetime(2012, 8, 27, 12, tzinfo=_UTC))
+		self.assertEqual(list(self.res.data.binary),
+						 [(base, (0.0, 2.0)), (base + 2 * day, (2.0, 3.0))])
+		self.assertNotIn("bin", self.req["transformers"])
+
+	def testAPI_GetSeriesData_PercentilesBad(self):
+		for query in ("agg=mean", "agg=p50&interval=3600", "agg=p50&interval=-86400",
+					  "agg=p50&points=100", "agg=p50&layout=grid"):
+			self.res.result = None
+			self.req["QUERY_STRING"] = query
+			self.api.get_data(self.req, self.res)
+			self.assertEqual(self.res.result.split()[0], "400", query)
+		self.assertFalse(self.db.get_sketches.called)
+
+	def testAPI_GetSeriesData_DecimateBad(self):
+		for query in ("points=many", "points=2", "points=10&decimate=mean",
+					  "decimate=lttb"):
+			self.res.result = None
+			self.req["QUERY_STRING"] = query
+			self.api.get_data(self.req, self.res)
+			self.assertEqual(self.res.result.split()[0], "400")
+
+class TestAPI_Changes(TestAPI):
+	def test_Changes(self):
+		self.req["QUERY_STRING"] = "since=1000"
+		self.res.headers = {}
+		data = fuse.arrays.ValueArray([0], [1.5], 4)
+		self.api.sync_limit = 1
+		self.db.get_changes.return_value = ({ 4: data },
+											fuse.watermark.Watermark(1, 4, 0))
+		self.api.get_changes(self.req, self.res)
+		self.db.get_changes.assert_called_once_with(
+			None, fuse.watermark.Watermark(1000), 1, ANY)
+		self.assertEqual(self.res.data.binary, { 4: data })
+		self.assertEqual(self.res.headers["X-Fuse-Watermark"], "1.4.0")
+		self.assertEqual(self.res.headers["X-Fuse-Complete"], "false")
+
 class TestAPI_GetSeriesInfo(TestAPI_WithSeries):
 	def test_GetInfo_NotSeries(self):
 		self.db.is_series.return_value = False
@@ -233,6 +496,207 @@ class TestAPI_GetSeriesInfo(TestAPI_WithSeries):
 		self.db.list_series.assert_called_once_with(sid=19)
 
 
+class TestAPI_AlterSeries(TestAPI_WithSeries):
+	def test_Alter_Retention(self):
+		self._set_input(b'{"retention": 86400}')
+		self.api.alter_series(self.req, self.res)
+		self.db.set_retention.assert_called_once_with(
+			19, datetime.timedelta(days=1))
+		self.db.list_series.assert_called_once_with(sid=19)
+
+	def test_Alter_NoRetention(self):
+		self._set_input(b'{"retention": null}')
+		self.api.alter_series(self.req, self.res)
+		self.db.set_retention.assert_called_once_with(19, None)
+
+	def test_Alter_BadRetention(self):
+		for body in (b'{"retention": -5}', b'{"retention": 1e30}'):
+			self._set_input(body)
+			self.api.alter_series(self.req, self.res)
+			self.assertEqual(self.res.result, "400 Bad syntax")
+		self.assertFalse(self.db.set_retention.called)
+
+	def test_Alter_Other(self):
+		self._set_input(b'{"name": "new", "retention": 5}')
+		self.api.alter_series(self.req, self.res)
+		self.assertEqual(self.res.result, "400 Bad request")
+		self.assertFalse(self.db.set_retention.called)
+
+	def test_Rollup(self):
+		row = (datetime.datetime(2012, 8, 28, 12, 0, tzinfo=_UTC), 2, 1.0, 3.0, 2.0)
+		self.db.get_rollup.return_value = [row]
+		self.req["QUERY_STRING"] = "startDate=2012-08-28T00:00:00%2b0000"
+		self.api.get_rollup(self.req, self.res)
+		self.db.get_rollup.assert_called_once_with(
+			19, from_ts=datetime.datetime(2012, 8, 28, tzinfo=_UTC))
+		self.assertEqual(self.res.data.binary, [row])
+
+
+class TestAPI_Summary(TestAPI):
+	def setUp(self):
+		TestAPI.setUp(self)
+		self.res.headers = {}
+		self.summary = { "count": 2, "min": 1.0, "max": 3.0,
+						 "first": datetime.datetime(2012, 8, 28, 12, 0, tzinfo=_UTC),
+						 "last": datetime.datetime(2012, 8, 28, 12, 30, tzinfo=_UTC),
+						 "latest": 3.0 }
+		self.db.get_summaries.return_value = { 19: self.summary }
+
+	def test_Summary(self):
+		self.req["wsgiorg.routing_args"] = [None, {"series_id": "19"}]
+		self.api.get_summary(self.req, self.res)
+		self.db.get_summaries.assert_called_once_with([19])
+		self.assertEqual(self.res.data.binary, self.summary)
+
+	def test_Summary_NotSeries(self):
+		self.req["wsgiorg.routing_args"] = [None, {"series_id": "20"}]
+		self.api.get_summary(self.req, self.res)
+		self.assertEqual(self.res.result, "404 Not found")
+
+	def test_Summaries_Listed(self):
+		self.req["QUERY_STRING"] = "series=19,20"
+		self.api.get_summaries(self.req, self.res)
+		self.db.get_summaries.assert_called_once_with([19, 20])
+		self.assertFalse(self.db.list_series.called)
+		self.assertEqual(self.res.data.binary, { 19: self.summary })
+
+	def test_Summaries_Page(self):
+		self.req["QUERY_STRING"] = "prefix=site&limit=2"
+		self.db.list_series.return_value = { 21: {}, 19: {} }
+		self.api.get_summaries(self.req, self.res)
+		self.db.list_series.assert_called_once_with(prefix="site", limit=2)
+		self.db.get_summaries.assert_called_once_with([19, 21])
+		self.assertIn("after=21", self.res.headers["Link"])
+
+	def test_Summaries_Bad(self):
+		self.req["QUERY_STRING"] = "series=19,x"
+		self.api.get_summaries(self.req, self.res)
+		self.assertEqual(self.res.result, "400 Unparsable parameter")
+
+
+class TestAPI_Metrics(TestAPI):
+	def test_GetMetrics(self):
+		self.api.registry = Mock()
+		self.api.registry.render.return_value = "metric_name 1\n"
+		self.api.get_metrics(self.req, self.res)
+		self.assertEqual(self.res.data.binary, "metric_name 1\n")
+		xfm = self.req["transformers"]["default"]()
+		self.assertEqual(xfm.transform(self.res.data.binary, self.req),
+						 [b"metric_name 1\n"])
+		self.assertTrue(xfm.mime_type.startswith("text/plain"))
+
+
+class TestAPI_Export(TestAPI_WithSeries):
+	def setUp(self):
+		TestAPI_WithSeries.setUp(self)
+		self.res.headers = {}
+		self.db.export.return_value = [b"series,time,value\n"]
+
+	def test_Export_Series(self):
+		self.req["QUERY_STRING"] = "startDate=2012-08-28T13:30:00%2b0000"
+		self.api.export_data(self.req, self.res)
+		self.db.export.assert_called_once_with(
+			19, from_ts=datetime.datetime(2012, 8, 28, 13, 30, 0, 0, _UTC))
+		self.assertEqual(self.res.data, [b"series,time,value\n"])
+		self.assertNotIn("Content-Encoding", self.res.headers)
+		xfm = self.req["transformers"]["default"]()
+		self.assertTrue(xfm.mime_type.startswith("text/csv"))
+
+	def test_Export_All(self):
+		del self.req["wsgiorg.routing_args"]
+		self.api.export_data(self.req, self.res)
+		self.db.export.assert_called_once_with(None)
+		self.assertFalse(self.db.is_series.called)
+
+	def test_Export_NotSeries(self):
+		self.db.is_series.return_value = False
+		self.api.export_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "404")
+		self.assertFalse(self.db.export.called)
+
+	def test_Export_BadParam(self):
+		self.req["QUERY_STRING"] = "endDate=tomorrow"
+		self.api.export_data(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+
+	def test_Export_Gzip(self):
+		self.req["HTTP_ACCEPT_ENCODING"] = "deflate, gzip;q=0.5"
+		self.api.export_data(self.req, self.res)
+		self.assertEqual(self.res.headers["Content-Encoding"], "gzip")
+		self.assertIsInstance(self.res.data, fuse.muddleware.GzipIterator)
+
+	def test_AcceptsGzip(self):
+		for enc, rv in (("", False), ("gzip", True), ("GZIP;q=0", False),
+						("br, x-gzip; q=0.1", True), ("identity", False)):
+			self.assertEqual(fuse.api.accepts_gzip({"HTTP_ACCEPT_ENCODING": enc}), rv)
+
+
+class TestAPI_Live(TestAPI_WithSeries):
+	def setUp(self):
+		TestAPI_WithSeries.setUp(self)
+		self.res.headers = {}
+		self.api.hub = Mock()
+		self.req["fuse.threaded"] = True
+
+	def test_Live_Series(self):
+		self.api.get_live(self.req, self.res)
+		self.api.hub.subscribe.assert_called_once_with([19])
+		self.db.release.assert_called_once_with()
+		self.assertIsInstance(self.res.data, fuse.live.EventStream)
+		self.assertEqual(self.res.headers["Cache-Control"], "no-cache")
+		xfm = self.req["transformers"]["default"]()
+		self.assertEqual(xfm.mime_type, "text/event-stream")
+
+	def test_Live_List(self):
+		del self.req["wsgiorg.routing_args"]
+		self.req["QUERY_STRING"] = "series=3,4"
+		self.api.get_live(self.req, self.res)
+		self.api.hub.subscribe.assert_called_once_with([3, 4])
+		self.db.is_series.assert_has_calls([call(3), call(4)])
+
+	def test_Live_All(self):
+		del self.req["wsgiorg.routing_args"]
+		self.api.get_live(self.req, self.res)
+		self.api.hub.subscribe.assert_called_once_with(None)
+
+	def test_Live_NotSeries(self):
+		self.db.is_series.return_value = False
+		self.api.get_live(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "404")
+		self.assertFalse(self.api.hub.subscribe.called)
+
+	def test_Live_NotThreaded(self):
+		self.req["fuse.threaded"] = False
+		self.api.get_live(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "503")
+		self.assertFalse(self.api.hub.subscribe.called)
+
+	def test_Live_NotThreadedServer(self):
+		"""Test that a live stream is refused when served through a
+		single-threaded wsgiref server, which still claims
+		wsgi.multithread
+		"""
+		mapper = Selector()
+		fuse.api.APIWrapper(config, self.db, mapper, fuse.metrics.Registry())
+		app = fuse.muddleware.Environ(mapper, { "fuse.threaded": False })
+		environ = { "PATH_INFO": "/api/live" }
+		wsgiref.util.setup_testing_defaults(environ)
+		out = io.BytesIO()
+		handler = wsgiref.simple_server.ServerHandler(
+			io.BytesIO(), out, io.StringIO(), environ)
+		handler.request_handler = Mock()
+		handler.run(app)
+		self.assertTrue(handler.wsgi_multithread)
+		self.assertRegex(out.getvalue(), rb"^HTTP/1\.0 503 ")
+
+	def test_Live_BadList(self):
+		del self.req["wsgiorg.routing_args"]
+		self.req["QUERY_STRING"] = "series=3,x"
+		self.api.get_live(self.req, self.res)
+		self.assertEqual(self.res.result.split()[0], "400")
+		self.assertFalse(self.api.hub.subscribe.called)
+
+
 class TestAPI_FailAs(unittest.TestCase):
 	def setUp(self):
 		fuse.api.log = Mock()
@@ -0,0 +1,208 @@
+"""Unit testing
+"""
+
+import unittest
+import struct
+import datetime
+
+import fuse.arrays as arrays
+
+def copy_buffer(rows, ext=b""):
+	"""Build a binary COPY buffer of (timestamp, float8) rows, with
+	timestamps given in PostgreSQL's microseconds since 2000-01-01
+	"""
+	buf = arrays.PGCOPY_SIGNATURE + struct.pack(">ii", 0, len(ext)) + ext
+	for stamp, value in rows:
+		buf += struct.pack(">hiqid", 2, 8, stamp, 8, value)
+	return buf + arrays.PGCOPY_TRAILER
+
+class TestDecodeCopy(unittest.TestCase):
+	def setUp(self):
+		self.rows = [(-arrays.PG_EPOCH_US - 1, 1.5),
+					 (0, -2.25),
+					 (123456789012, 1e300)]
+		self.expected = ([-1, arrays.PG_EPOCH_US, arrays.PG_EPOCH_US + 123456789012],
+						 [1.5, -2.25, 1e300])
+
+	def check(self, buf, use_numpy):
+		stamps, values = arrays.decode_copy(buf, use_numpy=use_numpy)
+		self.assertEqual((list(stamps), list(values)), self.expected)
+
+	@unittest.skipIf(arrays.numpy is None, "NumPy not installed")
+	def test_NumPy(self):
+		self.check(copy_buffer(self.rows), True)
+
+	def test_Array(self):
+		self.check(copy_buffer(self.rows), False)
+
+	def test_HeaderExtension(self):
+		self.check(copy_buffer(self.rows, ext=b"\0\1\2"), False)
+
+	def test_Empty(self):
+		for use_numpy in (True, False):
+			stamps, values = arrays.decode_copy(copy_buffer([]), use_numpy)
+			self.assertEqual((len(stamps), len(values)), (0, 0))
+
+	def test_BadSignature(self):
+		self.assertRaises(arrays.CopyFormatError,
+						  arrays.decode_copy, b"X" + copy_buffer(self.rows)[1:])
+
+	def test_BadTrailer(self):
+		self.assertRaises(arrays.CopyFormatError,
+						  arrays.decode_copy, copy_buffer(self.rows)[:-1])
+
+	def test_BadLayout(self):
+		# A null value changes the row length
+		buf = copy_buffer(self.rows)[:-2] + struct.pack(">hiqi", 2, 8, 0, -1)
+		buf += b"\0" * 8 + arrays.PGCOPY_TRAILER
+		for use_numpy in (True, False):
+			self.assertRaises(arrays.CopyFormatError,
+							  arrays.decode_copy, buf, use_numpy)
+
+class TestEncodeCopy(unittest.TestCase):
+	def setUp(self):
+		self.stamps = [-1, arrays.PG_EPOCH_US, 1234567890123456]
+		self.values = [1.5, -2.25, float("inf")]
+
+	def test_RoundTrip(self):
+		for use_numpy in (True, False):
+			buf = arrays.encode_copy(self.stamps, self.values, use_numpy)
+			stamps, values = arrays.decode_copy(buf, use_numpy)
+			self.assertEqual(list(stamps), self.stamps)
+			self.assertEqual(list(values), self.values)
+
+	def test_Layout(self):
+		buf = arrays.encode_copy(self.stamps[:1], self.values[:1], False)
+		self.assertEqual(buf, copy_buffer([(-1 - arrays.PG_EPOCH_US, 1.5)]))
+
+class TestRecords(unittest.TestCase):
+	def setUp(self):
+		self.buf = struct.pack("<qdqd", 5, 1.0, -1, 2.5)
+
+	def test_DecodeRecords(self):
+		for use_numpy in (True, False):
+			stamps, values = arrays.decode_records(self.buf, use_numpy)
+			self.assertEqual(list(stamps), [5, -1])
+			self.assertEqual(list(values), [1.0, 2.5])
+
+	def test_DecodeRecordsBadLength(self):
+		for use_numpy in (True, False):
+			self.assertRaises(ValueError, arrays.decode_records,
+							  self.buf[:-1], use_numpy)
+
+	def test_SplitValid(self):
+		for use_numpy in (True, False):
+			stamps, values = arrays.decode_records(
+				struct.pack("<qdqdqd", 5, 1.0, arrays.MAX_STAMP + 1, 2.0,
+							arrays.MIN_STAMP, 3.0), use_numpy)
+			bad, stamps, values = arrays.split_valid(stamps, values)
+			self.assertEqual(bad, [1])
+			self.assertEqual(list(stamps), [5, arrays.MIN_STAMP])
+			self.assertEqual(list(values), [1.0, 3.0])
+
+	def test_ToDatetime(self):
+		self.assertEqual(arrays.to_datetime(arrays.MAX_STAMP),
+						 datetime.datetime(9999, 12, 31, tzinfo=datetime.timezone.utc))
+
+class TestGrid(unittest.TestCase):
+	def setUp(self):
+		minute = 60000000
+		self.stamps = [minute, 2 * minute, 4 * minute, 4 * minute + 5]
+		self.values = [1.0, 2.0, 3.0, 4.0]
+
+	def grids(self, **kwargs):
+		for use_numpy in (True, False):
+			if use_numpy and arrays.numpy is None:
+				continue
+			if use_numpy:
+				data = arrays.ValueArray(arrays.numpy.array(self.stamps),
+										 arrays.numpy.array(self.values))
+			else:
+				data = arrays.ValueArray(self.stamps, self.values)
+			yield arrays.to_grid(data, 0, 60000000, use_numpy=use_numpy, **kwargs)
+
+	def test_JSON(self):
+		for grid in self.grids():
+			self.assertEqual(grid.as_json(),
+							 { "start": "1970-01-01T00:01:00.000000+0000",
+							   "period": 60.0,
+							   "values": [1.0, 2.0, None, 3.0],
+							   "offgrid": [("1970-01-01T00:04:00.000005+0000", 4.0)],
+							   })
+
+	def test_Bytes(self):
+		for grid in self.grids():
+			buf = grid.to_bytes()
+			self.assertEqual(arrays.Grid.HEADER.unpack_from(buf),
+							 (b"FGRD", 60000000, 60000000, 4, 1))
+			values = struct.unpack_from("<4d", buf, arrays.Grid.HEADER.size)
+			self.assertEqual([v for v in values if v == v], [1.0, 2.0, 3.0])
+			self.assertEqual(buf[-16:], struct.pack("<qd", 4 * 60000000 + 5, 4.0))
+
+	def test_Empty(self):
+		self.stamps = self.stamps[-1:]
+		self.values = self.values[-1:]
+		for grid in self.grids():
+			self.assertIsNone(grid.as_json()["start"])
+			self.assertEqual(grid.as_json()["values"], [])
+
+	def test_TooSparse(self):
+		self.stamps[-1] = 60000000 * 100000
+		self.assertRaises(ValueError, list, self.grids(max_sparsity=16))
+
+	def test_EncodeRecords(self):
+		for use_numpy in (True, False):
+			self.assertEqual(arrays.encode_records([5, -1], [1.0, 2.5], use_numpy),
+							 struct.pack("<qdqd", 5, 1.0, -1, 2.5))
+
+class TestFormat(unittest.TestCase):
+	def test_FormatStamps(self):
+		stamps = [arrays.MIN_STAMP, arrays.MAX_STAMP, -1, 0,
+				  # Either side of 2000-02-29
+				  951782400000000 - 1, 951782400000000 + 86400000000,
+				  1346155200123456]
+		expected = [arrays.to_datetime(s).isoformat(timespec="microseconds")
+					.replace("+00:00", "+0000")
+					for s in stamps]
+		for use_numpy in (True, False):
+			self.assertEqual(arrays.format_stamps(stamps, use_numpy), expected)
+		self.assertEqual(arrays.format_stamps([]), [])
+
+class TestValueArray(unittest.TestCase):
+	def setUp(self):
+		self.va = arrays.ValueArray([0, 1500000], [2.5, -1.0], 12)
+
+	def test_Iterate(self):
+		utc = datetime.timezone.utc
+		self.assertEqual(len(self.va), 2)
+		self.assertEqual(list(self.va),
+						 [(datetime.datetime(1970, 1, 1, tzinfo=utc), 2.5),
+						  (datetime.datetime(1970, 1, 1, 0, 0, 1, 500000, tzinfo=utc), -1.0)])
+		self.assertEqual(self.va[1][1], -1.0)
+
+	def test_AsJSON(self):
+		self.assertEqual(self.va.as_json(),
+						 [("1970-01-01T00:00:00.000000+0000", 2.5),
+						  ("1970-01-01T00:00:01.500000+0000", -1.0)])
+
+	def test_Nulls(self):
+		nan = float("nan")
+		va = arrays.ValueArray([0, 1], [nan, 1.0])
+		self.assertEqual([v for ts, v in va.as_json()], [None, 1.0])
+		va = arrays.ValueArray([0, 1], [(nan, 1.0), (2.0, 3.0)])
+		self.assertEqual(va.value_columns(True), [[None, 2.0], [1.0, 3.0]])
+		if arrays.numpy is not None:
+			va = arrays.ValueArray(arrays.numpy.array([0, 1]),
+								   arrays.numpy.array([nan, 1.0]))
+			self.assertEqual([v for ts, v in va.as_json()], [None, 1.0])
+			self.assertTrue(va.value_list()[0] != va.value_list()[0])
+
+	def test_Rows(self):
+		# Several values for each timestamp, as a list of tuples
+		va = arrays.ValueArray([0, 1500000], [(1.0, 2.0), (3.0, 4.0)])
+		self.assertEqual(va[1][1], (3.0, 4.0))
+		self.assertEqual(va.value_columns(), [[1.0, 3.0], [2.0, 4.0]])
+
+
+if __name__ == '__main__':
+	unittest.main()
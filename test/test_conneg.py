@@ -2,11 +2,14 @@
 """
 
 import unittest
+import json
+import struct
 
 from mock import Mock
 
 import fuse.conneg as cn
 import fuse.muddleware as mw
+import fuse.arrays as arrays
 
 class TestConnegBase(unittest.TestCase):
 	def setUp(self):
@@ -99,11 +102,66 @@ class TestConneg_CSV(TestConnegBase):
 					 ("Greenstreet", 1879, 1954))
 		self.transformers = { "csv": cn.CSVDataTransformer }
 		res = self.cn({"QUERY_STRING": "type=csv"}, self.sr)
-		self.assertEqual("".join(list(res)),
-"""Bogart,1899,1957\r
+		self.assertEqual(b"".join(list(res)),
+b"""Bogart,1899,1957\r
 Lorre,1904,1964\r
 Greenstreet,1879,1954\r
 """)
 
+	def test_CSVChunks(self):
+		xfm = cn.CSVDataTransformer(chunk_size=100)
+		xfm.BATCH = 3
+		rows = [("Bogart, Humphrey", 1899.5)] * 10
+		chunks = list(xfm.transform(rows, {}))
+		# Chunks are cut at the first batch boundary past chunk_size
+		self.assertEqual([len(c) for c in chunks], [27 * 6, 27 * 4])
+		self.assertEqual(b"".join(chunks),
+						 b'"Bogart, Humphrey",1899.5\r\n' * 10)
+
+	@unittest.skipIf(arrays.numpy is None, "NumPy not installed")
+	def test_CSVMultiColumn(self):
+		data = arrays.ValueArray(arrays.numpy.array([0, 1500000]),
+								 arrays.numpy.array([[1.0, 2.5], [3.0, -4.0]]))
+		res = cn.CSVDataTransformer().transform(data, {})
+		self.assertEqual(b"".join(res),
+						 b"1970-01-01 00:00:00+00:00,1.0,2.5\r\n"
+						 b"1970-01-01 00:00:01.500000+00:00,3.0,-4.0\r\n")
+		self.assertEqual(list(data)[1][1], (3.0, -4.0))
+
+class TestConneg_ValueArray(TestConnegBase):
+	def setUp(self):
+		TestConnegBase.setUp(self)
+		self.data = arrays.ValueArray([1346155200000000], [33.0])
+
+	def test_JSON(self):
+		self.transformers = { "json": cn.JSONTransformer }
+		res = self.cn({"QUERY_STRING": "type=json"}, self.sr)
+		self.assertEqual(list(res), [b'[["2012-08-28T12:00:00.000000+0000", 33.0]]'])
+
+	def test_CSV(self):
+		self.transformers = { "csv": cn.CSVDataTransformer }
+		res = self.cn({"QUERY_STRING": "type=csv"}, self.sr)
+		self.assertEqual(b"".join(res), b"2012-08-28 12:00:00+00:00,33.0\r\n")
+
+	def test_Nulls(self):
+		# A NULL value is rendered as null in JSON, and empty in CSV
+		self.data = arrays.ValueArray([0, 1000000], [float("nan"), 1.0])
+		self.transformers = { "json": cn.JSONTransformer }
+		res = self.cn({"QUERY_STRING": "type=json"}, self.sr)
+		self.assertEqual(json.loads(b"".join(res)),
+						 [["1970-01-01T00:00:00.000000+0000", None],
+						  ["1970-01-01T00:00:01.000000+0000", 1.0]])
+		self.transformers = { "csv": cn.CSVDataTransformer }
+		res = self.cn({"QUERY_STRING": "type=csv"}, self.sr)
+		self.assertEqual(b"".join(res), b"1970-01-01 00:00:00+00:00,\r\n"
+						 b"1970-01-01 00:00:01+00:00,1.0\r\n")
+
+	def test_Binary(self):
+		self.transformers = { "bin": cn.BinaryTransformer }
+		res = self.cn({"QUERY_STRING": "type=bin"}, self.sr)
+		self.assertEqual(list(res), [struct.pack("<qd", 1346155200000000, 33.0)])
+		self.assertIn(("Content-Type", "application/octet-stream"),
+					  self.sr.call_args[0][1])
+
 if __name__ == '__main__':
 	unittest.main()
@@ -4,8 +4,17 @@
 
 import unittest
 import datetime
+import queue
+import time
+import types
+
+import psycopg2
+from mock import patch
 
 import fuse.db as db
+import fuse.db_psql as db_psql
+import fuse.tailcache as tailcache
+import fuse.arrays as arrays
 import test.test_config as config
 
 _UTC = datetime.timezone.utc
@@ -124,12 +133,416 @@ class TestDBWithSeries(TestDBWithSeriesCommon):
 		self.assertEqual(d[0][0], stamp)
 		self.assertAlmostEqual(d[0][1], 218.2)
 
+	def test_GetValuesArray(self):
+		stamp = datetime.datetime(1969, 12, 31, 23, 59, 59, 999999, tzinfo=_UTC)
+		self.db.add_value(self.sid, stamp + datetime.timedelta(hours=1), 1.5)
+		self.db.add_value(self.sid, stamp, 134.6)
+		va = self.db.get_values_array(self.sid)
+		self.assertEqual(list(va.stamps), [-1, 3600 * 1000000 - 1])
+		self.assertEqual(list(va.values), [134.6, 1.5])
+		va = self.db.get_values_array(self.sid, from_ts=stamp,
+									  to_ts=stamp + datetime.timedelta(seconds=1))
+		self.assertEqual(list(va.stamps), [-1])
+
+	def test_AddValuesArray(self):
+		bad = self.db.add_values_array(self.sid, [5, -1, 2**62, 5], [1.0, 2.0, 3.0, 4.0])
+		self.assertEqual(bad, ([2], 2))
+		d = list(self.db.get_values(self.sid))
+		self.assertEqual([v for ts, v in d], [2.0, 4.0])
+		self.assertEqual(d[1][0], datetime.datetime(1970, 1, 1, 0, 0, 0, 5, tzinfo=_UTC))
+
+	def test_AddValuesArray_Unchanged(self):
+		self.db.add_values_array(self.sid, [1, 2], [1.0, 2.0])
+		ingest = self.db._query("select stamp, ingest from data order by stamp").fetchall()
+		self.assertEqual(self.db.add_values_array(self.sid, [1, 2, 3], [1.0, 2.5, 3.0]),
+						 ([], 2))
+		self.assertEqual(self.db.add_values_array(self.sid, [1, 2, 3], [1.0, 2.5, 3.0]),
+						 ([], 0))
+		after = self.db._query("select stamp, ingest from data order by stamp").fetchall()
+		self.assertEqual(after[0], ingest[0])
+		self.assertNotEqual(after[1], ingest[1])
+
+	def test_AddValuesArray_Null(self):
+		nan = float("nan")
+		self.assertEqual(self.db.add_values_array(self.sid, [1, 2], [nan, 2.0]),
+						 ([], 2))
+		self.assertEqual([v for ts, v in self.db.get_values(self.sid)], [None, 2.0])
+		# A NULL is unchanged by another NaN
+		self.assertEqual(self.db.add_values_array(self.sid, [1], [nan]), ([], 0))
+
+	def test_AddData_Unchanged(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		self.assertTrue(self.db.add_value(self.sid, stamp, 1.0))
+		ingest = self.db._query("select ingest from data").fetchone()
+		self.assertTrue(self.db.add_value(self.sid, stamp, 1.0))
+		self.assertEqual(self.db._query("select ingest from data").fetchone(), ingest)
+
+	def test_Expire(self):
+		hour = datetime.timedelta(hours=1)
+		base = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		for m, v in ((0, 1.0), (10, 3.0), (70, 5.0), (130, 7.0)):
+			self.db.add_value(self.sid, base + datetime.timedelta(minutes=m), v)
+		before = base + 2 * hour
+		self.assertEqual(self.db.count_expired(self.sid, before), 3)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 1), 1)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 10), 2)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 10), 0)
+		self.assertEqual([v for ts, v in self.db.get_values(self.sid)], [7.0])
+		self.assertEqual(self.db.get_rollup(self.sid),
+						 [(base, 2, 1.0, 3.0, 2.0), (base + hour, 1, 5.0, 5.0, 5.0)])
+		self.assertEqual(self.db.get_rollup(self.sid, from_ts=base + hour),
+						 [(base + hour, 1, 5.0, 5.0, 5.0)])
+
+	def test_Expire_Nulls(self):
+		# NULLs and NaNs count for nothing in the rollup, and a bucket
+		# with no values at all is left out
+		hour = datetime.timedelta(hours=1)
+		base = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		for m, v in ((0, None), (10, 4.0), (20, float("nan")), (30, 2.0),
+					 (70, None)):
+			self.db.add_value(self.sid, base + datetime.timedelta(minutes=m), v)
+		before = base + 2 * hour
+		self.assertEqual(self.db.expire(self.sid, before, hour, 2), 2)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 10), 3)
+		self.assertEqual(self.db.get_rollup(self.sid),
+						 [(base, 2, 2.0, 4.0, 3.0)])
+
+	def test_Summary(self):
+		base = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		stamps = [arrays.to_stamp(base + datetime.timedelta(minutes=m))
+				  for m in range(5)]
+		self.assertEqual(self.db.get_summaries([self.sid, -35]),
+						 { self.sid: { "count": 0, "min": None, "max": None,
+									   "first": None, "last": None,
+									   "latest": None } })
+		self.db.add_values_array(self.sid, stamps, [3.0, 1.0, float("nan"), 5.0, 2.0])
+		summary = self.db.get_summaries([self.sid])[self.sid]
+		self.assertEqual(summary, { "count": 5, "min": 1.0, "max": 5.0,
+									"first": base,
+									"last": base + datetime.timedelta(minutes=4),
+									"latest": 2.0 })
+		# Overwriting the min, the max and the latest value
+		self.db.add_values_array(self.sid, stamps[1:], [4.0, 4.0, 4.5, 6.0])
+		self.db.add_value(self.sid, base + datetime.timedelta(minutes=2), 0.5)
+		summary = self.db.get_summaries([self.sid])[self.sid]
+		self.assertEqual((summary["count"], summary["min"], summary["max"],
+						  summary["latest"]), (5, 0.5, 6.0, 6.0))
+		# Expiring the first point, and the min
+		hour = datetime.timedelta(hours=1)
+		self.db.expire(self.sid, base + datetime.timedelta(minutes=3), hour, 10)
+		summary = self.db.get_summaries([self.sid])[self.sid]
+		self.assertEqual(summary, { "count": 2, "min": 4.5, "max": 6.0,
+									"first": base + datetime.timedelta(minutes=3),
+									"last": base + datetime.timedelta(minutes=4),
+									"latest": 6.0 })
+
+	def test_Sketches(self):
+		day = datetime.timedelta(days=1)
+		base = datetime.datetime(2010, 2, 14, tzinfo=_UTC)
+		stamps = [arrays.to_stamp(base + h * datetime.timedelta(hours=1))
+				  for h in range(72)]
+		self.db.add_values_array(self.sid, stamps, [float(h) for h in range(72)])
+		sketches = self.db.get_sketches(self.sid, to_ts=base + 2 * day)
+		self.assertEqual([start for start, digest in sketches], [base, base + day])
+		self.assertEqual(sketches[1][1].quantiles([0, 1]), [24.0, 47.0])
+		self.assertEqual(self.db._query(
+			"select count(*) from sketch where digest is not null").fetchone()[0], 2)
+		# Stored, and served from the store
+		self.db._query("delete from data where stamp >= %s", (base + day,))
+		self.assertEqual(self.db.get_sketches(self.sid, from_ts=base + day * 1.5)[0][1].count,
+						 24)
+		# Writing makes the day's sketch stale
+		self.db.add_value(self.sid, base + day, 100.0)
+		self.assertEqual(self.db.get_sketches(self.sid, from_ts=base + day)[0][1].count, 1)
+		# Expired data is still covered
+		self.db.expire(self.sid, base + day, datetime.timedelta(hours=1), 100)
+		self.assertEqual(self.db.get_sketches(self.sid)[0][1].quantiles([0.5]), [11.5])
+
+	def test_Sketches_LateWrite(self):
+		# A late write into a day whose data has expired is added to
+		# the sketch of the expired data
+		base = datetime.datetime(2010, 2, 14, tzinfo=_UTC)
+		self.db.add_values_array(
+			self.sid, [arrays.to_stamp(base) + m * 60000000 for m in range(100)],
+			[float(m) for m in range(100)])
+		hour = datetime.timedelta(hours=1)
+		self.assertEqual(self.db.expire(self.sid, base + 3 * hour, hour, 1000), 100)
+		self.db.add_value(self.sid, base + 2 * hour, 1000.0)
+		digest = self.db.get_sketches(self.sid)[0][1]
+		self.assertEqual((digest.count, digest.min, digest.max), (101, 0.0, 1000.0))
+		self.assertEqual(self.db.expire(self.sid, base + 3 * hour, hour, 1000), 1)
+		self.db.add_value(self.sid, base + 2 * hour, 2000.0)
+		self.assertEqual(self.db.get_sketches(self.sid)[0][1].count, 102)
+
+	def test_Sketches_Blocks(self):
+		# Stale days are built a few at a time
+		base = datetime.datetime(2010, 2, 14, tzinfo=_UTC)
+		day = datetime.timedelta(days=1)
+		self.db.add_values_array(
+			self.sid, [arrays.to_stamp(base + d * day) for d in range(10)],
+			[float(d) for d in range(10)])
+		with patch.object(self.db, "_values_array", wraps=self.db._values_array) as read:
+			sketches = self.db.get_sketches(self.sid)
+		self.assertEqual(len(sketches), 10)
+		self.assertEqual([d.count for start, d in sketches], [1] * 10)
+		self.assertEqual(read.call_count, 2)
+
+	def test_Retention(self):
+		self.assertTrue(self.db.set_retention(self.sid, datetime.timedelta(days=2)))
+		self.assertEqual(self.db.list_series(sid=self.sid)[self.sid]["retention"],
+						 datetime.timedelta(days=2))
+		self.assertFalse(self.db.set_retention(-35, None))
+
+	def test_AddValuesArray_Fail(self):
+		self.assertEqual(self.db.add_values_array(-35, [1, 2], [1.0, 2.0]), ([0, 1], 0))
+
+	def test_GetChanges(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 00, 30, tzinfo=_UTC)
+		now = datetime.timedelta(0)
+		self.db.add_value(self.sid, stamp, 1.0)
+		self.db.add_value(self.sid, stamp + datetime.timedelta(minutes=1), 2.0)
+		changes, mark = self.db.get_changes(self.sid, None, 1, now)
+		self.assertEqual(list(changes[self.sid].values), [1.0])
+		changes, mark = self.db.get_changes(None, mark, 1, now)
+		self.assertEqual(list(changes[self.sid].values), [2.0])
+		changes, mark = self.db.get_changes(None, mark, 1, now)
+		self.assertEqual(changes, {})
+		self.db.add_value(self.sid, stamp, 3.0)
+		changes, mark2 = self.db.get_changes(self.sid, mark, 1, now)
+		self.assertEqual(list(changes[self.sid].values), [3.0])
+		# Not yet settled
+		changes, mark3 = self.db.get_changes(self.sid, mark, 1,
+											 datetime.timedelta(seconds=60))
+		self.assertEqual((changes, mark3), ({}, mark))
+
+	def test_GetChanges_InFlight(self):
+		# Points written by a transaction which hasn't committed yet
+		# are not passed by the watermark, however long it takes
+		stamp = datetime.datetime(2010, 2, 14, 12, 00, 30, tzinfo=_UTC)
+		settle = datetime.timedelta(0)
+		conn = psycopg2.connect(**config.db_params)
+		try:
+			cur = conn.cursor()
+			cur.execute("select upsert_data(%s, %s, clock_timestamp(), %s)",
+						(self.sid, stamp, 1.0))
+			time.sleep(0.1)
+			changes, mark = self.db.get_changes(self.sid, None, None, settle)
+			self.assertEqual(changes, {})
+			conn.commit()
+		finally:
+			conn.close()
+		changes, mark = self.db.get_changes(self.sid, mark, None, settle)
+		self.assertEqual(list(changes[self.sid].values), [1.0])
+
+	def test_GetChanges_Null(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 00, 30, tzinfo=_UTC)
+		self.db._query("insert into data (series_id, stamp, ingest, value)"
+					   " values (%s, %s, now(), null)", (self.sid, stamp))
+		changes, mark = self.db.get_changes(self.sid, None, None,
+											datetime.timedelta(0))
+		self.assertEqual(len(changes[self.sid]), 1)
+
+	def test_Export(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 00, 30, 123, tzinfo=_UTC)
+		self.db.add_value(self.sid, stamp, 134.6)
+		self.db.add_value(self.sid, stamp + datetime.timedelta(minutes=1), 1.5)
+		data = b"".join(self.db.export(self.sid, to_ts=stamp + datetime.timedelta(seconds=1)))
+		self.assertEqual(data.split(b"\n"),
+						 [b"series,time,value",
+						  "{0},2010-02-14T12:00:30.000123+0000,134.6".format(self.sid).encode(),
+						  b""])
+
+	def test_ExportClose(self):
+		it = self.db.export(self.sid, chunk_size=1)
+		self.assertEqual(next(it), b"series,time,value\n")
+		it.close()
+
+	def test_Listen(self):
+		got = queue.Queue()
+		self.db.listen(lambda sid, data: got.put((sid, list(data.stamps))))
+		time.sleep(0.5)
+		self.db.add_value(self.sid, datetime.datetime(1970, 1, 1, 0, 0, 1, tzinfo=_UTC), 1.0)
+		self.assertEqual(got.get(timeout=5), (self.sid, [1000000]))
+		# Too many points to send in full: they are fetched instead
+		stamps = list(range(0, 2000, 10))
+		self.db.add_values_array(self.sid, stamps, [1.0] * len(stamps))
+		self.assertEqual(got.get(timeout=5), (self.sid, stamps))
+
+	def test_AddValueNull(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 00, 30, tzinfo=_UTC)
+		self.assertTrue(self.db.add_value(self.sid, stamp, None))
+		self.assertTrue(self.db.db.autocommit)
+		self.assertEqual(list(self.db.get_values(self.sid)), [(stamp, None)])
+
+	def test_AddValue_NoListener(self):
+		# With no listener connected, no notifications are sent
+		if self.db._query(
+				"select count(*) from pg_stat_activity where application_name = %s",
+				(db_psql.LISTEN_APPLICATION,)).fetchone()[0]:
+			self.skipTest("A listener is connected")
+		conn = psycopg2.connect(**config.db_params)
+		try:
+			conn.autocommit = True
+			conn.cursor().execute("listen " + db_psql.NOTIFY_CHANNEL)
+			self.db.add_value(self.sid, datetime.datetime(2010, 1, 1, tzinfo=_UTC), 1.0)
+			time.sleep(0.1)
+			conn.poll()
+			self.assertEqual(conn.notifies, [])
+			# Once this process is listening, notifications are sent
+			self.db.listening = True
+			self.db.add_value(self.sid, datetime.datetime(2010, 1, 2, tzinfo=_UTC), 1.0)
+			time.sleep(0.1)
+			conn.poll()
+			self.assertEqual(len(conn.notifies), 1)
+		finally:
+			conn.close()
+
+	def test_TryLock(self):
+		self.assertTrue(self.db.try_lock(12345))
+		conn = psycopg2.connect(**config.db_params)
+		try:
+			cur = conn.cursor()
+			cur.execute("select pg_try_advisory_lock(12345)")
+			self.assertFalse(cur.fetchone()[0])
+			self.db.unlock(12345)
+			cur.execute("select pg_try_advisory_lock(12345)")
+			self.assertTrue(cur.fetchone()[0])
+		finally:
+			conn.close()
+
+	def test_Prepared(self):
+		self.db.is_series(self.sid)
+		self.db.is_series(self.sid)
+		self.assertIn("is_series", self.db.db.prepared)
+		names = [r[0] for r in self.db._query("select name from pg_prepared_statements")]
+		self.assertEqual(names.count("is_series"), 1)
+		# A new connection prepares its own
+		self.db.db.close()
+		self.db.local.conn = None
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertEqual(self.db.db.prepared, {"is_series"})
+
+	def test_NotPrepared(self):
+		self.db.prepare = False
+		self.db.db.close()
+		self.db.local.conn = None
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertEqual(list(self.db.list_series(sid=self.sid)), [self.sid])
+		self.assertEqual(self.db.db.prepared, set())
+
+	def test_Release(self):
+		conn = self.db.db
+		self.db.release()
+		self.assertEqual(self.db.pool, [conn])
+		self.assertIs(self.db.db, conn)
+		self.assertEqual(self.db.pool, [])
+
 	def test_IsSeriesPositive(self):
 		self.assertTrue(self.db.is_series(self.sid))
 
 	def test_IsSeriesNegative(self):
 		self.assertFalse(self.db.is_series(-35))
 
+class TestDBReplicas(TestDBWithSeriesCommon):
+	"""The test database stands in as its own replica
+	"""
+	def setUp(self):
+		TestDBWithSeriesCommon.setUp(self)
+		self.replica = db_psql._Replica(config.db_params)
+		self.db.replicas = [self.replica]
+		self.db.read_your_writes = 0
+
+	def tearDown(self):
+		self.db.release()
+		TestDBWithSeriesCommon.tearDown(self)
+
+	def test_Read(self):
+		self.db.add_value(self.sid, datetime.datetime(2020, 1, 1, tzinfo=_UTC), 1.0)
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertEqual(len(list(self.db.get_values(self.sid))), 1)
+		self.assertEqual(len(self.db.get_values_array(self.sid)), 1)
+		self.assertIn(self.sid, self.db.list_series())
+		replica, conn = self.db.local.reader
+		self.assertIs(replica, self.replica)
+		self.assertIn("is_series", conn.prepared)
+		self.assertNotIn("is_series", self.db.db.prepared)
+		self.db.release()
+		self.assertEqual(self.replica.pool, [conn])
+
+	def test_ReadYourWrites(self):
+		self.db.read_your_writes = 60
+		self.db.add_value(self.sid, datetime.datetime(2020, 1, 1, tzinfo=_UTC), 1.0)
+		self.assertEqual(len(list(self.db.get_values(self.sid))), 1)
+		self.assertIsNone(getattr(self.db.local, "reader", None))
+		self.db.written[self.sid] -= 60
+		self.assertEqual(len(list(self.db.get_values(self.sid))), 1)
+		self.assertIsNotNone(self.db.local.reader)
+
+	def test_ReadYourWrites_Summaries(self):
+		self.db.read_your_writes = 60
+		self.db.add_value(self.sid, datetime.datetime(2020, 1, 1, tzinfo=_UTC), 1.0)
+		summaries = self.db.get_summaries([-1, self.sid])
+		self.assertEqual(summaries[self.sid]["count"], 1)
+		self.assertIsNone(getattr(self.db.local, "reader", None))
+		self.db.written[self.sid] -= 60
+		self.db.get_summaries([-1, self.sid])
+		self.assertIsNotNone(self.db.local.reader)
+
+	def test_WrittenPruned(self):
+		self.db.read_your_writes = 60
+		self.db.written = { -1: time.monotonic() - 120, -2: time.monotonic() }
+		self.db.written_pruned -= 60
+		self.db.add_value(self.sid, datetime.datetime(2020, 1, 1, tzinfo=_UTC), 1.0)
+		self.assertCountEqual(self.db.written, [-2, self.sid])
+
+	def test_LagNotInRecovery(self):
+		cur = self.db.db.cursor()
+		cur.execute(db_psql.REPLICA_LAG_SQL)
+		self.assertEqual(cur.fetchone()[0], 0.0)
+
+	def test_TailFromPrimary(self):
+		# A replica may not have the latest writes yet, so tails are
+		# loaded from the primary
+		conf = types.SimpleNamespace(**vars(config))
+		conf.tail_window_seconds = 3600
+		conf.live_notify = False
+		cached = tailcache.cached(db_psql.Database)(conf)
+		cached.replicas = [self.replica]
+		cached.read_your_writes = 0
+		now = datetime.datetime.now(_UTC)
+		self.db.add_value(self.sid, now, 1.0)
+		try:
+			data = cached.get_values_array(self.sid, now - datetime.timedelta(minutes=1))
+			self.assertEqual(len(data), 1)
+			self.assertIn(self.sid, cached.tails)
+			self.assertIsNone(getattr(cached.local, "reader", None))
+		finally:
+			cached.release()
+
+	def test_Unreachable(self):
+		params = dict(config.db_params, port=1)
+		self.db.replicas = [db_psql._Replica(params), self.replica]
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertGreater(self.db.replicas[0].down_until, time.monotonic())
+		self.assertIs(self.db.local.reader[0], self.replica)
+
+	def test_Failed(self):
+		self.assertTrue(self.db.is_series(self.sid))
+		conn = self.db.local.reader[1]
+		self.db._query("select pg_terminate_backend(%s)", (conn.get_backend_pid(),))
+		# The replica's connection is lost under it: the read falls
+		# back to the primary
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertGreater(self.replica.down_until, time.monotonic())
+		self.assertTrue(conn.closed)
+
+	def test_Lagging(self):
+		self.db.replica_max_lag = -1
+		self.assertTrue(self.db.is_series(self.sid))
+		self.assertGreater(self.replica.down_until, time.monotonic())
+		self.assertIsNone(getattr(self.db.local, "reader", None))
+
 class TestDBWithMultiSeries(TestDBWithMultiSeriesCommon):
 	def test_ListSeriesByID(self):
 		serlist = self.db.list_series(sid=self.sid2)
@@ -157,10 +570,62 @@ class TestDBWithMultiSeries(TestDBWithMultiSeriesCommon):
 											  datetime.timedelta(seconds=1000)])
 		self.assertCountEqual((self.sid2, self.sid3), serlist)
 
+	def test_ListSeriesPaged(self):
+		serlist = self.db.list_series(limit=2)
+		self.assertEqual(list(serlist), [self.sid, self.sid2])
+		serlist = self.db.list_series(after=self.sid2, limit=2)
+		self.assertEqual(list(serlist), [self.sid3])
+
+	def test_ListSeriesByName(self):
+		self.assertCountEqual(self.db.list_series(name="VERG"),
+							  (self.sid, self.sid2, self.sid3))
+		self.assertCountEqual(self.db.list_series(prefix="Div"), (self.sid3,))
+		self.assertCountEqual(self.db.list_series(name="%"), ())
+
+	def test_ListSeriesAll(self):
+		self.assertEqual(list(self.db.list_series()), [self.sid, self.sid2, self.sid3])
+		self.assertEqual(self.db.list_series(sid=self.sid3)[self.sid3]["name"],
+						 "divergent")
+
 	def test_ListSeriesByType(self):
 		serlist = self.db.list_series(ts_type="point")
 		self.assertCountEqual((self.sid, self.sid3), serlist)
 
+class TestQueryStats(unittest.TestCase):
+	def test_Template(self):
+		stats = db_psql.QueryStats()
+		self.assertEqual(stats.template("select  *\n\t from data where id=%s"),
+						 "select * from data where id=%s")
+
+	def test_Summary(self):
+		stats = db_psql.QueryStats()
+		stats.record("select 1", 0.5, 1)
+		stats.record("select  1", 0.25, -1)
+		stats.record("select 2", 2.0, 3)
+		summary = stats.summary()
+		self.assertEqual([s["statement"] for s in summary],
+						 ["select 2", "select 1"])
+		self.assertEqual(summary[1]["calls"], 2)
+		self.assertEqual(summary[1]["seconds"], 0.75)
+		self.assertEqual(summary[1]["max_seconds"], 0.5)
+		self.assertEqual(summary[1]["rows"], 1)
+
+	def test_Bounded(self):
+		stats = db_psql.QueryStats(max_templates=3)
+		for i in range(10):
+			stats.record("select {0}".format(i), 0.1, 1)
+		self.assertLessEqual(len(stats.templates), 3)
+		summary = {s["statement"]: s["calls"] for s in stats.summary()}
+		self.assertEqual(len(summary), 4)
+		self.assertEqual(summary[stats.OTHER], 7)
+
+	def test_Collect(self):
+		stats = db_psql.QueryStats()
+		stats.record("select 1", 0.5, 1)
+		calls, secs, slowest, rows = stats.collect()
+		self.assertEqual(calls.values, {("select 1",): 1})
+		self.assertEqual(slowest.values, {("select 1",): 0.5})
+
 
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,193 @@
+# coding: utf-8
+"""Unit testing
+"""
+
+import unittest
+import datetime
+
+import fuse.db_memory as db_memory
+import fuse.arrays as arrays
+
+_UTC = datetime.timezone.utc
+
+class TestMemoryDB(unittest.TestCase):
+	def setUp(self):
+		self.db = db_memory.Database(None)
+		self.sid = self.db.create_series(
+			"convergent", datetime.timedelta(seconds=1800))
+		self.sid2 = self.db.create_series(
+			"divergent", datetime.timedelta(seconds=900), ts_type="mean")
+
+	def test_CreateSeriesFailure(self):
+		self.assertIsNone(self.db.create_series(
+			"test", datetime.timedelta(seconds=1800), ts_type="foo"))
+		self.assertIsNone(self.db.create_series("test", "colin"))
+		self.assertEqual(len(self.db.list_series()), 2)
+
+	def test_ListSeries(self):
+		self.assertCountEqual(self.db.list_series(), (self.sid, self.sid2))
+		self.assertCountEqual(self.db.list_series(sid=self.sid2), (self.sid2,))
+		self.assertCountEqual(self.db.list_series(ts_type="mean"), (self.sid2,))
+		self.assertCountEqual(self.db.list_series(name="VERG"), (self.sid, self.sid2))
+		self.assertCountEqual(
+			self.db.list_series(period=(datetime.timedelta(seconds=500),
+										datetime.timedelta(seconds=1000))),
+			(self.sid2,))
+		self.assertCountEqual(
+			self.db.list_series(period=datetime.timedelta(seconds=1800)),
+			(self.sid,))
+		self.assertCountEqual(self.db.list_series(prefix="DIV"), (self.sid2,))
+		self.assertEqual(list(self.db.list_series(limit=1)), [self.sid])
+		self.assertEqual(list(self.db.list_series(after=self.sid, limit=1)), [self.sid2])
+
+	def test_DropSeries(self):
+		self.db.drop_series(self.sid)
+		self.assertFalse(self.db.is_series(self.sid))
+		self.assertTrue(self.db.is_series(self.sid2))
+
+	def test_AddGetValues(self):
+		stamps = [datetime.datetime(2010, 2, 14, 12, m, tzinfo=_UTC)
+				  for m in (30, 0, 15)]
+		for i, ts in enumerate(stamps):
+			self.assertTrue(self.db.add_value(self.sid, ts, i))
+		self.assertTrue(self.db.add_value(self.sid, stamps[0], 12))
+		self.assertFalse(self.db.add_value(self.sid, stamps[0], "James di Griz"))
+		self.assertEqual(list(self.db.get_values(self.sid)),
+						 [(stamps[1], 1.0), (stamps[2], 2.0), (stamps[0], 12.0)])
+		self.assertEqual(list(self.db.get_values(self.sid, from_ts=stamps[2],
+												 to_ts=stamps[0])),
+						 [(stamps[2], 2.0)])
+	def test_GetValuesArray(self):
+		stamp = datetime.datetime(1970, 1, 1, 0, 0, 1, 5, tzinfo=_UTC)
+		self.db.add_value(self.sid, stamp, 2.5)
+		va = self.db.get_values_array(self.sid)
+		self.assertEqual(list(va.stamps), [1000005])
+		self.assertEqual(list(va.values), [2.5])
+
+	def test_AddValuesArray(self):
+		bad = self.db.add_values_array(self.sid, [5, -1, 2**62, 5], [1.0, 2.0, 3.0, 4.0])
+		self.assertEqual(bad, ([2], 2))
+		va = self.db.get_values_array(self.sid)
+		self.assertEqual((list(va.stamps), list(va.values)), ([-1, 5], [2.0, 4.0]))
+		self.assertEqual(self.db.add_values_array(self.sid, [5, 6], [4.0, 1.0]), ([], 1))
+
+	def test_AddValuesArray_Null(self):
+		nan = float("nan")
+		self.assertEqual(self.db.add_values_array(self.sid, [1, 2], [nan, 2.0]),
+						 ([], 2))
+		self.assertEqual(self.db.add_values_array(self.sid, [1], [nan]), ([], 0))
+		self.assertTrue(self.db.add_value(self.sid, arrays.to_datetime(3), None))
+		values = list(self.db.get_values_array(self.sid).values)
+		self.assertEqual(values[1], 2.0)
+		self.assertTrue(values[0] != values[0] and values[2] != values[2])
+
+	def test_GetChanges(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 00, 30, tzinfo=_UTC)
+		now = datetime.timedelta(0)
+		self.db.add_value(self.sid, stamp, 1.0)
+		self.db.add_value(self.sid, stamp + datetime.timedelta(minutes=1), 2.0)
+		changes, mark = self.db.get_changes(self.sid, None, 1, now)
+		self.assertEqual(list(changes[self.sid].values), [1.0])
+		changes, mark = self.db.get_changes(None, mark, 1, now)
+		self.assertEqual(list(changes[self.sid].values), [2.0])
+		changes, mark = self.db.get_changes(None, mark, 1, now)
+		self.assertEqual(changes, {})
+		self.db.add_value(self.sid, stamp, 3.0)
+		changes, mark2 = self.db.get_changes(self.sid, mark, 1, now)
+		self.assertEqual(list(changes[self.sid].values), [3.0])
+		# Not yet settled
+		changes, mark3 = self.db.get_changes(self.sid, mark, 1,
+											 datetime.timedelta(seconds=60))
+		self.assertEqual((changes, mark3), ({}, mark))
+
+	def test_Expire(self):
+		hour = datetime.timedelta(hours=1)
+		base = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		for m, v in ((0, 1.0), (10, 3.0), (70, 5.0), (130, 7.0)):
+			self.db.add_value(self.sid, base + datetime.timedelta(minutes=m), v)
+		before = base + 2 * hour
+		self.assertEqual(self.db.count_expired(self.sid, before), 3)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 1), 1)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 10), 2)
+		self.assertEqual([v for ts, v in self.db.get_values(self.sid)], [7.0])
+		self.assertEqual(self.db.get_rollup(self.sid),
+						 [(base, 2, 1.0, 3.0, 2.0), (base + hour, 1, 5.0, 5.0, 5.0)])
+
+	def test_Expire_Nulls(self):
+		# NULLs and NaNs count for nothing in the rollup, and a bucket
+		# with no values at all is left out
+		hour = datetime.timedelta(hours=1)
+		base = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		for m, v in ((0, None), (10, 4.0), (20, float("nan")), (30, 2.0),
+					 (70, None)):
+			self.db.add_value(self.sid, base + datetime.timedelta(minutes=m), v)
+		before = base + 2 * hour
+		self.assertEqual(self.db.expire(self.sid, before, hour, 2), 2)
+		self.assertEqual(self.db.expire(self.sid, before, hour, 10), 3)
+		self.assertEqual(self.db.get_rollup(self.sid),
+						 [(base, 2, 2.0, 4.0, 3.0)])
+
+	def test_Summary(self):
+		base = datetime.datetime(2010, 2, 14, 12, 0, tzinfo=_UTC)
+		for m, v in ((0, 3.0), (10, float("nan")), (20, 1.0), (30, 2.0)):
+			self.db.add_value(self.sid, base + datetime.timedelta(minutes=m), v)
+		summaries = self.db.get_summaries([self.sid, self.sid2, -35])
+		self.assertEqual(summaries[self.sid],
+						 { "count": 4, "min": 1.0, "max": 3.0, "first": base,
+						   "last": base + datetime.timedelta(minutes=30),
+						   "latest": 2.0 })
+		self.assertEqual(summaries[self.sid2]["count"], 0)
+		self.assertNotIn(-35, summaries)
+
+	def test_Sketches(self):
+		day = datetime.timedelta(days=1)
+		base = datetime.datetime(2010, 2, 14, tzinfo=_UTC)
+		for h in range(48):
+			self.db.add_value(self.sid, base + h * datetime.timedelta(hours=1), float(h))
+		sketches = self.db.get_sketches(self.sid)
+		self.assertEqual([start for start, digest in sketches], [base, base + day])
+		self.assertEqual(sketches[1][1].quantiles([0, 1]), [24.0, 47.0])
+		self.assertEqual(self.db.get_sketches(self.sid, from_ts=base + day * 1.5),
+						 sketches[1:])
+		# Writing makes the day's sketch stale
+		self.db.add_value(self.sid, base + day, 100.0)
+		self.assertIsNone(self.db.series[self.sid].sketches[base + day])
+		self.assertEqual(self.db.get_sketches(self.sid)[1][1].max, 100.0)
+		# Expired data is still covered
+		self.db.expire(self.sid, base + day, datetime.timedelta(hours=1), 100)
+		self.assertEqual(self.db.get_sketches(self.sid)[0][1].count, 24)
+
+	def test_Sketches_LateWrite(self):
+		# A late write into a day whose data has expired is added to
+		# the sketch of the expired data
+		base = datetime.datetime(2010, 2, 14, tzinfo=_UTC)
+		minute = datetime.timedelta(minutes=1)
+		for m in range(100):
+			self.db.add_value(self.sid, base + m * minute, float(m))
+		hour = datetime.timedelta(hours=1)
+		self.assertEqual(self.db.expire(self.sid, base + 3 * hour, hour, 1000), 100)
+		self.db.add_value(self.sid, base + 2 * hour, 1000.0)
+		digest = self.db.get_sketches(self.sid)[0][1]
+		self.assertEqual((digest.count, digest.min, digest.max), (101, 0.0, 1000.0))
+
+	def test_Listen(self):
+		got = []
+		self.db.listen(lambda sid, data: got.append((sid, list(data.stamps))))
+		self.db.add_value(self.sid, datetime.datetime(1970, 1, 1, 0, 0, 1, tzinfo=_UTC), 1.0)
+		self.db.add_values_array(self.sid, [7, 2**62, 3], [1.0, 2.0, 3.0])
+		self.assertEqual(got, [(self.sid, [1000000]), (self.sid, [3, 7])])
+
+	def test_Export(self):
+		stamp = datetime.datetime(2010, 2, 14, 12, 0, 30, 123, tzinfo=_UTC)
+		self.db.add_value(self.sid2, stamp, 2.5)
+		self.db.add_value(self.sid, stamp, 134.6)
+		self.assertEqual(
+			b"".join(self.db.export()),
+			b"series,time,value\n"
+			b"1,2010-02-14T12:00:30.000123+0000,134.6\n"
+			b"2,2010-02-14T12:00:30.000123+0000,2.5\n")
+		self.assertEqual(list(self.db.export(self.sid2, chunk_size=1)),
+						 [b"series,time,value\n2,2010-02-14T12:00:30.000123+0000,2.5\n"])
+
+if __name__ == '__main__':
+	unittest.main()
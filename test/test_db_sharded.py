@@ -0,0 +1,166 @@
+"""Unit testing
+"""
+
+import unittest
+import datetime
+import time
+
+import fuse.db_sharded as db_sharded
+import fuse.rebalance as rebalance
+import fuse.tailcache as tailcache
+import fuse.arrays as arrays
+import fuse.watermark as watermark
+import test.test_config as config
+
+_UTC = datetime.timezone.utc
+T0 = datetime.datetime(2020, 1, 1, tzinfo=_UTC)
+MINUTE = datetime.timedelta(seconds=60)
+
+class TestSharded(unittest.TestCase):
+	def setUp(self):
+		self.db = db_sharded.Database(config)
+		# One series on each shard
+		self.sids = {}
+		while len(self.sids) < 2:
+			sid = self.db.create_series("s", MINUTE)
+			self.sids.setdefault(self.db.shard_of(sid), sid)
+		for i, sid in self.sids.items():
+			self.db.add_values_array(
+				sid, [arrays.to_stamp(T0 + n * MINUTE) for n in range(5)],
+				[float(i)] * 5)
+
+	def tearDown(self):
+		self.db.release()
+		self.db._wipe()
+
+	def stored(self, shard, sid):
+		return self.db.shards[shard]._query(
+			"select count(*) from data where series_id = %s", (sid,)).fetchone()[0]
+
+	def test_Place(self):
+		self.assertEqual(db_sharded.place(7, 1), 0)
+		placed = [db_sharded.place(sid, 2) for sid in range(1, 101)]
+		self.assertGreater(placed.count(0), 30)
+		self.assertGreater(placed.count(1), 30)
+		# Adding a shard only moves series onto the new one
+		for sid in range(1, 101):
+			self.assertIn(db_sharded.place(sid, 3), (placed[sid - 1], 2))
+
+	def test_Route(self):
+		for i, sid in self.sids.items():
+			self.assertEqual(self.stored(i, sid), 5)
+			self.assertEqual(self.stored(1 - i, sid), 0)
+			self.assertEqual(len(self.db.get_values_array(sid)), 5)
+			self.assertTrue(self.db.add_value(sid, T0, 9.0))
+			self.assertEqual(list(self.db.get_values(sid))[0], (T0, 9.0))
+		self.assertCountEqual(self.db.list_series(), self.db.placement)
+		# The other shard only has entries for its own series
+		self.assertEqual(
+			self.db.shards[1]._query("select count(*) from series").fetchone()[0],
+			list(self.db.placement.values()).count(1))
+
+	def test_Missing(self):
+		self.assertFalse(self.db.is_series(-1))
+		self.assertEqual(self.db.add_values_array(-1, [0], [1.0]), ([0], 0))
+		self.assertEqual(list(self.db.get_values(-1)), [])
+
+	def test_Changes(self):
+		changes, mark = self.db.get_changes(settle=datetime.timedelta(0))
+		self.assertCountEqual(changes, self.sids.values())
+		changes, mark = self.db.get_changes(limit=7, settle=datetime.timedelta(0))
+		self.assertEqual(sum(len(v) for v in changes.values()), 7)
+		changes, mark = self.db.get_changes(since=mark, limit=7,
+											settle=datetime.timedelta(0))
+		self.assertEqual(sum(len(v) for v in changes.values()), 3)
+
+	def test_Summaries(self):
+		summaries = self.db.get_summaries(list(self.sids.values()) + [-1])
+		self.assertEqual(set(summaries), set(self.sids.values()))
+		for i, sid in self.sids.items():
+			self.assertEqual(summaries[sid]["count"], 5)
+			self.assertEqual(summaries[sid]["latest"], float(i))
+
+	def test_Export(self):
+		text = b"".join(self.db.export(chunk_size=64)).decode("utf-8")
+		lines = text.splitlines()
+		self.assertEqual(lines[0], "series,time,value")
+		series = [int(l.split(",")[0]) for l in lines[1:]]
+		self.assertEqual(series, sorted(series))
+		self.assertCountEqual(set(series), self.sids.values())
+		self.assertEqual(len(series), 10)
+
+	def test_Move(self):
+		sid = self.sids[0]
+		self.db.set_retention(sid, datetime.timedelta(days=1))
+		self.assertEqual(self.db.get_sketches(sid)[0][1].count, 5)
+		self.assertEqual(self.db.move_series(sid, 1, batch_size=2, wait=0), 5)
+		self.assertEqual(self.db.shard_of(sid), 1)
+		self.assertEqual(self.stored(0, sid), 0)
+		self.assertEqual(self.stored(1, sid), 5)
+		self.assertEqual(len(self.db.get_values_array(sid)), 5)
+		self.assertEqual(self.db.move_series(sid, 1), 0)
+		self.assertEqual(len(self.db.get_sketches(sid)), 1)
+		# Moving back to the catalogue keeps its series entry
+		self.db.move_series(sid, 0, wait=0)
+		self.assertTrue(self.db.is_series(sid))
+		self.assertEqual(self.stored(0, sid), 5)
+
+	def test_MoveExpired(self):
+		# The digests of expired data move with the series
+		sid = self.sids[0]
+		self.db.expire(sid, T0 + 2 * MINUTE, MINUTE, 10)
+		self.db.move_series(sid, 1, wait=0)
+		self.db.add_value(sid, T0, 9.0)
+		self.assertEqual(self.db.get_sketches(sid)[0][1].count, 6)
+
+	def test_TailReady(self):
+		# Tails aren't served until the shards' notifications can be
+		# relied on
+		conf = db_sharded._ShardConf(config, config.db_params)
+		conf.tail_window_seconds = 3600
+		conf.live_notify = True
+		db = tailcache.cached(db_sharded.Database)(conf)
+		self.assertGreater(db.notify_delay, 0)
+		self.assertGreater(db.tail_ready, time.monotonic())
+
+	def test_Plan(self):
+		sid = self.sids[0]
+		self.db.move_series(sid, 1, wait=0)
+		self.assertEqual(rebalance.plan(self.db), [(sid, 1, 0)])
+
+	def test_Unsharded(self):
+		# A series created before sharding was enabled has no shard:
+		# it is on the catalogue
+		sid = self.db.catalogue.create_series("old", MINUTE)
+		self.db.catalogue.add_value(sid, T0, 1.0)
+		self.db.loaded = None
+		self.assertEqual(self.db.shard_of(sid), 0)
+		self.assertTrue(self.db.add_value(sid, T0 + MINUTE, 2.0))
+		self.assertEqual(len(self.db.get_values_array(sid)), 2)
+		self.assertEqual(self.stored(0, sid), 2)
+		text = b"".join(self.db.export()).decode("utf-8")
+		self.assertEqual(sum(l.startswith(str(sid) + ",") for l in text.splitlines()), 2)
+		moves = rebalance.plan(self.db)
+		if db_sharded.place(sid, 2) == 0:
+			self.assertEqual(moves, [])
+		else:
+			self.assertEqual(moves, [(sid, 0, 1)])
+
+	def test_UnshardedCatalogue(self):
+		# With a catalogue which isn't a shard, series created before
+		# sharding stay on it, as an extra shard, until moved
+		conf = db_sharded._ShardConf(config, config.db_params)
+		conf.db_shards = config.db_shards[1:]
+		db = db_sharded.Database(conf)
+		try:
+			self.assertEqual((db.placed, db.home), (1, 1))
+			sid = db.catalogue.create_series("old", MINUTE)
+			self.assertTrue(db.add_value(sid, T0, 1.0))
+			self.assertEqual(self.stored(0, sid), 1)
+			self.assertIn((sid, 1, 0), rebalance.plan(db))
+			self.assertEqual(db.shard_of(db.create_series("new", MINUTE)), 0)
+		finally:
+			db.release()
+
+if __name__ == '__main__':
+	unittest.main()
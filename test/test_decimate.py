@@ -0,0 +1,87 @@
+"""Unit testing
+"""
+
+import unittest
+import math
+
+import fuse.decimate as decimate
+import fuse.arrays as arrays
+
+def wave(size, spike=None):
+	"""Return a ValueArray of a sine wave sampled every second, with a
+	spike at index spike
+	"""
+	stamps = [1000000 * i for i in range(size)]
+	values = [math.sin(i / 50.0) for i in range(size)]
+	if spike is not None:
+		values[spike] = 10.0
+	return arrays.ValueArray(stamps, values, 7)
+
+class TestDecimate(unittest.TestCase):
+	def test_Check(self):
+		self.assertRaises(ValueError, decimate.check, "average", 100)
+		self.assertRaises(ValueError, decimate.check, "lttb", 2)
+		decimate.check("minmax", 3)
+
+	def test_Small(self):
+		data = wave(10)
+		self.assertIs(decimate.decimate(data, 10), data)
+
+	def test_LTTB(self):
+		data = wave(10000, spike=4321)
+		for use_numpy in (True, False):
+			out = decimate.decimate(data, 100, "lttb", use_numpy)
+			stamps = list(out.stamps)
+			self.assertEqual(len(stamps), 100)
+			self.assertEqual(out.sid, 7)
+			self.assertEqual(stamps, sorted(stamps))
+			self.assertEqual(stamps[0], 0)
+			self.assertEqual(stamps[-1], data.stamps[-1])
+			self.assertIn(10.0, list(out.values))
+
+	def test_MinMax(self):
+		data = wave(10000, spike=4321)
+		for use_numpy in (True, False):
+			out = decimate.decimate(data, 100, "minmax", use_numpy)
+			values = list(out.values)
+			self.assertLessEqual(len(values), 100)
+			self.assertEqual(list(out.stamps), sorted(out.stamps))
+			self.assertEqual(max(values), 10.0)
+			self.assertEqual(min(values), min(data.values))
+
+	def test_Same(self):
+		# NumPy and plain Python give the same result
+		data = wave(5000)
+		for method in decimate.METHODS:
+			a = decimate.decimate(data, 64, method, True)
+			b = decimate.decimate(data, 64, method, False)
+			self.assertEqual(list(a), list(b))
+
+	def test_Chunks(self):
+		# Feeding the data in chunks gives the same result as all at once
+		data = wave(5000, spike=2500)
+		for method in decimate.METHODS:
+			for use_numpy in (True, False):
+				whole = decimate.decimate(data, 50, method, use_numpy)
+				dec = decimate.Decimator(method, 50, 0, data.stamps[-1], use_numpy)
+				for i in range(0, len(data), 333):
+					dec.feed(data.stamps[i:i + 333], data.values[i:i + 333])
+				self.assertEqual(list(dec.result(7)), list(whole))
+				self.assertLessEqual(len(dec.stamps), 2 * 5000 // 48 + 333)
+
+	def test_NaN(self):
+		data = wave(1000)
+		data.values[0] = data.values[500] = float("nan")
+		for method in decimate.METHODS:
+			for use_numpy in (True, False):
+				out = decimate.decimate(data, 20, method, use_numpy)
+				self.assertFalse(any(v != v for v in out.values))
+				if method == "lttb":
+					self.assertEqual(out.stamps[0], 1000000)
+
+	def test_Empty(self):
+		dec = decimate.Decimator("lttb", 10, 0, 100)
+		self.assertEqual(len(dec.result()), 0)
+
+if __name__ == '__main__':
+	unittest.main()
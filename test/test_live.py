@@ -0,0 +1,80 @@
+"""Unit testing
+"""
+
+import unittest
+import json
+
+from mock import Mock
+
+import fuse.live as live
+import fuse.metrics as metrics
+import fuse.arrays as arrays
+
+class TestHub(unittest.TestCase):
+	def setUp(self):
+		self.db = Mock()
+		self.reg = metrics.Registry()
+		self.hub = live.Hub(self.db, depth=2, registry=self.reg)
+		self.data = arrays.ValueArray([0], [1.5])
+
+	def event(self, sid):
+		return live.encode_event(sid, self.data)
+
+	def test_Encode(self):
+		event = self.event(3).decode("utf-8")
+		self.assertTrue(event.startswith("event: data\ndata: "))
+		self.assertTrue(event.endswith("\n\n"))
+		self.assertEqual(json.loads(event.split("data: ", 1)[1]),
+						 { "series": 3,
+						   "data": [["1970-01-01T00:00:00.000000+0000", 1.5]] })
+
+	def test_Listen(self):
+		self.hub.subscribe([1])
+		self.hub.subscribe()
+		self.db.listen.assert_called_once_with(self.hub.publish)
+
+	def test_Publish(self):
+		one = self.hub.subscribe([1])
+		both = self.hub.subscribe([1, 2])
+		every = self.hub.subscribe()
+		self.hub.publish(2, self.data)
+		self.assertEqual(both.get(0), self.event(2))
+		self.assertEqual(every.get(0), self.event(2))
+		self.assertTrue(one.queue.empty())
+		self.assertEqual(
+			self.reg.counter("fuse_live_events_total", "").values[()], 2)
+		self.assertEqual(
+			self.reg.gauge("fuse_live_subscribers", "").values[()], 3)
+
+	def test_Unsubscribe(self):
+		sub = self.hub.subscribe([1])
+		self.hub.unsubscribe(sub)
+		self.hub.publish(1, self.data)
+		self.assertIsNone(sub.get(0))
+		self.assertEqual(self.hub.subscribers, {})
+		self.assertEqual(
+			self.reg.gauge("fuse_live_subscribers", "").values[()], 0)
+
+	def test_Overflow(self):
+		slow = self.hub.subscribe([1])
+		for i in range(3):
+			self.hub.publish(1, self.data)
+		self.assertIsNone(slow.get(0))
+		self.assertEqual(self.hub.subscribers, {})
+		self.assertEqual(
+			self.reg.counter("fuse_live_dropped_total", "").values[()], 1)
+
+	def test_Stream(self):
+		sub = self.hub.subscribe([1])
+		stream = live.EventStream(self.hub, sub, heartbeat=0.01)
+		it = iter(stream)
+		self.assertEqual(next(it), live.RETRY)
+		self.assertEqual(next(it), live.KEEPALIVE)
+		self.hub.publish(1, self.data)
+		self.assertEqual(next(it), self.event(1))
+		stream.close()
+		self.assertEqual(list(it), [])
+		self.assertEqual(self.hub.subscribers, {})
+
+if __name__ == '__main__':
+	unittest.main()
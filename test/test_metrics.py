@@ -0,0 +1,60 @@
+"""Unit testing
+"""
+
+import unittest
+
+import fuse.metrics as metrics
+
+class TestMetrics(unittest.TestCase):
+	def setUp(self):
+		self.reg = metrics.Registry()
+
+	def test_CounterRender(self):
+		c = self.reg.counter("requests_total", "Requests", ("route",))
+		c.inc(("a",))
+		c.inc(("a",), 2)
+		c.inc(("b\"",))
+		self.assertEqual(
+			self.reg.render(),
+			"# HELP requests_total Requests\n"
+			"# TYPE requests_total counter\n"
+			'requests_total{route="a"} 3\n'
+			'requests_total{route="b\\""} 1\n')
+
+	def test_SameMetric(self):
+		c1 = self.reg.counter("requests_total", "Requests")
+		c2 = self.reg.counter("requests_total", "Requests")
+		self.assertIs(c1, c2)
+
+	def test_Histogram(self):
+		h = self.reg.histogram("latency", "Latency", ("route",),
+							   buckets=(0.1, 1.0))
+		h.observe(("a",), 0.05)
+		h.observe(("a",), 0.1)
+		h.observe(("a",), 0.5)
+		h.observe(("a",), 3.0)
+		lines = self.reg.render().split("\n")
+		self.assertIn('latency_bucket{route="a",le="0.1"} 2', lines)
+		self.assertIn('latency_bucket{route="a",le="1.0"} 3', lines)
+		self.assertIn('latency_bucket{route="a",le="+Inf"} 4', lines)
+		self.assertIn('latency_sum{route="a"} 3.65', lines)
+		self.assertIn('latency_count{route="a"} 4', lines)
+
+	def test_Collector(self):
+		def collect():
+			g = self.reg.collected(metrics.Gauge, "backlog", "Backlog")
+			g.set((), 12)
+			return [g]
+		self.reg.add_collector(collect)
+		self.assertIn("backlog 12", self.reg.render().split("\n"))
+
+	def test_AccountDB(self):
+		acc = metrics.begin_request()
+		metrics.account_db(0.5, 10)
+		metrics.account_db(0.25, -1)
+		metrics.end_request()
+		metrics.account_db(1.0, 10)
+		self.assertEqual(acc, [0.75, 10])
+
+if __name__ == '__main__':
+	unittest.main()
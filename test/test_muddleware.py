@@ -4,11 +4,18 @@
 import unittest
 import json
 import datetime
+import os
+import tempfile
+import pstats
+import gzip
 
 from mock import Mock, ANY, patch, call
 import wsgiref.headers
 
 import fuse.muddleware as mw
+import fuse.metrics as metrics
+import fuse.trace as trace
+import fuse.arrays as arrays
 
 _P15 = datetime.timezone(datetime.timedelta(0, 900))
 
@@ -56,6 +63,34 @@ class TestMuddleware(unittest.TestCase):
 		it = iter(data)
 		self.assertEqual(next(it), b'["some result", "more result"]')
 
+	def test_GzipIterator(self):
+		data = Mock()
+		data.__iter__ = Mock(return_value=iter([b"abc", b"", b"def" * 1000]))
+		it = mw.GzipIterator(data)
+		self.assertEqual(gzip.decompress(b"".join(it)), b"abc" + b"def" * 1000)
+		it.close()
+		data.close.assert_called_once_with()
+
+	def test_BinaryJSON_ValueArray(self):
+		data = mw.BinaryJSONIterator(arrays.ValueArray([0], [1.5]))
+		self.assertEqual(list(data), [b'[["1970-01-01T00:00:00.000000+0000", 1.5]]'])
+
+	def test_Release(self):
+		release = Mock()
+		app = mw.Release(self.app, release)
+		res = app(self.env, self.sr)
+		self.assertFalse(release.called)
+		self.assertEqual(list(res), self.result)
+		res.close()
+		release.assert_called_once_with()
+
+	def test_Release_Exception(self):
+		release = Mock()
+		self.app.side_effect = ValueError
+		app = mw.Release(self.app, release)
+		self.assertRaises(ValueError, app, self.env, self.sr)
+		release.assert_called_once_with()
+
 	def test_AccessFunction1(self):
 		wrap = mw.AccessFunctionWrapper(self.app)
 		res = wrap(self.env, self.sr)
@@ -167,6 +202,171 @@ class TestMuddleware(unittest.TestCase):
 		self.sr.assert_called_once_with(result, headers)
 		headers.append.called_once_with(("Access-Control-Allow-Origin", "bbc.co.uk carfax.org.uk"))
 
+	def test_Metrics(self):
+		"""Test that the metrics middleware records the request once
+		the response has been consumed
+		"""
+		def app(env, sr):
+			sr("404 Not found", [])
+			metrics.account_db(0.5, 7)
+			return [b"abc", b"de"]
+		reg = metrics.Registry()
+		wrapped = mw.Metrics(reg, "get_data")(app)
+		res = wrapped({"REQUEST_METHOD": "GET"}, self.sr)
+
+		self.sr.assert_called_once_with("404 Not found", [])
+		self.assertEqual(list(res), [b"abc", b"de"])
+		res.close()
+
+		labels = ("get_data", "GET", "404")
+		self.assertEqual(
+			reg.counter("fuse_http_requests_total", "").values[labels], 1)
+		self.assertEqual(
+			reg.counter("fuse_http_response_bytes_total", "").values[labels], 5)
+		self.assertEqual(
+			reg.counter("fuse_http_db_seconds_total", "").values[labels], 0.5)
+		self.assertEqual(
+			reg.counter("fuse_http_db_rows_total", "").values[labels], 7)
+		self.assertEqual(
+			reg.histogram("fuse_http_request_duration_seconds", "")
+			.values[labels][-1], 1)
+
+	def test_Metrics_Exception(self):
+		"""Test that a request whose app raises is recorded as a 500,
+		and stops accumulating database statistics
+		"""
+		def app(env, sr):
+			metrics.account_db(0.5, 7)
+			raise RuntimeError("broken")
+		reg = metrics.Registry()
+		wrapped = mw.Metrics(reg, "get_data")(app)
+		with self.assertRaises(RuntimeError):
+			wrapped({"REQUEST_METHOD": "GET"}, self.sr)
+
+		labels = ("get_data", "GET", "500")
+		self.assertEqual(
+			reg.counter("fuse_http_requests_total", "").values[labels], 1)
+		self.assertEqual(
+			reg.counter("fuse_http_db_seconds_total", "").values[labels], 0.5)
+		self.assertIsNone(metrics._local.acc)
+
+	def test_Tracing(self):
+		"""Test that the headers are held back until the body is
+		ready, and then include the Server-Timing header
+		"""
+		def app(env, sr):
+			sr("200 OK", [("X-Header", "Empty")])
+			with trace.span("encode"):
+				pass
+			return [b"abc"]
+		wrapped = mw.Tracing("get_data")(app)
+		res = wrapped({}, self.sr)
+		self.assertFalse(self.sr.called)
+
+		self.assertEqual(list(res), [b"abc"])
+		self.assertEqual(self.sr.call_count, 1)
+		result, headers = self.sr.call_args[0]
+		self.assertEqual(result, "200 OK")
+		self.assertEqual(headers[0], ("X-Header", "Empty"))
+		self.assertEqual(headers[1][0], "Server-Timing")
+		self.assertRegex(headers[1][1], r"^encode;dur=[0-9.]+, total;dur=[0-9.]+$")
+		self.assertIsNone(trace.current())
+
+	def test_TracingFile(self):
+		"""Test that sampled traces are written to the trace file
+		"""
+		def app(env, sr):
+			sr("200 OK", [])
+			return []
+		with tempfile.TemporaryDirectory() as tmp:
+			fname = os.path.join(tmp, "trace.jsonl")
+			wrapped = mw.Tracing("get_data", sample_rate=1.0,
+								 trace_file=fname, header=False)(app)
+			res = wrapped({"REQUEST_METHOD": "GET", "PATH_INFO": "/x"}, self.sr)
+			self.assertEqual(list(res), [])
+			self.sr.assert_called_once_with("200 OK", [])
+			with open(fname) as f:
+				lines = [json.loads(l) for l in f]
+		self.assertEqual(len(lines), 1)
+		self.assertEqual(lines[0]["route"], "get_data")
+		self.assertEqual(lines[0]["status"], "200")
+		self.assertEqual(lines[0]["path"], "/x")
+		self.assertEqual([s[0] for s in lines[0]["spans"]], [])
+
+	def test_TracingException(self):
+		"""Test that the trace of a request whose app raises is ended,
+		and written to the trace file even if not sampled
+		"""
+		def app(env, sr):
+			with trace.span("query"):
+				raise RuntimeError("broken")
+		with tempfile.TemporaryDirectory() as tmp:
+			fname = os.path.join(tmp, "trace.jsonl")
+			wrapped = mw.Tracing("get_data", sample_rate=0.0,
+								 trace_file=fname)(app)
+			with self.assertRaises(RuntimeError):
+				wrapped({"REQUEST_METHOD": "GET"}, self.sr)
+			with open(fname) as f:
+				lines = [json.loads(l) for l in f]
+		self.assertIsNone(trace.current())
+		self.assertEqual(len(lines), 1)
+		self.assertEqual(lines[0]["status"], "500")
+		self.assertEqual(lines[0]["error"], "RuntimeError: broken")
+		self.assertEqual([s[0] for s in lines[0]["spans"]], ["query"])
+
+	def test_Profiler_NotWanted(self):
+		with tempfile.TemporaryDirectory() as tmp:
+			app = mw.Profiler(self.app, tmp, token="secret")
+			res = app({"HTTP_X_FUSE_PROFILE": "guess"}, self.sr)
+			self.assertIs(res, self.result)
+			self.assertEqual(os.listdir(tmp), [])
+
+	def test_Profiler_Token(self):
+		def app(env, sr):
+			sr("200 OK", [])
+			return [b"abc"]
+		with tempfile.TemporaryDirectory() as tmp:
+			wrapped = mw.Profiler(app, tmp, token="secret", memory=True)
+			res = wrapped({"HTTP_X_FUSE_PROFILE": "secret",
+						   "PATH_INFO": "/api/series"}, self.sr)
+			self.assertEqual(list(res), [b"abc"])
+			result, headers = self.sr.call_args[0]
+			name = dict(headers)["X-Fuse-Profile"]
+			self.assertCountEqual(os.listdir(tmp),
+								  [name + ".pstats", name + ".tracemalloc"])
+			pstats.Stats(os.path.join(tmp, name + ".pstats"))
+
+	def test_Profiler_Retention(self):
+		def app(env, sr):
+			sr("200 OK", [])
+			return []
+		with tempfile.TemporaryDirectory() as tmp:
+			wrapped = mw.Profiler(app, tmp, sample_rate=1.0, keep=2)
+			names = []
+			for i in range(3):
+				list(wrapped({}, self.sr))
+				names.append(dict(self.sr.call_args[0][1])["X-Fuse-Profile"])
+				# Make sure the modification times differ
+				os.utime(os.path.join(tmp, names[-1] + ".pstats"), (i, i))
+			self.assertCountEqual(os.listdir(tmp),
+								  [n + ".pstats" for n in names[1:]])
+
+	def test_Profiler_OneAtATime(self):
+		def app(env, sr):
+			sr("200 OK", [])
+			return [b"abc"]
+		with tempfile.TemporaryDirectory() as tmp:
+			wrapped = mw.Profiler(app, tmp, sample_rate=1.0)
+			first = wrapped({}, self.sr)
+			# The first response is still being generated, so the second
+			# request isn't profiled
+			self.assertEqual(wrapped({}, self.sr), [b"abc"])
+			self.assertNotIn("X-Fuse-Profile", dict(self.sr.call_args[0][1]))
+			first.close()
+			list(wrapped({}, self.sr))
+			self.assertIn("X-Fuse-Profile", dict(self.sr.call_args[0][1]))
+			self.assertEqual(len(os.listdir(tmp)), 2)
+
 # FIXME: Add tests for the exception handler and HTTP change/caching
 # test function
 
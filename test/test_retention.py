@@ -0,0 +1,64 @@
+"""Unit testing
+"""
+
+import unittest
+import datetime
+
+from mock import Mock
+
+import fuse.retention as retention
+import fuse.metrics as metrics
+import fuse.db_memory as db_memory
+
+_UTC = datetime.timezone.utc
+HOUR = datetime.timedelta(hours=1)
+
+class TestRetention(unittest.TestCase):
+	def setUp(self):
+		self.db = db_memory.Database(None)
+		self.reg = metrics.Registry()
+		self.now = datetime.datetime(2020, 1, 10, 12, 30, tzinfo=_UTC)
+		self.keep = self.db.create_series("keep", datetime.timedelta(seconds=60))
+		self.sid = self.db.create_series("expire", datetime.timedelta(seconds=60),
+										 retention=datetime.timedelta(days=1))
+		for sid in (self.keep, self.sid):
+			for m in range(0, 48 * 60, 30):
+				self.db.add_value(sid, self.now - datetime.timedelta(minutes=m),
+								  float(m))
+		self.worker = retention.RetentionWorker(
+			self.db, bucket=HOUR, batch_size=7, pause=0, registry=self.reg)
+
+	def test_Cutoff(self):
+		self.assertEqual(retention.cutoff(self.now, datetime.timedelta(days=1), HOUR),
+						 datetime.datetime(2020, 1, 9, 12, 0, tzinfo=_UTC))
+
+	def test_RunOnce(self):
+		before = datetime.datetime(2020, 1, 9, 12, 0, tzinfo=_UTC)
+		expired = self.db.count_expired(self.sid, before)
+		self.assertEqual(self.worker.run_once(self.now), expired)
+		self.assertEqual(self.db.count_expired(self.sid, before), 0)
+		self.assertEqual(len(list(self.db.get_values(self.keep))), 96)
+		self.assertEqual(
+			self.reg.counter("fuse_retention_purged_points_total", "").values[()],
+			expired)
+		self.assertEqual(
+			self.reg.gauge("fuse_retention_backlog_points", "").values[()], 0)
+
+		rollup = self.db.get_rollup(self.sid)
+		self.assertEqual(sum(r[1] for r in rollup), expired)
+		# The newest bucket: the points at 11:30 and 11:00
+		self.assertEqual(rollup[-1], (before - HOUR, 2, 1500.0, 1530.0, 1515.0))
+		self.assertEqual(self.worker.run_once(self.now), 0)
+	def test_Locked(self):
+		# Another worker holds the lock: this one does nothing
+		self.db.try_lock = Mock(return_value=False)
+		self.db.unlock = Mock()
+		self.assertEqual(self.worker.run_once(self.now), 0)
+		self.db.try_lock.assert_called_once_with(retention.LOCK_KEY)
+		self.assertFalse(self.db.unlock.called)
+		self.db.try_lock.return_value = True
+		self.assertGreater(self.worker.run_once(self.now), 0)
+		self.db.unlock.assert_called_once_with(retention.LOCK_KEY)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,103 @@
+"""Unit testing
+"""
+
+import unittest
+import random
+import bisect
+import datetime
+
+import fuse.sketch as sketch
+import fuse.arrays as arrays
+
+_UTC = datetime.timezone.utc
+
+QUANTILES = (0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999)
+
+def rank_error(data, q, estimate):
+	"""Return how far q is from the range of ranks (as fractions of the
+	sorted data) that estimate falls at
+	"""
+	lo = bisect.bisect_left(data, estimate) / len(data)
+	hi = bisect.bisect_right(data, estimate) / len(data)
+	if lo <= q <= hi:
+		return 0.0
+	return min(abs(lo - q), abs(hi - q))
+
+class TestTDigest(unittest.TestCase):
+	def setUp(self):
+		rng = random.Random(7)
+		self.distributions = {
+			"uniform": lambda: rng.random(),
+			"normal": lambda: rng.gauss(0, 1),
+			"exponential": lambda: rng.expovariate(1.0),
+			"lognormal": lambda: rng.lognormvariate(0, 2),
+			"pareto": lambda: rng.paretovariate(1.5),
+			}
+
+	def check_bounds(self, data, digest, name):
+		data = sorted(data)
+		for q, estimate in zip(QUANTILES, digest.quantiles(QUANTILES)):
+			bound = 0.002 if q < 0.01 or q > 0.99 else 0.005
+			self.assertLessEqual(rank_error(data, q, estimate), bound,
+								 "{0}, q={1}".format(name, q))
+
+	def test_Bounds(self):
+		# The documented rank error bounds hold for a digest of all the
+		# data, and for one merged from digests of parts of it
+		for name, draw in self.distributions.items():
+			data = [draw() for i in range(50000)]
+			self.check_bounds(data, sketch.TDigest.from_values(data), name)
+			parts = [sketch.TDigest.from_values(data[i:i + 1440])
+					 for i in range(0, len(data), 1440)]
+			merged = sketch.TDigest.merge(parts)
+			self.assertEqual(merged.count, len(data))
+			self.assertLessEqual(len(merged.means), sketch.COMPRESSION // 2 + 1)
+			self.check_bounds(data, merged, name + " merged")
+
+	def test_Bounds_NoNumpy(self):
+		data = [self.distributions["lognormal"]() for i in range(20000)]
+		parts = [sketch.TDigest.from_values(data[i:i + 1000], use_numpy=False)
+				 for i in range(0, len(data), 1000)]
+		self.check_bounds(data, sketch.TDigest.merge(parts, use_numpy=False),
+						  "lognormal")
+
+	def test_Exact(self):
+		digest = sketch.TDigest.from_values([3.0, float("nan"), 1.0, 2.0])
+		self.assertEqual(digest.count, 3)
+		self.assertEqual(digest.quantiles([0, 0.5, 1]), [1.0, 2.0, 3.0])
+		self.assertEqual(sketch.TDigest.from_values([5.0]).quantiles([0.1, 0.9]),
+						 [5.0, 5.0])
+		empty = sketch.TDigest.merge([sketch.TDigest(), sketch.TDigest.from_values([])])
+		self.assertEqual(empty.count, 0)
+		self.assertTrue(all(v != v for v in empty.quantiles([0.5])))
+
+	def test_Bytes(self):
+		digest = sketch.TDigest.from_values([float(i % 17) for i in range(1000)])
+		copy = sketch.TDigest.from_bytes(digest.to_bytes())
+		self.assertEqual((copy.means, copy.weights, copy.min, copy.max),
+						 (digest.means, digest.weights, digest.min, digest.max))
+
+	def test_ParsePercentiles(self):
+		self.assertEqual(sketch.parse_percentiles("p50, P95,p99"), [0.5, 0.95, 0.99])
+		self.assertAlmostEqual(sketch.parse_percentiles("p99.9")[0], 0.999)
+		for bad in ("50", "p101", "pfoo", "p50,", "pnan"):
+			self.assertRaises(ValueError, sketch.parse_percentiles, bad)
+
+	def test_Percentiles(self):
+		day = datetime.timedelta(days=1)
+		base = datetime.datetime(2020, 1, 1, tzinfo=_UTC)
+		sketches = [(base + i * day, sketch.TDigest.from_values(
+			[float(i * 10 + v) for v in range(11)])) for i in range(10)]
+		sketches[3] = (base + 3 * day, sketch.TDigest())
+		# Weekly, counted from the second day
+		data = sketch.percentiles(sketches[1:], [0, 1], 7 * sketch.BUCKET_US,
+								  arrays.to_stamp(base + day), 3)
+		self.assertEqual(data.sid, 3)
+		self.assertEqual([ts for ts, v in data], [base + day, base + 8 * day])
+		self.assertEqual([v for ts, v in data], [(10.0, 80.0), (80.0, 100.0)])
+		# Empty intervals are left out
+		data = sketch.percentiles(sketches[3:4], [0.5], sketch.BUCKET_US)
+		self.assertEqual(len(data), 0)
+
+if __name__ == '__main__':
+	unittest.main()
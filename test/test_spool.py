@@ -0,0 +1,86 @@
+"""Unit testing
+"""
+
+import unittest
+import os
+import tempfile
+import datetime
+
+from mock import Mock
+
+import fuse.spool as spool
+import fuse.metrics as metrics
+import fuse.db_memory as db_memory
+
+class TestSpool(unittest.TestCase):
+	def setUp(self):
+		self.tmp = tempfile.TemporaryDirectory()
+		self.db = db_memory.Database(None)
+		self.sid = self.db.create_series("s", datetime.timedelta(seconds=60))
+		self.reg = metrics.Registry()
+
+	def tearDown(self):
+		self.tmp.cleanup()
+
+	def make(self, **kwargs):
+		sp = spool.Spool(self.db, self.tmp.name, flush_seconds=60,
+						 registry=self.reg, **kwargs)
+		sp.start()
+		return sp
+
+	def stored(self):
+		va = self.db.get_values_array(self.sid)
+		return list(zip([int(s) for s in va.stamps], va.value_list()))
+
+	def test_Flush(self):
+		sp = self.make()
+		sp.append(self.sid, [1, 2], [1.0, 2.0])
+		sp.append(self.sid, [2, 3], [2.5, 3.0])
+		self.assertEqual(self.stored(), [])
+		sp.stop()
+		self.assertEqual(self.stored(), [(1, 1.0), (2, 2.5), (3, 3.0)])
+		self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+		self.assertEqual(sp.pending, 0)
+		self.assertEqual(
+			self.reg.counter("fuse_spool_flushed_points_total", "").values[()], 4)
+
+	def test_Replay(self):
+		sp = self.make()
+		sp.append(self.sid, [1], [1.0])
+		sp.append(self.sid, [2], [2.0])
+		# Simulate a crash in the middle of writing a record
+		with open(sp.file.name, "ab") as f:
+			f.write(spool.encode_record(self.sid, [3], [3.0])[:-1])
+		self.make()
+		self.assertEqual(self.stored(), [(1, 1.0), (2, 2.0)])
+
+	def test_Full(self):
+		sp = self.make(max_bytes=1)
+		sp.append(self.sid, [1], [1.0])
+		self.assertRaises(spool.SpoolFull, sp.append, self.sid, [2], [2.0])
+		sp.stop()
+		self.assertEqual(self.stored(), [(1, 1.0)])
+		sp = self.make(max_bytes=1)
+		sp.append(self.sid, [2], [2.0])
+
+	def test_Retry(self):
+		sp = self.make()
+		sp.append(self.sid, [1], [1.0])
+		self.db.add_values_array = Mock(return_value=([0], 0))
+		self.assertRaises(IOError, sp.flush)
+		self.assertEqual(len(os.listdir(self.tmp.name)), 2)
+		del self.db.add_values_array
+		sp.flush()
+		self.assertEqual(self.stored(), [(1, 1.0)])
+		self.assertEqual(sp.pending, 0)
+
+	def test_MissingSeries(self):
+		sp = self.make()
+		sp.append(self.sid + 1, [1], [1.0])
+		sp.flush()
+		self.assertEqual(
+			self.reg.counter("fuse_spool_rejected_points_total", "").values[()], 1)
+		self.assertEqual(len(os.listdir(self.tmp.name)), 1)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,135 @@
+"""Unit testing
+"""
+
+import unittest
+import datetime
+import time
+
+from mock import Mock
+
+import fuse.tailcache as tailcache
+import fuse.db_memory as db_memory
+import fuse.arrays as arrays
+import fuse.live as live
+import fuse.metrics as metrics
+
+_UTC = datetime.timezone.utc
+MINUTE = datetime.timedelta(seconds=60)
+
+class TestTail(unittest.TestCase):
+	def test_Store(self):
+		tail = tailcache._Tail(10, tailcache._to_array("q", [10, 20]),
+							   tailcache._to_array("d", [1.0, 2.0]))
+		tail.store([30, 15, 20, 5], [3.0, 1.5, 2.5, 0.5])
+		self.assertEqual(list(tail.stamps), [10, 15, 20, 30])
+		self.assertEqual(list(tail.values), [1.0, 1.5, 2.5, 3.0])
+		self.assertEqual([list(a) for a in tail.slice(15, 30)], [[15, 20], [1.5, 2.5]])
+
+	def test_StoreBatch(self):
+		# A late batch, out of order and with repeats, is merged in
+		tail = tailcache._Tail(0, tailcache._to_array("q", range(0, 1000, 10)),
+							   tailcache._to_array("d", [0.0] * 100))
+		expected = dict.fromkeys(range(0, 1000, 10), 0.0)
+		batch = [(995, 1.0), (5, 2.0), (500, 3.0), (5, 4.0), (1005, 5.0), (-5, 6.0)]
+		tail.store([ts for ts, v in batch], [v for ts, v in batch])
+		expected.update((ts, v) for ts, v in batch if ts >= 0)
+		self.assertEqual(list(tail.stamps), sorted(expected))
+		self.assertEqual(list(tail.values), [expected[ts] for ts in sorted(expected)])
+
+	def test_Trim(self):
+		tail = tailcache._Tail(0, tailcache._to_array("q", range(100)),
+							   tailcache._to_array("d", [0.0] * 100))
+		self.assertEqual(tail.trim(5), 0)
+		self.assertEqual(tail.start, 5)
+		self.assertEqual(tail.trim(50), 50)
+		self.assertEqual(tail.stamps[0], 50)
+		self.assertEqual(tail.trim(40), 0)
+		# Too few of a large tail to be worth shifting it down for
+		tail = tailcache._Tail(0, tailcache._to_array("q", range(100000)),
+							   tailcache._to_array("d", [0.0] * 100000))
+		self.assertEqual(tail.trim(2000), 0)
+		self.assertEqual(tail.trim(20000), 20000)
+
+class TestTailCache(unittest.TestCase):
+	def setUp(self):
+		conf = Mock()
+		conf.tail_window_seconds = 3600
+		conf.tail_max_points = 100
+		conf.live_notify = True
+		self.db = tailcache.cached(db_memory.Database)(conf)
+		self.now = datetime.datetime.now(_UTC).replace(second=0, microsecond=0)
+		self.sid = self.db.create_series("s", MINUTE)
+		for m in range(90):
+			self.db.add_value(self.sid, self.now - m * MINUTE, float(m))
+		self.recent = self.now - 30 * MINUTE
+
+	def reads(self, result):
+		return self.db.tail_reads.values.get((result,), 0)
+
+	def test_Load(self):
+		before = self.reads("hit")
+		data = self.db.get_values_array(self.sid, self.recent)
+		self.assertEqual(list(data.values), [float(m) for m in range(30, -1, -1)])
+		self.assertIn(self.sid, self.db.tails)
+		self.assertEqual(len(list(self.db.get_values(self.sid, self.recent,
+													 self.now))), 30)
+		self.assertEqual(self.reads("hit"), before + 1)
+		# Older data comes from the database
+		self.assertEqual(len(self.db.get_values_array(self.sid)), 90)
+
+	def test_NotReady(self):
+		# Until the database's notifications can be relied on, reads
+		# go to the database
+		self.db.tail_ready = time.monotonic() + 60
+		before = self.reads("database")
+		self.assertEqual(len(self.db.get_values_array(self.sid, self.recent)), 31)
+		self.assertNotIn(self.sid, self.db.tails)
+		self.assertGreater(self.reads("database"), before)
+
+	def test_Write(self):
+		self.db.get_values_array(self.sid, self.recent)
+		# A late overwrite, a new point, and a rejected one
+		self.db.add_values_array(
+			self.sid,
+			[arrays.to_stamp(self.now - 10 * MINUTE), arrays.to_stamp(self.now + MINUTE),
+			 2**62],
+			[-1.0, -2.0, 5.0])
+		self.db.add_value(self.sid, self.now, -3.0)
+		data = self.db.get_values_array(self.sid, self.recent)
+		self.assertEqual(data.values[-12:].tolist(), [-1.0] + [float(m) for m in range(9, 0, -1)]
+						 + [-3.0, -2.0])
+		self.assertEqual(list(data), list(db_memory.Database.get_values_array(
+			self.db, self.sid, self.recent)))
+
+	def test_OtherWriter(self):
+		self.db.get_values_array(self.sid, self.recent)
+		self.db._tail_notified(self.sid, arrays.from_points(
+			[(arrays.to_stamp(self.now), 9.0)], self.sid))
+		self.assertEqual(self.db.get_values_array(self.sid, self.now)[0][1], 9.0)
+
+	def test_OneListener(self):
+		# The live update hub is fed from the cache's listener, rather
+		# than starting another
+		hub = live.Hub(self.db, registry=metrics.Registry())
+		sub = hub.subscribe([self.sid])
+		self.assertEqual(self.db.listeners, [self.db._tail_notified])
+		self.db.add_value(self.sid, self.now, 9.0)
+		self.assertIn(b"9.0", sub.get(timeout=1))
+
+	def test_Evict(self):
+		other = self.db.create_series("t", MINUTE)
+		for m in range(80):
+			self.db.add_value(other, self.now - m * MINUTE, float(m))
+		self.db.get_values_array(self.sid, self.recent)
+		self.db.get_values_array(other, self.recent)
+		self.assertEqual(list(self.db.tails), [other])
+		self.assertLessEqual(self.db.tail_points, 100)
+
+	def test_Drop(self):
+		self.db.get_values_array(self.sid, self.recent)
+		self.db.drop_series(self.sid)
+		self.assertEqual(self.db.tails, {})
+		self.assertEqual(self.db.tail_points, 0)
+
+if __name__ == '__main__':
+	unittest.main()
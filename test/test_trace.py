@@ -0,0 +1,46 @@
+"""Unit testing
+"""
+
+import unittest
+
+import fuse.trace as trace
+
+class TestTrace(unittest.TestCase):
+	def tearDown(self):
+		trace.end()
+
+	def test_NoTrace(self):
+		self.assertIsNone(trace.current())
+		with trace.span("nothing"):
+			pass
+		trace.add("nothing", 0.0, 1.0)
+
+	def test_Spans(self):
+		t = trace.begin()
+		with trace.span("db"):
+			pass
+		trace.add("db", t.start, 0.002)
+		trace.add("encode", t.start, 0.001)
+		self.assertIs(trace.current(), t)
+		self.assertEqual([n for n, s, d in t.spans], ["db", "db", "encode"])
+		totals = t.totals()
+		self.assertEqual([n for n, d in totals], ["db", "encode"])
+		self.assertGreaterEqual(totals[0][1], 0.002)
+
+	def test_ServerTiming(self):
+		t = trace.begin()
+		trace.add("db", t.start, 0.0015)
+		trace.add("db", t.start, 0.001)
+		self.assertEqual(t.server_timing(0.004),
+						 "db;dur=2.500, total;dur=4.000")
+
+	def test_Overflow(self):
+		t = trace.begin()
+		for i in range(trace.MAX_SPANS + 10):
+			trace.add("parse", t.start, 0.001)
+		self.assertEqual(len(t.spans), trace.MAX_SPANS)
+		self.assertAlmostEqual(t.overflow["parse"], 0.01)
+		self.assertAlmostEqual(t.totals()[0][1], (trace.MAX_SPANS + 10) * 0.001)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,65 @@
+"""Unit testing
+"""
+
+import unittest
+import datetime
+
+import fuse.watermark as watermark
+
+_UTC = datetime.timezone.utc
+
+class TestWatermark(unittest.TestCase):
+	def test_Parse(self):
+		for token in ("0", "1577836800000000", "15.3.-20"):
+			self.assertEqual(str(watermark.Watermark.parse(token)), token)
+		self.assertEqual(watermark.Watermark.parse("15.3.-20"),
+						 watermark.Watermark(15, 3, -20))
+
+	def test_ParseBad(self):
+		for token in ("", "moo", "1.2", "1.2.3.4", "999999999999999999999999999999",
+					  "-999999999999999999999", "0.1.999999999999999999999",
+					  "0.4294967296.0"):
+			self.assertRaises(ValueError, watermark.Watermark.parse, token)
+
+	def test_Key(self):
+		epoch = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+		row = (epoch, 3, epoch)
+		self.assertLess(watermark.Watermark(-1).key(), row)
+		self.assertGreater(watermark.Watermark(0).key(), row)
+		self.assertEqual(watermark.Watermark(0, 3, 0).key(), row)
+		self.assertLess(watermark.Watermark(0, 2, 5).key(), row)
+
+	def test_NextWatermark(self):
+		epoch = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+		second = datetime.timedelta(seconds=1)
+		rows = [(epoch, 3, epoch + second, 1.0), (epoch + second, 2, epoch, 2.0)]
+		since = watermark.Watermark(0)
+		# A full page ends at the last row
+		self.assertEqual(watermark.next_watermark(since, rows, 2, epoch + 5 * second),
+						 watermark.Watermark(1000000, 2, 0))
+		# Otherwise at the horizon, which never moves backwards
+		self.assertEqual(watermark.next_watermark(since, rows, 3, epoch + 5 * second),
+						 watermark.Watermark(5000000))
+		self.assertEqual(watermark.next_watermark(watermark.Watermark(9), [], 3, epoch),
+						 watermark.Watermark(9))
+
+	def test_Group(self):
+		epoch = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+		second = datetime.timedelta(seconds=1)
+		groups = watermark.group([(epoch, 3, epoch + second, 1.0),
+								  (epoch, 2, epoch, 2.0),
+								  (epoch, 3, epoch, 3.0)])
+		self.assertEqual(sorted(groups), [2, 3])
+		self.assertEqual(list(groups[3].stamps), [0, 1000000])
+		self.assertEqual(list(groups[3].values), [3.0, 1.0])
+		self.assertEqual(groups[3].sid, 3)
+
+	def test_GroupNull(self):
+		epoch = datetime.datetime(1970, 1, 1, tzinfo=_UTC)
+		groups = watermark.group([(epoch, 3, epoch, None)])
+		value = groups[3].values[0]
+		self.assertNotEqual(value, value)
+
+
+if __name__ == '__main__':
+	unittest.main()